@@ -0,0 +1,112 @@
+# encoding: utf-8
+"""
+Benchmark cases: each one names the code path it drives and builds request `i` of the run.
+A request is <method, path, headers, body>. Transform cases vary `side`/`size` per request
+so every request misses the derivative cache ('cold'), their '_warm' twin repeats one derivative.
+"""
+import os
+import random
+import uuid
+
+from Benchmark import Fixtures
+
+
+class Case:
+
+    def __init__(self, name, path, request, iterations, warmup=0, statuses=(200,)):
+        """
+        :param path: code path measured, for the report
+        :param request: `request(i)` -> <method, url, headers, body>
+        :param statuses: expected status codes, anything else counts as an error
+        """
+        self.name = name
+        self.path = path
+        self.request = request
+        self.iterations = iterations
+        self.warmup = warmup
+        self.statuses = statuses
+
+
+def __get(url, headers=None):
+    return 'GET', url, headers or {}, None
+
+
+def __upload(i):
+    data = __upload_data[0]
+    boundary = uuid.uuid4().hex
+    body = b''.join([
+        ('--%s\r\nContent-Disposition: form-data; name="file"; filename="upload_%d.bin"\r\n'
+         'Content-Type: application/octet-stream\r\n\r\n' % (boundary, i)).encode('latin-1'),
+        data,
+        ('\r\n--%s--\r\n' % boundary).encode('latin-1'),
+    ])
+    return 'POST', '/file/upload/', {'Content-Type': 'multipart/form-data; boundary=' + boundary}, body
+
+
+def __range(i, size, length=1024 * 1024):
+    start = random.Random(i).randrange(0, max(1, size - length))
+    return __get('/file/download/large.bin', {'Range': 'bytes=%d-%d' % (start, start + length - 1)})
+
+
+def __multi_range(i, size, length=64 * 1024, count=8):
+    rng = random.Random(i)
+    ranges = []
+    for _ in range(count):
+        start = rng.randrange(0, max(1, size - length))
+        ranges.append('%d-%d' % (start, start + length - 1))
+    return __get('/file/download/large.bin', {'Range': 'bytes=' + ','.join(ranges)})
+
+
+__upload_data = [b'']
+
+
+def cases(fixtures, scale=1.0):
+    """
+    :param fixtures: dict of stored name -> path, see Fixtures.build
+    :param scale: multiplies every iteration count
+    :return: list of Case
+    """
+    with open(fixtures['upload.bin'], 'rb') as f:
+        __upload_data[0] = f.read()
+    large_size = os.path.getsize(fixtures['large.bin'])
+
+    def n(count):
+        return max(1, int(count * scale))
+
+    pages = Fixtures.COMIC_PAGES
+    return [
+        Case('upload', 'FileService.perform_upload', __upload, n(20)),
+        Case('download_full', 'RangeResponse.stream_response (full body)',
+             lambda i: __get('/file/download/large.bin'), n(10)),
+        Case('download_range', 'RangeResponse.__range_stream_response (1 MB)',
+             lambda i: __range(i, large_size), n(300), statuses=(206,)),
+        Case('download_multi_range', 'RangeResponse.__range_fd_response (multipart/byteranges)',
+             lambda i: __multi_range(i, large_size), n(200), statuses=(206,)),
+        Case('image_side_jpeg', 'RangeResponse.__compress_image_side_response (cold)',
+             lambda i: __get('/file/download/photo.jpg?side=%d' % (200 + i)), n(20)),
+        Case('image_side_jpeg_warm', 'RangeResponse.__compress_image_side_response (cached)',
+             lambda i: __get('/file/download/photo.jpg?side=300'), n(200), warmup=1),
+        Case('image_side_jpeg_derived', 'RangeResponse.__compress_image_side_response (cold, from the cached 1080)',
+             lambda i: __get('/file/download/photo.jpg?side=%d' % (1080 if i < 0 else 100 + i)), n(20), warmup=1),
+        Case('image_side_png', 'RangeResponse.__compress_image_side_response (cold)',
+             lambda i: __get('/file/download/photo.png?side=%d' % (200 + i)), n(20)),
+        Case('image_fit_size', 'RangeResponse.__compress_image_quality_response (cold)',
+             lambda i: __get('/file/download/photo.jpg?size=%d&side=1080' % (100 + i)), n(20)),
+        Case('gif_side', 'RangeResponse.__compress_gif_response (cold)',
+             lambda i: __get('/file/download/anim.gif?side=%d' % (100 + i)), n(10)),
+        Case('gif_side_webp', 'RangeResponse.__compress_gif_response (cold, animated WebP)',
+             lambda i: __get('/file/download/anim.gif?side=%d' % (100 + i), {'Accept': 'image/webp'}), n(10)),
+        Case('audio_cover', 'RangeResponse.audio_cover_response (cold sides)',
+             lambda i: __get('/file/download/song.mp3?cover=1&mime=audio/mpeg&side=%d' % (200 + i)), n(20)),
+        Case('video_cover', 'RangeResponse.video_cover_response (cold sides)',
+             lambda i: __get('/file/download/clip.mp4?cover=1&mime=video/mp4&side=%d' % (200 + i)), n(20)),
+        Case('epub_cover', 'RangeResponse.epub_cover_response (cold sides)',
+             lambda i: __get('/file/download/book.epub?cover=1&mime=application/epub%%2Bzip&side=%d' % (200 + i)), n(20)),
+        Case('inzip_stored', 'RangeResponse.__full_stream_inzip_response (stored member)',
+             lambda i: __get('/file/download/comic.zip/page_%03d.jpg' % (i % pages)), n(200)),
+        Case('inzip_stored_range', 'RangeResponse.__range_stream_response (stored member)',
+             lambda i: __get('/file/download/comic.zip/page_%03d.jpg' % (i % pages), {'Range': 'bytes=1024-66559'}),
+             n(200), statuses=(206,)),
+        Case('inzip_deflated', 'RangeResponse.__full_stream_inzip_response (deflated member)',
+             lambda i: __get('/file/download/book.epub/OEBPS/text/c1.xhtml'), n(200)),
+    ]
@@ -0,0 +1,167 @@
+# encoding: utf-8
+"""
+Synthetic, seeded benchmark inputs: a large binary, JPEG/PNG/GIF images, an MP3 with APIC art,
+an MP4, an EPUB with a cover and a comic ZIP of stored pages.
+They are built once per `--base` directory and hard linked into the store of every case.
+"""
+from io import BytesIO
+import json
+import os
+import random
+import shutil
+import zipfile
+
+import cv2
+import numpy
+from mutagen.id3 import ID3, APIC
+from PIL import Image
+
+import GlobalConfigContext
+from Service import StoreLayout
+
+__manifest_name = 'manifest.json'
+COMIC_PAGES = 24
+
+
+def build(directory, large_mb=256, upload_mb=16):
+    """
+    :return: dict of stored name -> fixture path
+    """
+    manifest_path = os.path.join(directory, __manifest_name)
+    settings = {'large_mb': large_mb, 'upload_mb': upload_mb}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        if manifest['settings'] == settings and all(os.path.exists(p) for p in manifest['files'].values()):
+            return manifest['files']
+
+    os.makedirs(directory, exist_ok=True)
+    rng = random.Random(20240101)
+    files = {}
+
+    def path(name):
+        files[name] = os.path.join(directory, name)
+        return files[name]
+
+    __binary(path('large.bin'), large_mb * 1024 * 1024, rng)
+    __binary(path('upload.bin'), upload_mb * 1024 * 1024, rng)
+    photo = __photo(4000, 3000, seed=1)
+    photo.save(path('photo.jpg'), format='JPEG', quality=92)
+    __photo(2048, 1536, seed=2).save(path('photo.png'), format='PNG')
+    __gif(path('anim.gif'), 480, 360, 30)
+    cover = BytesIO()
+    __photo(1200, 1200, seed=3).save(cover, format='JPEG', quality=90)
+    __mp3(path('song.mp3'), cover.getvalue())
+    __mp4(path('clip.mp4'), 1280, 720, 25 * 20)
+    __epub(path('book.epub'), cover.getvalue())
+    __comic(path('comic.zip'), COMIC_PAGES)
+
+    with open(manifest_path, 'w') as f:
+        json.dump({'settings': settings, 'files': files}, f)
+    return files
+
+
+def install(files):
+    """
+    Link the fixtures into the configured store under their stored names.
+    """
+    for name, source in files.items():
+        if name == 'upload.bin':
+            continue
+        target = StoreLayout.store_path(name)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        if os.path.exists(target):
+            continue
+        try:
+            os.link(source, target)
+        except OSError:
+            shutil.copyfile(source, target)
+    os.makedirs(GlobalConfigContext.FileCache_Directory, exist_ok=True)
+
+
+def __binary(path, size, rng, buffer_size=4 * 1024 * 1024):
+    block = rng.randbytes(buffer_size)
+    with open(path, 'wb') as f:
+        left = size
+        while left > 0:
+            f.write(block[:min(left, buffer_size)])
+            left -= buffer_size
+
+
+def __photo(width, height, seed):
+    """
+    Smooth gradients plus noise, about as hard to compress as a camera picture.
+    """
+    rs = numpy.random.RandomState(seed)
+    y, x = numpy.mgrid[0:height, 0:width]
+    r = (x * 255 / width)
+    g = (y * 255 / height)
+    b = ((x + y) * 255 / (width + height))
+    im = numpy.stack([r, g, b], axis=-1) + rs.normal(0, 18, (height, width, 3))
+    return Image.fromarray(numpy.clip(im, 0, 255).astype(numpy.uint8), 'RGB')
+
+
+def __gif(path, width, height, count):
+    frames = []
+    for i in range(count):
+        im = Image.new('RGB', (width, height), (i * 8 % 256, 64, 128))
+        block = Image.new('RGB', (width // 4, height // 4), (255, 255 - i * 8 % 256, 0))
+        im.paste(block, ((i * 13) % (width - width // 4), (i * 7) % (height - height // 4)))
+        frames.append(im.convert('P', palette=Image.Palette.ADAPTIVE, colors=128))
+    frames[0].save(path, format='GIF', save_all=True, append_images=frames[1:], duration=60, loop=0)
+
+
+def __mp3(path, cover, seconds=30):
+    # silent MPEG-1 layer III frames, 128 kbps 44.1 kHz: 417 bytes each, 38.28 per second
+    frame = b'\xff\xfb\x90\x64' + b'\x00' * 413
+    with open(path, 'wb') as f:
+        f.write(frame * int(seconds * 38.28))
+    tags = ID3()
+    tags.add(APIC(encoding=3, mime='image/jpeg', type=3, desc='', data=cover))
+    tags.save(path)
+
+
+def __mp4(path, width, height, frames):
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'mp4v'), 25, (width, height))
+    try:
+        base = numpy.zeros((height, width, 3), numpy.uint8)
+        base[:, :, 0] = numpy.linspace(0, 255, width, dtype=numpy.uint8)
+        for i in range(frames):
+            frame = base.copy()
+            x = (i * 7) % (width - 200)
+            frame[200:400, x:x + 200] = (0, 255 - i % 256, 255)
+            writer.write(frame)
+    finally:
+        writer.release()
+
+
+def __epub(path, cover):
+    container = (
+        '<?xml version="1.0"?>'
+        '<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">'
+        '<rootfiles><rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/></rootfiles>'
+        '</container>')
+    opf = (
+        '<?xml version="1.0"?>'
+        '<package xmlns="http://www.idpf.org/2007/opf" version="2.0">'
+        '<metadata xmlns:dc="http://purl.org/dc/elements/1.1/" xmlns:opf="http://www.idpf.org/2007/opf">'
+        '<dc:title>Benchmark</dc:title><meta name="cover" content="cover-image"/></metadata>'
+        '<manifest><item id="cover-image" href="images/cover.jpg" media-type="image/jpeg"/>'
+        '<item id="c1" href="text/c1.xhtml" media-type="application/xhtml+xml"/></manifest>'
+        '<spine><itemref idref="c1"/></spine></package>')
+    with zipfile.ZipFile(path, 'w') as z:
+        z.writestr('mimetype', 'application/epub+zip', compress_type=zipfile.ZIP_STORED)
+        z.writestr('META-INF/container.xml', container, compress_type=zipfile.ZIP_DEFLATED)
+        z.writestr('OEBPS/content.opf', opf, compress_type=zipfile.ZIP_DEFLATED)
+        z.writestr('OEBPS/text/c1.xhtml', '<html><body>%s</body></html>' % ('<p>text</p>' * 2000),
+                   compress_type=zipfile.ZIP_DEFLATED)
+        z.writestr('OEBPS/images/cover.jpg', cover, compress_type=zipfile.ZIP_DEFLATED)
+
+
+def __comic(path, pages):
+    with zipfile.ZipFile(path, 'w') as z:
+        for i in range(pages):
+            page = BytesIO()
+            __photo(1600, 2400, seed=100 + i).save(page, format='JPEG', quality=88)
+            # comic archives are usually stored, pages are already compressed
+            z.writestr('page_%03d.jpg' % i, page.getvalue(), compress_type=zipfile.ZIP_STORED)
@@ -0,0 +1,347 @@
+# encoding: utf-8
+"""
+Benchmark runner, from the FileUpDown directory:
+    python -m Benchmark.Run --out before.json                  # Flask test client, one process per case
+    python -m Benchmark.Run --mode server --concurrency 8      # real local server over HTTP
+    python -m Benchmark.Run --mode server --server-command "gunicorn -k gthread --threads 32 -b 127.0.0.1:{port} Benchmark.Server:app"
+    python -m Benchmark.Run --compare before.json after.json   # exit status 1 on a regression
+Every case runs against a fresh store and cache under `--base`/runs/<case>, in its own process,
+so the peak RSS reported is the one of that case alone.
+"""
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import http.client
+import json
+import os
+import platform
+import resource
+import shlex
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import Benchmark
+from Benchmark import Cases
+from Benchmark import Fixtures
+import GlobalConfigContext
+
+__compared = (
+    # metric, True if higher is better
+    ('p50_ms', False),
+    ('p99_ms', False),
+    ('throughput_rps', True),
+    ('peak_rss_kb', False),
+)
+
+
+def main(argv=None):
+    args = __parser().parse_args(argv)
+    if args.compare:
+        return compare(args.compare[0], args.compare[1], args.threshold)
+    if args.child:
+        return __child(args)
+    return run(args)
+
+
+def __parser():
+    parser = argparse.ArgumentParser(description='RGFileServer benchmarks')
+    parser.add_argument('--mode', choices=('client', 'server'), default='client',
+                        help='Flask test client in process, or a real local server over HTTP')
+    parser.add_argument('--server-command', default=None,
+                        help='server mode: command line with a {port} placeholder, default the threaded werkzeug server')
+    parser.add_argument('--cases', default=None, help='comma separated case names, default all')
+    parser.add_argument('--scale', type=float, default=1.0, help='multiplies the iterations of every case')
+    parser.add_argument('--concurrency', type=int, default=1)
+    parser.add_argument('--large-mb', type=int, default=256, help='size of the large download fixture')
+    parser.add_argument('--upload-mb', type=int, default=16, help='size of the uploaded fixture')
+    parser.add_argument('--base', default=os.path.join(tempfile.gettempdir(), 'rg-bench'),
+                        help='fixtures and per case stores, fixtures are reused between runs')
+    parser.add_argument('--out', default=None, help='result JSON, default benchmark-<time>.json')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'), default=None)
+    parser.add_argument('--threshold', type=float, default=0.1, help='relative change reported as a regression')
+    parser.add_argument('--list', action='store_true', help='list the cases and exit')
+    parser.add_argument('--child', default=None, help=argparse.SUPPRESS)
+    return parser
+
+
+def run(args):
+    fixtures = Fixtures.build(os.path.join(args.base, 'fixtures'), large_mb=args.large_mb, upload_mb=args.upload_mb)
+    selected = __select(args, fixtures)
+    if args.list:
+        for case in selected:
+            print('%-24s %5d  %s' % (case.name, case.iterations, case.path))
+        return 0
+
+    results = {}
+    for case in selected:
+        case_base = os.path.join(args.base, 'runs', case.name)
+        shutil.rmtree(case_base, ignore_errors=True)
+        if args.mode == 'client':
+            result = __run_child(args, case)
+        else:
+            result = __run_server(args, case, case_base, fixtures)
+        results[case.name] = result
+        print('%-24s p50 %9.2f ms  p99 %9.2f ms  %9.1f req/s  %8.1f MB/s  rss %8d KB  errors %d' % (
+            case.name, result['p50_ms'], result['p99_ms'], result['throughput_rps'], result['throughput_mb_s'],
+            result['peak_rss_kb'], result['errors']))
+
+    report = {'meta': __meta(args), 'cases': results}
+    out = args.out or 'benchmark-%s.json' % time.strftime('%Y%m%d-%H%M%S')
+    with open(out, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    print('written to %s' % out)
+    return 0
+
+
+def __select(args, fixtures):
+    cases = Cases.cases(fixtures, scale=args.scale)
+    if not args.cases:
+        return cases
+    names = args.cases.split(',')
+    unknown = set(names) - {case.name for case in cases}
+    if unknown:
+        raise SystemExit('unknown cases: %s' % ', '.join(sorted(unknown)))
+    return [case for case in cases if case.name in names]
+
+
+def __run_child(args, case):
+    command = [sys.executable, '-m', 'Benchmark.Run', '--child', case.name,
+               '--base', args.base, '--scale', str(args.scale), '--concurrency', str(args.concurrency),
+               '--large-mb', str(args.large_mb), '--upload-mb', str(args.upload_mb)]
+    process = subprocess.run(command, cwd=GlobalConfigContext.Base_Directory, stdout=subprocess.PIPE, check=True)
+    return json.loads(process.stdout.decode('utf-8').strip().splitlines()[-1])
+
+
+def __child(args):
+    """
+    One case through the Flask test client, the result JSON is the last line of stdout.
+    """
+    Benchmark.configure(os.path.join(args.base, 'runs', args.child))
+    fixtures = Fixtures.build(os.path.join(args.base, 'fixtures'), large_mb=args.large_mb, upload_mb=args.upload_mb)
+    Fixtures.install(fixtures)
+    case = [c for c in Cases.cases(fixtures, scale=args.scale) if c.name == args.child][0]
+
+    from FileUpDownApp import app
+    from Service import TransformExecutor
+    local = threading.local()
+
+    def send(method, url, headers, body):
+        client = getattr(local, 'client', None)
+        if client is None:
+            client = local.client = app.test_client()
+        response = client.open(url, method=method, headers=headers, data=body, buffered=False)
+        size = 0
+        try:
+            for chunk in response.response:
+                size += len(chunk)
+        finally:
+            response.close()
+        return response.status_code, size
+
+    baseline = __hwm_kb(os.getpid())
+    result = __drive(send, case, args.concurrency)
+    TransformExecutor.shutdown()
+    result['baseline_rss_kb'] = baseline
+    result['peak_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # transform pool workers, reaped by the shutdown above
+    result['peak_rss_children_kb'] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    print(json.dumps(result))
+    return 0
+
+
+def __run_server(args, case, case_base, fixtures):
+    Benchmark.configure(case_base)
+    Fixtures.install(fixtures)
+    port = __free_port()
+    env = dict(os.environ, RG_BENCH_BASE=case_base)
+    if args.server_command:
+        command = shlex.split(args.server_command.format(port=port))
+    else:
+        command = [sys.executable, '-m', 'Benchmark.Server', '--base', case_base, '--port', str(port)]
+    server = subprocess.Popen(command, cwd=GlobalConfigContext.Base_Directory, env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        __wait_port(port, server)
+        baseline = __hwm_kb(server.pid)
+
+        def send(method, url, headers, body):
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=300)
+            try:
+                conn.request(method, url, body=body, headers=headers)
+                response = conn.getresponse()
+                size = 0
+                while True:
+                    buf = response.read(256 * 1024)
+                    if not buf:
+                        break
+                    size += len(buf)
+                return response.status, size
+            finally:
+                conn.close()
+
+        result = __drive(send, case, args.concurrency)
+        result['baseline_rss_kb'] = baseline
+        result['peak_rss_kb'] = __hwm_kb(server.pid)
+        result['peak_rss_children_kb'] = sum(__hwm_kb(pid) for pid in __children(server.pid))
+        return result
+    finally:
+        server.terminate()
+        try:
+            server.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            server.kill()
+
+
+def __drive(send, case, concurrency):
+    """
+    Send the warmup requests, then `case.iterations` requests from `concurrency` threads.
+    A request is built before its timer starts, the response body is read to the end before it stops.
+    :return: dict of latency percentiles, throughput and errors
+    """
+    for i in range(case.warmup):
+        send(*case.request(-1 - i))
+
+    lock = threading.Lock()
+    latencies = []
+    statuses = {}
+    total = [0]
+
+    def one(i):
+        request = case.request(i)
+        start = time.perf_counter()
+        status, size = send(*request)
+        elapsed = time.perf_counter() - start
+        with lock:
+            latencies.append(elapsed)
+            statuses[status] = statuses.get(status, 0) + 1
+            total[0] += size
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        list(executor.map(one, range(case.iterations)))
+    wall = time.perf_counter() - started
+
+    latencies.sort()
+    errors = sum(count for status, count in statuses.items() if status not in case.statuses)
+    return {
+        'path': case.path,
+        'requests': len(latencies),
+        'concurrency': concurrency,
+        'errors': errors,
+        'statuses': {str(k): v for k, v in statuses.items()},
+        'p50_ms': __percentile(latencies, 50) * 1000,
+        'p99_ms': __percentile(latencies, 99) * 1000,
+        'mean_ms': sum(latencies) / len(latencies) * 1000,
+        'max_ms': latencies[-1] * 1000,
+        'bytes': total[0],
+        'throughput_rps': len(latencies) / wall,
+        'throughput_mb_s': total[0] / wall / (1024 * 1024),
+    }
+
+
+def __percentile(values, percent):
+    """
+    Nearest rank percentile of sorted `values`.
+    """
+    rank = max(1, int(-(-len(values) * percent // 100)))
+    return values[min(rank, len(values)) - 1]
+
+
+def __hwm_kb(pid):
+    """
+    :return: peak resident set size of `pid` in KB (VmHWM), 0 if unknown
+    """
+    try:
+        with open('/proc/%d/status' % pid) as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    if pid == os.getpid():
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return 0
+
+
+def __children(pid):
+    try:
+        with open('/proc/%d/task/%d/children' % (pid, pid)) as f:
+            return [int(p) for p in f.read().split()]
+    except OSError:
+        return []
+
+
+def __free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def __wait_port(port, server, timeout=60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError('benchmark server exited with %s' % server.returncode)
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError('benchmark server did not start on port %d' % port)
+
+
+def __meta(args):
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=GlobalConfigContext.Base_Directory,
+                                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout.decode().strip()
+    except OSError:
+        commit = None
+    return {
+        'commit': commit or None,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'mode': args.mode,
+        'server_command': args.server_command,
+        'scale': args.scale,
+        'concurrency': args.concurrency,
+        'large_mb': args.large_mb,
+        'upload_mb': args.upload_mb,
+        'transform_workers': GlobalConfigContext.Transform_Workers,
+    }
+
+
+def compare(before_path, after_path, threshold=0.1):
+    """
+    Print the change of every compared metric between two result files.
+    :return: 1 if a metric got worse by more than `threshold`, else 0
+    """
+    with open(before_path) as f:
+        before = json.load(f)
+    with open(after_path) as f:
+        after = json.load(f)
+    print('before: %s  after: %s' % (before['meta'].get('commit'), after['meta'].get('commit')))
+    regressions = 0
+    for name in sorted(set(before['cases']) & set(after['cases'])):
+        old, new = before['cases'][name], after['cases'][name]
+        cells = []
+        for metric, higher_better in __compared:
+            if not old.get(metric) or metric not in new:
+                continue
+            change = (new[metric] - old[metric]) / old[metric]
+            worse = change < -threshold if higher_better else change > threshold
+            regressions += worse
+            cells.append('%s %+.1f%%%s' % (metric, change * 100, ' REGRESSION' if worse else ''))
+        print('%-24s %s' % (name, '  '.join(cells)))
+    for name in sorted(set(before['cases']) ^ set(after['cases'])):
+        print('%-24s only in %s' % (name, 'before' if name in before['cases'] else 'after'))
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
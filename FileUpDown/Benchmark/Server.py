@@ -0,0 +1,22 @@
+# encoding: utf-8
+"""
+FileUpDownApp configured for a benchmark directory, for the real server mode of Benchmark.Run.
+`python -m Benchmark.Server --base DIR --port N` runs the threaded werkzeug server,
+`RG_BENCH_BASE=DIR gunicorn Benchmark.Server:app` any WSGI server.
+"""
+import argparse
+import os
+
+import Benchmark
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='benchmark server')
+    parser.add_argument('--base', required=True)
+    parser.add_argument('--port', type=int, required=True)
+    args = parser.parse_args()
+    Benchmark.configure(args.base)
+    from FileUpDownApp import app
+    app.run(host='127.0.0.1', port=args.port, threaded=True, use_reloader=False)
+else:
+    Benchmark.configure(os.environ['RG_BENCH_BASE'])
+    from FileUpDownApp import app
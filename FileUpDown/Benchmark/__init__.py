@@ -0,0 +1,28 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+This package measures the upload, download, range, transform and in-archive hot paths.
+Run it from the FileUpDown directory: `python -m Benchmark.Run --help`.
+"""
+import os
+
+import GlobalConfigContext
+
+
+def configure(base):
+    """
+    Point every directory and database of GlobalConfigContext into `base`, before FileUpDownApp is imported,
+    so a run never touches the real store and each case starts from a cold cache.
+    """
+    GlobalConfigContext.FileStore_Directory = os.path.join(base, 'stores')
+    GlobalConfigContext.FileCache_Directory = os.path.join(base, 'cache')
+    GlobalConfigContext.FileImport_Directory = os.path.join(base, 'import')
+    GlobalConfigContext.FileBlob_Directory = os.path.join(base, 'stores', '.blobs')
+    GlobalConfigContext.FileMeta_Database = os.path.join(base, 'meta.sqlite3')
+    GlobalConfigContext.FileCache_Database = os.path.join(base, 'cache.sqlite3')
+    # background work would blur the numbers of the request being measured
+    GlobalConfigContext.Pregenerate_Enabled = False
+    GlobalConfigContext.Store_Migrate_On_Start = False
+    for directory in (GlobalConfigContext.FileStore_Directory, GlobalConfigContext.FileCache_Directory,
+                      GlobalConfigContext.FileImport_Directory):
+        os.makedirs(directory, exist_ok=True)
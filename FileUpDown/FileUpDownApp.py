@@ -7,18 +7,29 @@ the environment and set up essential connection for other part of sub system.
 Actually, it launches as a Flask application, for web service request handing.
 """
 import logging
+import multiprocessing
 import os
 
 from flask import Flask
 # from werkzeug.contrib.fixers import ProxyFix
 
 import GlobalConfigContext
-from Gateway import FileGateway
+from Gateway import FileGateway, MetricsGateway
+from Service import CacheManager, Pregenerate, StoreLayout, Reaper
 
 os.makedirs(GlobalConfigContext.FileStore_Directory, exist_ok=True)
+if multiprocessing.parent_process() is None:
+    # not again in each transform pool worker, they import this module too
+    CacheManager.start_rebuild()
+    Pregenerate.start()
+    Reaper.start()
+    if GlobalConfigContext.Store_Migrate_On_Start:
+        StoreLayout.start_migration()
 app = Flask(__name__)
 # app.wsgi_app = ProxyFix(app.wsgi_app)
+app.wsgi_app = MetricsGateway.middleware(app.wsgi_app)
 app.register_blueprint(FileGateway.RestRouter)
+app.register_blueprint(MetricsGateway.MetricsRouter)
 app.config["SECRET_KEY"] = "niang_pa_si"
 
 # handler
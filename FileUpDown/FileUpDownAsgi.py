@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+File UpDown ASGI Entry Point
+Serves the same Flask routes (`FileUpDownApp.app`) from an asyncio server, e.g.
+`uvicorn FileUpDownAsgi:app --workers 4`, so slow clients do not each hold a thread:
+- the Flask handler runs on a bounded thread pool (transforms still go to TransformExecutor),
+- the request body is streamed to it: messages are received on the event loop into a bounded queue
+  while the handler reads them, so an upload is written once and never waits for its whole body,
+- the response body is sent on the event loop, a thread is only borrowed for each chunk read.
+Plain files handed to `wsgi.file_wrapper` are read with `os.pread`, or passed to the server as is
+when it supports the `http.response.zerocopysend` extension.
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import itertools
+import os
+import sys
+from urllib.parse import unquote_to_bytes
+
+from werkzeug.exceptions import ClientDisconnected
+
+import GlobalConfigContext
+from FileUpDownApp import app as flask_app
+from Service import TransformExecutor
+import logging as L
+logging = L.getLogger('file')
+
+__handlers = ThreadPoolExecutor(max_workers=GlobalConfigContext.Asgi_Handler_Threads, thread_name_prefix='asgi-handler')
+__io = ThreadPoolExecutor(max_workers=GlobalConfigContext.Asgi_Io_Threads, thread_name_prefix='asgi-io')
+__end = object()
+
+
+class FileWrapper:
+    """
+    `wsgi.file_wrapper` of this server, recognized in the response and sent from the file descriptor.
+    """
+
+    def __init__(self, filelike, block_size=256 * 1024):
+        self.filelike = filelike
+        self.block_size = block_size
+
+    def __iter__(self):
+        while True:
+            buf = self.filelike.read(self.block_size)
+            if not buf:
+                break
+            yield buf
+
+    def close(self):
+        self.filelike.close()
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'http':
+        await __http(scope, receive, send)
+    elif scope['type'] == 'lifespan':
+        await __lifespan(receive, send)
+
+
+async def __lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, TransformExecutor.shutdown)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def __http(scope, receive, send):
+    loop = asyncio.get_running_loop()
+    body = RequestBody(loop)
+    pump = loop.create_task(body.pump(receive))
+    try:
+        environ = __environ(scope, body)
+        started = {}
+        written = []
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info is not None and started.get('sent'):
+                raise exc_info[1].with_traceback(exc_info[2])
+            started['status'] = int(status.split(' ', 1)[0])
+            started['headers'] = [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in headers]
+            # the legacy write() callable: its data goes out before the iterable, once the handler returned
+            return written.append
+
+        iterable = await loop.run_in_executor(__handlers, flask_app.wsgi_app, environ, start_response)
+    finally:
+        # a body the handler left unread is not received
+        pump.cancel()
+
+    try:
+        if isinstance(iterable, FileWrapper) and not written:
+            await __send_file(loop, scope, send, started, iterable)
+        else:
+            await __send_iterable(loop, send, started, itertools.chain(written, iterable))
+    finally:
+        close = getattr(iterable, 'close', None)
+        if close is not None:
+            await loop.run_in_executor(__io, close)
+
+
+class RequestBody:
+    """
+    `wsgi.input` of this server, read by the handler thread while `pump` receives the body on the event loop.
+    At most `Asgi_Body_Queue` messages wait in between, a client sending faster than the handler reads waits.
+    A client gone before the end of the body raises werkzeug's ClientDisconnected (400) in the handler.
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.queue = asyncio.Queue(maxsize=GlobalConfigContext.Asgi_Body_Queue)
+        self.buffer = bytearray()
+        self.done = False
+
+    async def pump(self, receive):
+        try:
+            while True:
+                message = await receive()
+                await self.queue.put(message)
+                if message['type'] != 'http.request' or not message.get('more_body', False):
+                    return
+        except Exception as ex:
+            logging.error(ex, exc_info=True)
+            await self.queue.put({'type': 'http.disconnect'})
+
+    def __receive(self):
+        """
+        Wait for the next body message, on the handler thread.
+        """
+        message = asyncio.run_coroutine_threadsafe(self.queue.get(), self.loop).result()
+        if message['type'] != 'http.request':
+            self.done = True
+            raise ClientDisconnected()
+        self.done = not message.get('more_body', False)
+        self.buffer += message.get('body', b'')
+
+    def read(self, size=-1):
+        while not self.done and (size is None or size < 0 or len(self.buffer) < size):
+            self.__receive()
+        if size is None or size < 0:
+            size = len(self.buffer)
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    def readline(self, size=-1):
+        while not self.done and b'\n' not in self.buffer and (size is None or size < 0 or len(self.buffer) < size):
+            self.__receive()
+        end = self.buffer.find(b'\n') + 1 or len(self.buffer)
+        if size is not None and 0 <= size < end:
+            end = size
+        return self.read(end)
+
+    def readlines(self, hint=-1):
+        return list(self)
+
+    def __iter__(self):
+        while True:
+            line = self.readline()
+            if not line:
+                return
+            yield line
+
+
+def __environ(scope, body):
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    root_path = scope.get('root_path', '').encode('utf-8').decode('latin-1')
+    raw_path = scope.get('raw_path')
+    if raw_path is not None:
+        path = unquote_to_bytes(raw_path.split(b'?', 1)[0]).decode('latin-1')
+    else:
+        path = scope['path'].encode('utf-8').decode('latin-1')
+    if root_path and path.startswith(root_path):
+        path = path[len(root_path):]
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': root_path,
+        'PATH_INFO': path,
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'REMOTE_ADDR': client[0],
+        'REMOTE_PORT': str(client[1]),
+        'SERVER_PROTOCOL': 'HTTP/%s' % scope.get('http_version', '1.1'),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+        'wsgi.file_wrapper': FileWrapper,
+    }
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name == 'CONTENT_TYPE' or name == 'CONTENT_LENGTH':
+            key = name
+        else:
+            key = 'HTTP_' + name
+        if key in environ:
+            environ[key] += (';' if key == 'HTTP_COOKIE' else ',') + value
+        else:
+            environ[key] = value
+    # the body ends with its last message, chunked or not: werkzeug reads it without Content-Length
+    # (and still enforces MAX_CONTENT_LENGTH)
+    environ['wsgi.input_terminated'] = True
+    return environ
+
+
+def __content_length(headers):
+    for name, value in headers:
+        if name == b'content-length':
+            return int(value)
+    return None
+
+
+async def __send_iterable(loop, send, started, iterable):
+    iterator = iter(iterable)
+    # the first chunk is read before the headers go out, so an error still becomes a 500
+    chunk = await loop.run_in_executor(__io, next, iterator, __end)
+    await send({'type': 'http.response.start', 'status': started['status'], 'headers': started['headers']})
+    started['sent'] = True
+    while chunk is not __end:
+        if chunk:
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        chunk = await loop.run_in_executor(__io, next, iterator, __end)
+    await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+
+
+async def __send_file(loop, scope, send, started, wrapper):
+    fd = wrapper.filelike
+    offset = fd.tell()
+    count = __content_length(started['headers'])
+    if count is None:
+        count = os.fstat(fd.fileno()).st_size - offset
+    await send({'type': 'http.response.start', 'status': started['status'], 'headers': started['headers']})
+    started['sent'] = True
+
+    if 'http.response.zerocopysend' in scope.get('extensions', {}):
+        await send({'type': 'http.response.zerocopysend', 'file': fd, 'offset': offset, 'count': count, 'more_body': False})
+        # leave the file where the body ended, as `socket.sendfile` does (the metrics count sent bytes from it)
+        fd.seek(offset + count)
+        return
+
+    fileno = fd.fileno()
+    while count > 0:
+        buf = await loop.run_in_executor(__io, os.pread, fileno, min(wrapper.block_size, count), offset)
+        if not buf:
+            break
+        offset += len(buf)
+        count -= len(buf)
+        await send({'type': 'http.response.body', 'body': buf, 'more_body': True})
+    fd.seek(offset)
+    if count > 0:
+        logging.error('file ended %d bytes before Content-Length', count)
+    await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
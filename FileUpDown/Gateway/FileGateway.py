@@ -1,14 +1,42 @@
 #!/usr/bin/env python
 # encoding: utf-8
 
-from flask import Blueprint, abort, request, jsonify
+import json
+
+from flask import Blueprint, Response, abort, request, jsonify
 
 import Gateway
-from Service import FileService, RangeResponse
+import GlobalConfigContext
+from Service import FileService, RangeResponse, CacheManager, TransformExecutor, Pregenerate, ChunkUpload, BlobStore, Derivative, \
+    StoreLayout
 
 RestRouter = Blueprint('FileGateway', __name__, url_prefix='/file/')
 
 
+@RestRouter.errorhandler(TransformExecutor.Busy)
+def handle_transform_busy(ex):
+    """
+    The transform pool is saturated: ask the client to come back instead of queueing without bound.
+    """
+    response = Response('transform pool is busy', status=503)
+    response.headers['Retry-After'] = str(ex.retry_after)
+    return response
+
+
+@RestRouter.errorhandler(StoreLayout.InvalidName)
+def handle_invalid_name(ex):
+    response = jsonify({'err_msg': str(ex)})
+    response.status_code = 400
+    return response
+
+
+@RestRouter.errorhandler(ChunkUpload.UploadError)
+def handle_chunk_upload_error(ex):
+    response = jsonify({'err_msg': str(ex)})
+    response.status_code = ex.status
+    return response
+
+
 @RestRouter.route('/upload/', methods=['POST'])
 def handle_upload_file():
     """
@@ -59,6 +87,59 @@ def __wrapper_res(name, file_path, mime, exif, size, md5, err_msg, flag, key):
     }
 
 
+@RestRouter.route('/upload/chunked/', methods=['POST'])
+def chunked_upload_init():
+    """
+    Start a resumable upload, then PUT its parts, see ChunkUpload.
+    params: filename, size (optional total bytes), part_size (optional), mime (optional)
+    :return: {'upload_id', 'filename', 'size', 'part_size', 'parts', 'missing'}
+    """
+    filename = FileService.get_request_param('filename')
+    size = FileService.get_request_param('size', is_number=True)
+    part_size = FileService.get_request_param('part_size', is_number=True)
+    mime = FileService.get_request_param('mime')
+    return jsonify(ChunkUpload.init(filename=filename,
+                                    size=int(size) if size is not None else None,
+                                    part_size=int(part_size) if part_size is not None else None,
+                                    mimetype=mime))
+
+
+@RestRouter.route('/upload/chunked/<upload_id>/<int:part>', methods=['PUT'])
+def chunked_upload_part(upload_id, part):
+    """
+    Body: the raw bytes of part `part`, starting at part * part_size. Parts may be sent in parallel.
+    params: hash (optional), the part is refused if its hash differs
+    :return: {'part', 'size', 'hash'}
+    """
+    expected_hash = request.args.get('hash')
+    return jsonify(ChunkUpload.put_part(upload_id, part, request.stream, expected_hash=expected_hash))
+
+
+@RestRouter.route('/upload/chunked/<upload_id>', methods=['GET'])
+def chunked_upload_status(upload_id):
+    """
+    Parts received so far, to resume after a dropped connection.
+    """
+    return jsonify(ChunkUpload.status(upload_id))
+
+
+@RestRouter.route('/upload/chunked/<upload_id>/complete', methods=['POST'])
+def chunked_upload_complete(upload_id):
+    """
+    Assemble the parts and store the file.
+    :return: the same item as one element of /upload/
+    """
+    filename = ChunkUpload.status(upload_id)['filename']
+    flag, message, path, mime, exif, size, md5 = ChunkUpload.complete(upload_id)
+    return jsonify(__wrapper_res(filename, path, mime, exif, size, md5, message, flag, upload_id))
+
+
+@RestRouter.route('/upload/chunked/<upload_id>', methods=['DELETE'])
+def chunked_upload_abort(upload_id):
+    ChunkUpload.abort(upload_id)
+    return jsonify({'upload_id': upload_id, 'result': True})
+
+
 @RestRouter.route('/download/<path:filename>', methods=['GET'])
 def handle_download_file(filename):
     """
@@ -105,29 +186,169 @@ def __actual_handle_download(filename, flag, location, sub_path):
         return RangeResponse.partial_response(request=request, path=location, sub_path=sub_path, filename=filename)
 
 
+@RestRouter.route('/archive', methods=['GET', 'POST'])
+def download_archive():
+    """
+    Many stored files as one ZIP, streamed while it is built.
+    params (json or query): names (a list, `names=a&names=b` in a query), filename (default 'archive.zip'),
+    side, sf, quality, size (derivatives of images, as for /download/), compress (default true)
+    """
+    names = __request_names()
+    filename = FileService.get_request_param('filename') or 'archive.zip'
+    side = int(FileService.get_request_param('side', 0, is_number=True))
+    sf = min(4, max(1, int(FileService.get_request_param('sf', 1, is_number=True))))
+    max_size = int(FileService.get_request_param('size', 0, is_number=True))
+    quality = FileService.get_request_param('quality')
+    if isinstance(quality, str) and quality.isdigit():
+        quality = int(quality)
+    compress = FileService.get_request_param('compress', True)
+    if isinstance(compress, str):
+        compress = compress.lower() not in ('0', 'false', 'no')
+    return RangeResponse.archive_response(names=names, filename=filename,
+                                          side=side * sf if side else None, quality=quality or None,
+                                          max_size=max_size or None, compress=bool(compress))
+
+
+@RestRouter.route('/covers', methods=['GET', 'POST'])
+def download_covers():
+    """
+    Covers of many stored files (thumbnails of images) in one multipart/mixed response, see RangeResponse.covers_response.
+    params (json or query): names (a list, `names=a&names=b` in a query),
+    side, sf, quality, size, format (as for /download/?cover=1)
+    """
+    names = __request_names()
+    side = int(FileService.get_request_param('side', 0, is_number=True))
+    sf = min(4, max(1, int(FileService.get_request_param('sf', 1, is_number=True))))
+    max_size = int(FileService.get_request_param('size', 0, is_number=True))
+    quality = FileService.get_request_param('quality')
+    if isinstance(quality, str) and quality.isdigit():
+        quality = int(quality)
+    image_format, vary_accept = Derivative.output_format(FileService.get_request_param('format'),
+                                                         request.accept_mimetypes)
+    response = RangeResponse.covers_response(names=names, side=side or None, sf=sf, quality=quality or None,
+                                             max_size=max_size or None, image_format=image_format)
+    if vary_accept:
+        response.vary.add('Accept')
+    return response
+
+
+def __request_names():
+    """
+    :return: the stored names of a batch request, json `names` or the query `names=a&names=b`, 400 for any that
+             is not a plain stored name (see StoreLayout.check_name), 404 for none
+    """
+    args = request.get_json(silent=True) or {}
+    names = args.get('names') or request.args.getlist('names')
+    if not names:
+        abort(404)
+    if not isinstance(names, list):
+        raise StoreLayout.InvalidName('names is not a list')
+    for name in names:
+        StoreLayout.check_name(name)
+    return names
+
+
 @RestRouter.route('/del', methods=['POST'])
 def file_del():
+    """
+    Delete stored files and their derivatives, on a thread pool.
+    json: {'names': [...], 'defer': remove cache directories in the background, 'stream': NDJSON}
+    :return: [{'name', 'result'}, ...] in the order of names,
+             or with `stream` (or Accept: application/x-ndjson) one such line per name as soon as it is done
+    """
     args = request.json
     names = args.get('names')
-
-    results = []
     for name in names:
-        result = FileService.perform_del(name)
-        results.append({
-            'name': name,
+        StoreLayout.check_name(name)
+    defer = bool(args.get('defer', GlobalConfigContext.Cache_Reap_Deferred))
+
+    def item(index, result):
+        return {
+            'name': names[index],
             'result': result
-        })
-    return jsonify(results)
+        }
+    return __batch_response(FileService.perform_del_batch(names, defer=defer), item, len(names))
 
 
 @RestRouter.route('/info', methods=['GET'])
 def file_info():
+    """
+    json: {'names': [...], 'stream': NDJSON}
+    :return: same items as /upload/, in the order of names,
+             or with `stream` (or Accept: application/x-ndjson) one line per name as soon as it is known
+    """
     args = request.json
     names = args.get('names')
-
-    results = []
     for name in names:
-        flag, message, path, mime, exif, size, md5 = FileService.perform_info(name)
-        info = __wrapper_res(name, path, mime, exif, size, md5, message, flag, 'file')
-        results.append(info)
-    return jsonify(results)
+        StoreLayout.check_name(name)
+
+    def item(index, result):
+        flag, message, name, mime, exif, size, md5 = result
+        return __wrapper_res(name, name, mime, exif, size, md5, message, flag, 'file')
+    return __batch_response(FileService.iter_info_batch(names), item, len(names))
+
+
+def __batch_response(results, item, count):
+    """
+    :param results: generator of <index, result> in completion order
+    :param item: `item(index, result)` -> JSON object of one result
+    """
+    if __wants_ndjson():
+        def lines():
+            try:
+                for index, result in results:
+                    yield json.dumps(item(index, result), default=str) + '\n'
+            finally:
+                results.close()
+        return Response(lines(), mimetype='application/x-ndjson')
+    items = [None] * count
+    for index, result in results:
+        items[index] = item(index, result)
+    return jsonify(items)
+
+
+def __wants_ndjson():
+    args = request.get_json(silent=True) or {}
+    if args.get('stream') or request.args.get('stream'):
+        return True
+    return request.accept_mimetypes.best_match(['application/json', 'application/x-ndjson']) == 'application/x-ndjson'
+
+
+@RestRouter.route('/derivatives/<path:name>', methods=['GET'])
+def derivatives_progress(name):
+    """
+    Progress of the derivative pre-generation of a stored file.
+    :return: {'name', 'state': pending|running|done|failed, 'total', 'finished', 'attempts', 'error', 'updated'}
+    """
+    progress = Pregenerate.progress(name)
+    if progress is None:
+        abort(404)
+    return jsonify(progress)
+
+
+@RestRouter.route('/derivatives/<path:name>', methods=['POST'])
+def derivatives_enqueue(name):
+    """
+    (Re)queue the derivative pre-generation of a stored file, e.g. one uploaded before it existed.
+    """
+    flag, location, sub_path = FileService.perform_download(name)
+    if flag is False or sub_path:
+        abort(404)
+    Pregenerate.enqueue(name)
+    return jsonify(Pregenerate.progress(name))
+
+
+@RestRouter.route('/cache/stats', methods=['GET'])
+def cache_stats():
+    """
+    Derivative cache counters: hits, misses, stores, evictions, bytes in use.
+    """
+    return jsonify(CacheManager.stats())
+
+
+@RestRouter.route('/dedup/stats', methods=['GET'])
+def dedup_stats():
+    """
+    Content deduplication counters: uploads, duplicates, saved_bytes, dedupe_rate.
+    """
+    return jsonify(BlobStore.stats())
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+/metrics for Prometheus, and the request hooks feeding Service.Metrics for every route of the application.
+A request is measured by `middleware` around the WSGI application until the server closes its response body,
+so streamed downloads count their whole transfer: body bytes are counted as they are read and sent, not as declared.
+The largest peak RSS of the transforms a request waited for (see Service.Governor) is sent in `X-Transform-Peak-RSS`,
+transforms run while a body streams (ZIP exports) come too late for the header and only show in the histograms.
+"""
+import time
+
+from flask import Blueprint, Response, request
+from werkzeug.wsgi import ClosingIterator
+
+from Service import Governor
+from Service import Metrics
+
+MetricsRouter = Blueprint('MetricsGateway', __name__)
+
+
+@MetricsRouter.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(Metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+def middleware(wsgi_app):
+    """
+    Wrap `wsgi_app` (the Flask `app.wsgi_app`): the in-flight gauge, the duration and the byte counters
+    of a request are settled once the server closes the body, or at once when the application raises.
+    """
+    def measured(environ, start_response):
+        if not Metrics.enabled():
+            return wsgi_app(environ, start_response)
+        state = {
+            'start': time.perf_counter(),
+            'route': 'unmatched',
+            'method': environ.get('REQUEST_METHOD', ''),
+            'status': 500,
+            'streamed': False,
+            'received': 0,
+            'sent': 0,
+            'finished': False,
+        }
+        environ['rg.metrics'] = state
+        if environ.get('wsgi.input') is not None:
+            environ['wsgi.input'] = __CountedInput(environ['wsgi.input'], state)
+        Metrics.inc('rg_http_requests_in_flight')
+        try:
+            body = wsgi_app(environ, start_response)
+        except BaseException:
+            __finish(state)
+            raise
+        try:
+            return __counted(body, environ, state)
+        except BaseException:
+            __finish(state)
+            raise
+
+    return measured
+
+
+@MetricsRouter.before_app_request
+def __request_started():
+    Governor.begin()
+
+
+@MetricsRouter.after_app_request
+def __request_finished(response):
+    peak = Governor.end()
+    if peak is not None:
+        response.headers['X-Transform-Peak-RSS'] = peak
+    state = request.environ.get('rg.metrics')
+    if state is None:
+        return response
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    if peak is not None:
+        Metrics.observe('rg_http_request_peak_rss_bytes', peak, route=route)
+    state['route'] = route
+    state['status'] = response.status_code
+    if response.is_streamed and not state['streamed']:
+        state['streamed'] = True
+        Metrics.inc('rg_http_streams_in_flight', route=route)
+    return response
+
+
+def __finish(state):
+    """
+    Settle the measures of a request, once.
+    """
+    if state['finished']:
+        return
+    state['finished'] = True
+    route = state['route']
+    Metrics.inc('rg_http_requests_total', route=route, method=state['method'], status=state['status'])
+    Metrics.observe('rg_http_request_duration_seconds', time.perf_counter() - state['start'], route=route)
+    Metrics.inc('rg_http_received_bytes_total', state['received'], route=route)
+    Metrics.inc('rg_http_sent_bytes_total', state['sent'], route=route)
+    Metrics.inc('rg_http_requests_in_flight', -1)
+    if state['streamed']:
+        Metrics.inc('rg_http_streams_in_flight', -1, route=route)
+
+
+def __counted(body, environ, state):
+    """
+    Count the bytes of `body` as the server takes them and settle the request when it closes `body`.
+    A `wsgi.file_wrapper` body keeps its type (the server only uses sendfile on its own wrapper class),
+    its bytes are how far the file position moved, which both reading and `socket.sendfile` advance.
+    """
+    close = getattr(body, 'close', None)
+
+    def close_body():
+        try:
+            if close is not None:
+                close()
+        finally:
+            __finish(state)
+
+    wrapper = environ.get('wsgi.file_wrapper')
+    filelike = getattr(body, 'filelike', None)
+    if isinstance(wrapper, type) and isinstance(body, wrapper) and filelike is not None:
+        start = filelike.tell()
+
+        def close_file():
+            try:
+                state['sent'] = max(0, filelike.tell() - start)
+            except (OSError, ValueError):
+                pass
+            close_body()
+
+        try:
+            body.close = close_file
+            return body
+        except AttributeError:
+            pass
+    return ClosingIterator(__count_chunks(body, state), close_body)
+
+
+def __count_chunks(body, state):
+    for chunk in body:
+        state['sent'] += len(chunk)
+        yield chunk
+
+
+class __CountedInput:
+    """
+    `wsgi.input` counting the request body bytes the application reads.
+    """
+
+    def __init__(self, stream, state):
+        self.stream = stream
+        self.state = state
+
+    def read(self, *args):
+        data = self.stream.read(*args)
+        self.state['received'] += len(data)
+        return data
+
+    def readinto(self, b):
+        size = self.stream.readinto(b)
+        if size:
+            self.state['received'] += size
+        return size
+
+    def readline(self, *args):
+        line = self.stream.readline(*args)
+        self.state['received'] += len(line)
+        return line
+
+    def readlines(self, *args):
+        lines = self.stream.readlines(*args)
+        self.state['received'] += sum(len(line) for line in lines)
+        return lines
+
+    def __iter__(self):
+        for line in self.stream:
+            self.state['received'] += len(line)
+            yield line
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
@@ -9,3 +9,101 @@ Base_Directory = os.path.dirname(__file__)
 FileStore_Directory = os.path.join(Base_Directory, 'stores')
 FileCache_Directory = os.path.join(Base_Directory, 'cache')
 FileImport_Directory = os.path.join(Base_Directory, 'import')
+FileBlob_Directory = os.path.join(FileStore_Directory, '.blobs')
+FileMeta_Database = os.path.join(Base_Directory, 'meta.sqlite3')
+FileCache_Database = os.path.join(Base_Directory, 'cache.sqlite3')
+
+# layout: new files and cache directories go to two levels of md5(name) hex prefix (see Service.StoreLayout)
+Store_Sharded = True
+# layout: move flat entries into their shard in the background at start, pausing this long every 100 moves
+Store_Migrate_On_Start = False
+Store_Migrate_Pause = 0.05
+# upload: digest algorithm, see Service.Digest.hash_support ('md5' keeps old clients compatible, 'blake2b' is faster)
+Upload_Hash_Algorithm = 'md5'
+# upload: leading bytes kept in memory while writing, used for MIME sniffing and EXIF parsing
+Upload_Header_Size = 256 * 1024
+# upload: store identical bytes once, names become hard links of a blob in FileBlob_Directory (see Service.BlobStore)
+Dedup_Enabled = False
+# chunked upload: default, smallest and largest part size, and seconds before an idle upload is removed
+Chunk_Upload_Part_Size = 8 * 1024 * 1024
+Chunk_Upload_Min_Part_Size = 64 * 1024
+Chunk_Upload_Max_Part_Size = 512 * 1024 * 1024
+Chunk_Upload_Expire = 24 * 3600
+# batch delete/info: threads doing the file system work of all batch requests
+Batch_Workers = 16
+# covers: threads waiting for the cover builds of all /covers requests, apart from Batch_Workers
+Cover_Workers = 8
+# delete: leave cache directories to the background reaper by default (a request may still ask with `defer`)
+Cache_Reap_Deferred = False
+# download: send plain files through the server's `wsgi.file_wrapper` (sendfile) when it provides one
+Response_Use_File_Wrapper = True
+# cache: byte budget of FileCache_Directory, least recently used derivatives are evicted down to the low water mark
+FileCache_Max_Bytes = 10 * 1024 * 1024 * 1024
+FileCache_Low_Water = 0.9
+# cache: seconds between two last access updates of the same entry
+FileCache_Touch_Interval = 60
+# transform: process pool running image/GIF/video derivative work, 0 workers runs it inline on the request thread
+Transform_Workers = os.cpu_count() or 1
+# transform: jobs allowed to wait for a worker, more are refused with 503 + Retry-After (seconds)
+Transform_Queue_Depth = 2 * Transform_Workers
+Transform_Retry_After = 2
+# transform: Retry-After waits of a response already streaming (ZIP export, covers) for a busy pool, then a ZIP entry
+# gets the original and a cover part is a 503
+Transform_Stream_Retries = 5
+# transform: seconds a request waits for its job
+Transform_Timeout = 120
+Transform_Start_Method = 'spawn'
+# transform: address space (bytes) each pool worker may map, None for no limit
+# (OpenCV and numpy reserve far more address space than they touch, leave room when setting it)
+Transform_Worker_Memory_Limit = None
+# governor: images past this many pixels are not decoded, thumbnails of them serve the original
+Image_Max_Pixels = 100 * 1000 * 1000
+# governor: GIFs past this many frames are not resized, a still of their first frame is served instead
+Image_Max_Frames = 1000
+# animated GIF thumbnails: 'pillow' resizes the frames in the transform pool, 'gifsicle' runs gifsicle per variant
+Gif_Engine = 'pillow'
+# animated GIF thumbnails (pillow engine): 'fast', 'balanced' or 'small' output, quality=low always gets 'small'
+Gif_Mode = 'balanced'
+# animated GIF thumbnails (pillow engine): clients negotiating WebP or AVIF get an animated WebP
+Gif_Animated_WebP = True
+# governor: address space (bytes) and CPU time (seconds) of transform subprocesses (gifsicle), None for no limit
+Subprocess_Memory_Limit = 1024 * 1024 * 1024
+Subprocess_CPU_Limit = 60
+# asgi serving (FileUpDownAsgi): handler threads, threads borrowed per response chunk read,
+# and request body messages received ahead of the handler reading them
+Asgi_Handler_Threads = 64
+Asgi_Io_Threads = 16
+Asgi_Body_Queue = 16
+# MIME of files sniffed by libmagic, memoized by path and mtime
+Mime_Cache_Size = 4096
+# metrics: request, stage and cache counters served at /metrics in the Prometheus text format
+Metrics_Enabled = True
+# archives (zip, epub) kept open with their member index, least recently used closed first
+Archive_Index_Size = 32
+# image derivatives: formats offered to clients listing them in Accept, best first (AVIF needs a Pillow that writes it)
+Image_Negotiate_Formats = ['AVIF', 'WEBP']
+# image thumbnails: built from a cached thumbnail of the same image at least this many times larger, at the same
+# quality or better, instead of the original (0 disables)
+Image_Derive_Min_Ratio = 2
+# video frame strips (cover with frames=N): default tile side, most frames, and how far ahead (seconds)
+# the next frame is reached by decoding on rather than seeking
+Video_Frame_Side = 240
+Video_Frames_Max = 32
+Video_Grab_Window = 2
+# size-capped images (max_size): stop searching once an encode fills this share of the budget
+Fit_Size_Tolerance = 0.9
+# search the quality on a copy scaled by this factor first (1 disables), for images of at least this many scaled pixels
+Fit_Size_Search_Scale = 0.5
+Fit_Size_Search_Min_Pixels = 512 * 512
+# pregenerate: standard derivatives built in the background after each upload, off by default as it adds the CPU
+# of every side and format to each upload (GIFs included), turn it on where first views matter more
+Pregenerate_Enabled = False
+Pregenerate_Sides = [150, 300, 1080]
+Pregenerate_Quality = 85
+# pregenerate: also build thumbnails in the first negotiable format (what current browsers get), next to the source format
+Pregenerate_Negotiated = True
+Pregenerate_Workers = 1
+# pregenerate: seconds between two polls of the job table when idle, and lease of a running job before another worker retries it
+Pregenerate_Poll_Interval = 5
+Pregenerate_Lease = 600
+Pregenerate_Max_Attempts = 3
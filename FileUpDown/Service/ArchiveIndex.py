@@ -0,0 +1,160 @@
+# encoding: utf-8
+"""
+Process wide cache of opened ZIP/EPUB archives, so browsing the members of one archive
+parses its central directory once instead of on every request.
+Entries are keyed by path and checked against mtime_ns + size on each use, the least recently used
+archive is closed past `GlobalConfigContext.Archive_Index_Size`.
+Besides the member table an entry memoizes the data offset of stored members and values derived
+from the archive (e.g. the EPUB cover member, see `memo`).
+"""
+from collections import OrderedDict
+import os
+import struct
+import threading
+import zipfile
+
+import GlobalConfigContext
+import logging as L
+logging = L.getLogger('file')
+
+__lock = threading.Lock()
+__entries = OrderedDict()
+__local_header = struct.Struct('<4s22xHH')
+
+
+class __Entry:
+
+    def __init__(self, path, stamp):
+        self.path = path
+        self.stamp = stamp
+        self.zip = zipfile.ZipFile(path)
+        self.lock = threading.Lock()
+        self.closed = False
+        self.offsets = {}
+        self.memo = {}
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            # members still being read keep their own reference to the file
+            self.zip.close()
+
+
+def __entry(path):
+    """
+    :return: cached entry of `path`, reopened if the file changed
+    """
+    st = os.stat(path)
+    stamp = (st.st_mtime_ns, st.st_size)
+    with __lock:
+        entry = __entries.get(path)
+        if entry is not None and entry.stamp == stamp:
+            __entries.move_to_end(path)
+            return entry
+    entry = __Entry(path, stamp)
+    with __lock:
+        old = __entries.pop(path, None)
+        __entries[path] = entry
+        closing = [old] if old is not None else []
+        while len(__entries) > max(1, GlobalConfigContext.Archive_Index_Size):
+            closing.append(__entries.popitem(last=False)[1])
+    for old in closing:
+        old.close()
+    return entry
+
+
+def __use(path, action):
+    """
+    Run `action(entry)` holding the entry lock, on an entry that is not closed by an eviction meanwhile.
+    """
+    while True:
+        entry = __entry(path)
+        with entry.lock:
+            if not entry.closed:
+                return action(entry)
+
+
+def __info(entry, name):
+    """
+    :param name: member name, names of legacy archives written in GBK are also matched
+    """
+    try:
+        return entry.zip.getinfo(name)
+    except KeyError:
+        try:
+            legacy = name.encode('gbk').decode('cp437')
+        except UnicodeError:
+            raise KeyError(name)
+        return entry.zip.getinfo(legacy)
+
+
+def member_info(path, name):
+    """
+    :return: ZipInfo of member `name`
+    :raise KeyError: no such member
+    """
+    return __info(__entry(path), name)
+
+
+def open_member(path, name):
+    """
+    Open member `name` for reading.
+    A stored (not compressed) member comes back as the archive file itself and the offset of its data,
+    so it can be seeked and sent like a plain file; any other member as a decompressing stream.
+    :return: <fd, member size, data offset or None>, the caller closes fd
+    :raise KeyError: no such member
+    """
+    entry = __entry(path)
+    info = __info(entry, name)
+    if info.compress_type == zipfile.ZIP_STORED and not info.flag_bits & 0x1:
+        fd = open(path, 'rb')
+        try:
+            offset = __data_offset(entry, info, fd)
+        except Exception:
+            fd.close()
+            raise
+        if offset is not None:
+            return fd, info.file_size, offset
+        fd.close()
+    return __use(path, lambda e: e.zip.open(__info(e, name))), info.file_size, None
+
+
+def read(path, name):
+    """
+    :return: bytes of member `name`
+    """
+    fd = __use(path, lambda e: e.zip.open(__info(e, name)))
+    with fd:
+        return fd.read()
+
+
+def memo(path, key, compute):
+    """
+    :param compute: `compute(zip_file)`, called once per archive version
+    :return: value of `key` memoized for the archive at `path`
+    """
+    def action(entry):
+        if key not in entry.memo:
+            entry.memo[key] = compute(entry.zip)
+        return entry.memo[key]
+    return __use(path, action)
+
+
+def __data_offset(entry, info, fd):
+    """
+    The local header may carry a different extra field than the central directory, read its lengths.
+    """
+    offset = entry.offsets.get(info.filename)
+    if offset is not None:
+        return offset
+    fd.seek(info.header_offset)
+    header = fd.read(__local_header.size)
+    if len(header) != __local_header.size:
+        return None
+    signature, name_length, extra_length = __local_header.unpack(header)
+    if signature != b'PK\x03\x04':
+        logging.error('bad local header of %s in %s', info.filename, entry.path)
+        return None
+    offset = info.header_offset + __local_header.size + name_length + extra_length
+    entry.offsets[info.filename] = offset
+    return offset
@@ -0,0 +1,151 @@
+# encoding: utf-8
+"""
+Content addressed storage, enabled by `GlobalConfigContext.Dedup_Enabled`.
+The bytes of an upload are kept once as a blob `{FileBlob_Directory}/{algorithm}/{hh}/{hash}`,
+every stored name is a hard link to it, so a duplicate upload costs no extra bytes and the link count
+of the blob is the reference count. The derivative cache directory of each name is a symlink
+to one directory per content, so thumbnails are built once for all the names of the same bytes.
+"""
+from contextlib import contextmanager
+import fcntl
+import filecmp
+import os
+import shutil
+import sqlite3
+
+import GlobalConfigContext
+from Service import Database
+import logging as L
+logging = L.getLogger('file')
+
+__counters = ('uploads', 'duplicates', 'saved_bytes')
+# the hash alone can be forged for these, duplicates are compared byte by byte
+__weak_algorithms = {'md5', 'sha1'}
+
+
+def __connection():
+    return Database.connection(GlobalConfigContext.FileMeta_Database, init=__init_schema)
+
+
+def __init_schema(conn):
+    conn.execute('CREATE TABLE IF NOT EXISTS blob_counter (key TEXT PRIMARY KEY, value INTEGER)')
+    conn.executemany('INSERT OR IGNORE INTO blob_counter (key, value) VALUES (?, 0)', [(k,) for k in __counters])
+
+
+def enabled():
+    return GlobalConfigContext.Dedup_Enabled
+
+
+def blob_path(file_hash, algorithm):
+    return os.path.join(GlobalConfigContext.FileBlob_Directory, algorithm, file_hash[:2], file_hash)
+
+
+def shared_cache_dir(file_hash, algorithm):
+    return os.path.join(GlobalConfigContext.FileCache_Directory, '.shared', algorithm, file_hash)
+
+
+@contextmanager
+def __locked():
+    """
+    Serializes link count decisions between uploads and deletes, across threads and processes.
+    """
+    os.makedirs(GlobalConfigContext.FileBlob_Directory, exist_ok=True)
+    with open(os.path.join(GlobalConfigContext.FileBlob_Directory, '.lock'), 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def store(staging_path, upload_path, file_hash, algorithm):
+    """
+    Put a fully written upload at `upload_path`, as a new link of its blob.
+    :return: True if the same bytes were already stored, `staging_path` is then removed
+    """
+    blob = blob_path(file_hash, algorithm)
+    os.makedirs(os.path.dirname(blob), exist_ok=True)
+    with __locked():
+        if os.path.exists(blob) and __same(blob, staging_path, algorithm):
+            os.link(blob, upload_path)
+            os.remove(staging_path)
+            __count(duplicates=1, saved_bytes=os.path.getsize(blob), uploads=1)
+            return True
+        os.rename(staging_path, upload_path)
+        if os.path.exists(blob):
+            # a forged hash collision keeps its own file, without a blob
+            logging.error('hash collision on %s', blob)
+        else:
+            os.link(upload_path, blob)
+        __count(uploads=1)
+        return False
+
+
+def __same(blob, path, algorithm):
+    if os.path.getsize(blob) != os.path.getsize(path):
+        return False
+    if algorithm in __weak_algorithms:
+        return filecmp.cmp(blob, path, shallow=False)
+    return True
+
+
+def link_cache_dir(cache_dir, path, file_hash, algorithm):
+    """
+    Make the per-name cache directory `cache_dir` of the stored `path` point to the directory shared by the content,
+    unless `path` is not a link of the blob (a hash collision).
+    """
+    try:
+        if not os.path.samefile(path, blob_path(file_hash, algorithm)):
+            return
+    except FileNotFoundError:
+        return
+    shared = shared_cache_dir(file_hash, algorithm)
+    os.makedirs(shared, exist_ok=True)
+    if os.path.islink(cache_dir):
+        os.unlink(cache_dir)
+    elif os.path.isdir(cache_dir):
+        shutil.rmtree(cache_dir)
+    else:
+        # the shard directory of a new name (see StoreLayout.cache_dir)
+        os.makedirs(os.path.dirname(cache_dir), exist_ok=True)
+    os.symlink(shared, cache_dir)
+
+
+def release(path, file_hash, algorithm):
+    """
+    Remove the stored name `path`, and its blob once no other name links to it.
+    :return: True if it was the last name of the content
+    """
+    blob = blob_path(file_hash, algorithm)
+    with __locked():
+        if os.path.exists(path):
+            os.remove(path)
+        try:
+            st = os.stat(blob)
+        except FileNotFoundError:
+            return True
+        if st.st_nlink <= 1:
+            os.remove(blob)
+            return True
+        return False
+
+
+def stats():
+    """
+    :return: upload and duplicate counts, bytes saved, dedupe rate (duplicates / uploads since enabled)
+    """
+    rows = __connection().execute('SELECT key, value FROM blob_counter').fetchall()
+    result = {row['key']: row['value'] for row in rows}
+    result['enabled'] = enabled()
+    result['dedupe_rate'] = result['duplicates'] / result['uploads'] if result['uploads'] else 0.0
+    return result
+
+
+def __count(**values):
+    try:
+        conn = __connection()
+        with Database.transaction(conn):
+            conn.executemany('UPDATE blob_counter SET value = value + ? WHERE key = ?',
+                             [(value, key) for key, value in values.items()])
+    except sqlite3.Error as ex:
+        logging.error(ex, exc_info=True)
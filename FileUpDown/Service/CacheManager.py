@@ -0,0 +1,437 @@
+# encoding: utf-8
+"""
+This module bounds the derivative cache under `GlobalConfigContext.FileCache_Directory`.
+Every cached file is tracked with its size and last access (SQLite at `GlobalConfigContext.FileCache_Database`),
+once the total passes `FileCache_Max_Bytes` the least recently used entries are removed.
+"""
+from contextlib import contextmanager
+import fcntl
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+import GlobalConfigContext
+from Service import Database
+from Service import Metrics
+from Service import Reaper
+import logging as L
+logging = L.getLogger('file')
+
+__columns = [
+    ('path', 'TEXT PRIMARY KEY'),
+    ('dir', 'TEXT'),
+    ('kind', 'TEXT'),
+    ('size', 'INTEGER'),
+    ('last_access', 'REAL'),
+    ('hits', 'INTEGER DEFAULT 0'),
+]
+__counters = ('hits', 'misses', 'stores', 'evictions', 'evicted_bytes', 'bytes')
+
+__lock = threading.Lock()
+__evict_lock = threading.Lock()
+__pending = {}
+__pending_touch = {}
+__last_flush = 0.0
+__touched = {}
+__flights = {}
+__local = threading.local()
+
+
+class Miss(Exception):
+    """
+    `produce` was asked for a derivative that is not cached while `cached_only` is on.
+    """
+
+
+def __connection():
+    return Database.connection(GlobalConfigContext.FileCache_Database, init=__init_schema)
+
+
+def __init_schema(conn):
+    Database.add_columns(conn, 'cache_entry', __columns)
+    conn.execute('CREATE INDEX IF NOT EXISTS cache_entry_access ON cache_entry (last_access)')
+    conn.execute('CREATE INDEX IF NOT EXISTS cache_entry_dir ON cache_entry (dir)')
+    conn.execute('CREATE TABLE IF NOT EXISTS cache_counter (key TEXT PRIMARY KEY, value INTEGER)')
+    conn.executemany('INSERT OR IGNORE INTO cache_counter (key, value) VALUES (?, 0)', [(k,) for k in __counters])
+    conn.execute('CREATE TABLE IF NOT EXISTS quality_hint (path TEXT PRIMARY KEY, dir TEXT, quality INTEGER)')
+    conn.execute('CREATE INDEX IF NOT EXISTS quality_hint_dir ON quality_hint (dir)')
+
+
+def kind(cache_path):
+    """
+    :return: derivative type of a cache file, named as `RangeResponse` names them
+    """
+    name = os.path.basename(cache_path)
+    if '@frames_' in name:
+        return 'frames'
+    if '@color_' in name:
+        return 'gif'
+    if '@size_' in name:
+        return 'size'
+    if '@quality_' in name:
+        return 'thumbnail'
+    return 'cover'
+
+
+def lookup(cache_path):
+    """
+    Check a derivative before serving it, counting the hit or miss and refreshing its last access.
+    Under `cached_only` the count waits for the end of the block (see there).
+    :return: True if `cache_path` exists
+    """
+    hit = os.path.exists(cache_path)
+    if hit:
+        __touch(cache_path)
+    __count_lookup(cache_path, hit)
+    return hit
+
+
+def __count_lookup(cache_path, hit):
+    pending = getattr(__local, 'pending', None)
+    if pending is not None:
+        pending.append((cache_path, hit))
+        return
+    __count('hits' if hit else 'misses')
+    Metrics.inc('rg_cache_lookups_total', kind=kind(cache_path), result='hit' if hit else 'miss')
+
+
+def commit(cache_path):
+    """
+    Track a derivative just written to `cache_path`, evicting old entries when over budget.
+    """
+    try:
+        size = os.path.getsize(cache_path)
+        conn = __connection()
+        with Database.transaction(conn):
+            row = conn.execute('SELECT size FROM cache_entry WHERE path = ?', (cache_path,)).fetchone()
+            conn.execute(
+                'INSERT OR REPLACE INTO cache_entry (path, dir, kind, size, last_access, hits) VALUES (?, ?, ?, ?, ?, 0)',
+                (cache_path, os.path.dirname(cache_path), kind(cache_path), size, time.time()))
+            __add(conn, 'bytes', size - (row['size'] if row is not None else 0))
+            __add(conn, 'stores', 1)
+        total = conn.execute("SELECT value FROM cache_counter WHERE key = 'bytes'").fetchone()['value']
+        if total > GlobalConfigContext.FileCache_Max_Bytes:
+            evict()
+    except (OSError, sqlite3.Error) as ex:
+        logging.error(ex, exc_info=True)
+
+
+@contextmanager
+def cached_only():
+    """
+    Within the block `produce` raises Miss instead of creating anything (or waiting for another caller
+    creating it), on this thread: only what is already cached is served, e.g. by the first pass of a batch.
+    The lookups of the block are counted when it ends without a Miss, after one they are left to the caller
+    coming back for the derivative, so each is counted once.
+    """
+    previous = (getattr(__local, 'cached_only', False), getattr(__local, 'pending', None),
+                getattr(__local, 'missed', False))
+    __local.cached_only, __local.pending, __local.missed = True, [], False
+    try:
+        yield
+    finally:
+        pending, missed = __local.pending, __local.missed
+        __local.cached_only, __local.pending, __local.missed = previous
+        if not missed:
+            for cache_path, hit in pending:
+                __count_lookup(cache_path, hit)
+
+
+@contextmanager
+def produce(cache_path):
+    """
+    Single-flight creation of a derivative, concurrent requests for the same `cache_path` do the work once.
+    The first caller gets a temp path to write and the result is renamed into place atomically,
+    callers that waited (threads of this process, or other processes through a file lock) get None
+    when the file was produced meanwhile and just serve it.
+        with CacheManager.produce(cache_path) as temp_path:
+            if temp_path is not None:
+                im.save(temp_path, format=format)
+    :raise Miss: under `cached_only`, when `cache_path` does not exist
+    """
+    if getattr(__local, 'cached_only', False) and not os.path.exists(cache_path):
+        __local.missed = True
+        raise Miss(cache_path)
+    with __flight(cache_path):
+        directory, name = os.path.split(cache_path)
+        lock_path = os.path.join(directory, '.%s.lock' % name)
+        with open(lock_path, 'a+b') as lock_file:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                if os.path.exists(cache_path):
+                    yield None
+                    return
+                temp_path = os.path.join(directory, '.%s.%s.tmp' % (name, uuid.uuid4().hex))
+                try:
+                    yield temp_path
+                    if os.path.exists(temp_path):
+                        os.replace(temp_path, cache_path)
+                        commit(cache_path)
+                finally:
+                    if os.path.exists(temp_path):
+                        os.remove(temp_path)
+            finally:
+                # removed while still held, so no lock file outlives its work: a process already waiting on it
+                # then finds the derivative, or builds it once more if it failed, it never reads a partial file
+                __remove(lock_path)
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+def __remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+@contextmanager
+def __flight(cache_path):
+    with __lock:
+        flight = __flights.get(cache_path)
+        if flight is None:
+            flight = __flights[cache_path] = [threading.Lock(), 0]
+        flight[1] += 1
+    try:
+        with flight[0]:
+            yield
+    finally:
+        with __lock:
+            flight[1] -= 1
+            if flight[1] == 0:
+                del __flights[cache_path]
+
+
+def forget_dir(base_dir):
+    """
+    Drop the entries of a per-file cache directory that is being removed.
+    """
+    try:
+        conn = __connection()
+        with Database.transaction(conn):
+            row = conn.execute('SELECT COALESCE(SUM(size), 0) AS size FROM cache_entry WHERE dir = ?', (base_dir,)).fetchone()
+            conn.execute('DELETE FROM cache_entry WHERE dir = ?', (base_dir,))
+            conn.execute('DELETE FROM quality_hint WHERE dir = ?', (base_dir,))
+            __add(conn, 'bytes', -row['size'])
+    except sqlite3.Error as ex:
+        logging.error(ex, exc_info=True)
+
+
+def move_dir(base_dir, new_dir):
+    """
+    Follow a per-file cache directory renamed to `new_dir`.
+    """
+    try:
+        conn = __connection()
+        with Database.transaction(conn):
+            for table in ('cache_entry', 'quality_hint'):
+                conn.execute(
+                    'UPDATE OR REPLACE %s SET path = ? || substr(path, ?), dir = ? WHERE dir = ?' % table,
+                    (new_dir, len(base_dir) + 1, new_dir, base_dir))
+    except sqlite3.Error as ex:
+        logging.error(ex, exc_info=True)
+
+
+def quality_hint(cache_path):
+    """
+    :return: quality a size-capped derivative was last encoded with, None if unknown.
+    It goes with its entry when evicted or forgotten, but outlives a cache file removed outside the cache
+    (see `rebuild`), so rebuilding that derivative starts from it.
+    """
+    try:
+        row = __connection().execute('SELECT quality FROM quality_hint WHERE path = ?', (cache_path,)).fetchone()
+    except sqlite3.Error as ex:
+        logging.error(ex, exc_info=True)
+        return None
+    return row['quality'] if row is not None else None
+
+
+def set_quality_hint(cache_path, quality):
+    try:
+        __connection().execute(
+            'INSERT OR REPLACE INTO quality_hint (path, dir, quality) VALUES (?, ?, ?)',
+            (cache_path, os.path.dirname(cache_path), quality))
+    except sqlite3.Error as ex:
+        logging.error(ex, exc_info=True)
+
+
+def evict(target=None):
+    """
+    Remove least recently used entries until the cache is below `target` bytes,
+    default `FileCache_Max_Bytes * FileCache_Low_Water`.
+    """
+    if target is None:
+        target = int(GlobalConfigContext.FileCache_Max_Bytes * GlobalConfigContext.FileCache_Low_Water)
+    if not __evict_lock.acquire(blocking=False):
+        return
+    try:
+        __flush(force=True)
+        conn = __connection()
+        total = conn.execute("SELECT value FROM cache_counter WHERE key = 'bytes'").fetchone()['value']
+        while total > target:
+            rows = conn.execute('SELECT path, size FROM cache_entry ORDER BY last_access LIMIT 256').fetchall()
+            if not rows:
+                break
+            evicted = []
+            for row in rows:
+                if total <= target:
+                    break
+                try:
+                    os.remove(row['path'])
+                except FileNotFoundError:
+                    pass
+                except OSError as ex:
+                    logging.error(ex, exc_info=True)
+                    continue
+                evicted.append(row)
+                total -= row['size']
+            if not evicted:
+                break
+            evicted_bytes = sum(row['size'] for row in evicted)
+            with Database.transaction(conn):
+                conn.executemany('DELETE FROM cache_entry WHERE path = ?', [(row['path'],) for row in evicted])
+                conn.executemany('DELETE FROM quality_hint WHERE path = ?', [(row['path'],) for row in evicted])
+                __add(conn, 'bytes', -evicted_bytes)
+                __add(conn, 'evictions', len(evicted))
+                __add(conn, 'evicted_bytes', evicted_bytes)
+            logging.info('cache evict %d entries %d bytes', len(evicted), evicted_bytes)
+    except sqlite3.Error as ex:
+        logging.error(ex, exc_info=True)
+    finally:
+        __evict_lock.release()
+
+
+def stats():
+    """
+    :return: dict of the counters (summed over all processes), entry count and budget
+    """
+    __flush(force=True)
+    conn = __connection()
+    result = {row['key']: row['value'] for row in conn.execute('SELECT key, value FROM cache_counter')}
+    result['entries'] = conn.execute('SELECT COUNT(*) AS n FROM cache_entry').fetchone()['n']
+    result['max_bytes'] = GlobalConfigContext.FileCache_Max_Bytes
+    return result
+
+
+def rebuild():
+    """
+    Track cache files written before this module existed (or by another node) and drop rows whose file is gone.
+    Lock and temp files a killed process left behind are removed.
+    """
+    base = GlobalConfigContext.FileCache_Directory
+    if not os.path.isdir(base):
+        return
+    conn = __connection()
+    try:
+        known = {row['path'] for row in conn.execute('SELECT path FROM cache_entry')}
+        found = set()
+        rows = []
+        trash = Reaper.trash_dir()
+        for root, dirs, files in os.walk(base):
+            # directories waiting for the reaper are already forgotten
+            dirs[:] = [d for d in dirs if os.path.join(root, d) != trash]
+            for name in files:
+                path = os.path.join(root, name)
+                if name.startswith('.'):
+                    __remove_leftover(path)
+                    continue
+                found.add(path)
+                if path in known:
+                    continue
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                rows.append((path, root, kind(path), st.st_size, st.st_atime))
+        missing = json.dumps(list(known - found))
+        with Database.transaction(conn):
+            # a file committed (and counted) since `known` was read is left as it is, only inserted rows add bytes
+            added = 0
+            for row in rows:
+                changes = conn.total_changes
+                conn.execute(
+                    'INSERT OR IGNORE INTO cache_entry (path, dir, kind, size, last_access, hits) VALUES (?, ?, ?, ?, ?, 0)',
+                    row)
+                if conn.total_changes != changes:
+                    added += row[3]
+            gone = conn.execute(
+                'SELECT COALESCE(SUM(size), 0) AS size FROM cache_entry WHERE path IN (SELECT value FROM json_each(?))',
+                (missing,)).fetchone()
+            conn.execute('DELETE FROM cache_entry WHERE path IN (SELECT value FROM json_each(?))', (missing,))
+            __add(conn, 'bytes', added - gone['size'])
+        logging.info('cache rebuild tracked %d entries, dropped %d', len(rows), len(known - found))
+    except sqlite3.Error as ex:
+        logging.error(ex, exc_info=True)
+    evict()
+
+
+def __remove_leftover(path):
+    """
+    Lock and temp files of `produce` left by a killed process, once no request can still be waiting on them.
+    """
+    if not (path.endswith('.lock') or path.endswith('.tmp')):
+        return
+    try:
+        if time.time() - os.path.getmtime(path) > GlobalConfigContext.Transform_Timeout:
+            os.remove(path)
+    except OSError:
+        pass
+
+
+def start_rebuild():
+    thread = threading.Thread(target=rebuild, name='cache-rebuild', daemon=True)
+    thread.start()
+    return thread
+
+
+def __count(key, value=1):
+    with __lock:
+        __pending[key] = __pending.get(key, 0) + value
+    __flush()
+
+
+def __touch(cache_path):
+    now = time.time()
+    with __lock:
+        if now - __touched.get(cache_path, 0) < GlobalConfigContext.FileCache_Touch_Interval:
+            return
+        __touched[cache_path] = now
+        __pending_touch[cache_path] = now
+        if len(__touched) > 65536:
+            __touched.clear()
+    __flush()
+
+
+def __flush(force=False):
+    """
+    Counters and last access times are written in batches, not once per request.
+    """
+    global __last_flush
+    now = time.time()
+    with __lock:
+        if not force and now - __last_flush < 1 and sum(__pending.values()) < 64:
+            return
+        __last_flush = now
+        pending = dict(__pending)
+        touches = dict(__pending_touch)
+        __pending.clear()
+        __pending_touch.clear()
+    if not pending and not touches:
+        return
+    try:
+        conn = __connection()
+        with Database.transaction(conn):
+            for key, value in pending.items():
+                __add(conn, key, value)
+            conn.executemany(
+                'UPDATE cache_entry SET last_access = ?, hits = hits + 1 WHERE path = ?',
+                [(t, p) for p, t in touches.items()])
+    except sqlite3.Error as ex:
+        logging.error(ex, exc_info=True)
+
+
+def __add(conn, key, value):
+    conn.execute('UPDATE cache_counter SET value = value + ? WHERE key = ?', (value, key))
+
@@ -0,0 +1,286 @@
+# encoding: utf-8
+"""
+Resumable chunked upload: `init` an upload, `put_part` its parts in any order and over several connections,
+ask `status` which parts arrived after a drop, then `complete` it into the store through FileService.perform_register.
+An upload is a directory `{FileStore_Directory}/.chunked/{upload_id}` holding
+- `upload.json`: filename, mime given by the client, total size if known, part size,
+- `data`: the file, part N written at offset N * part size,
+- `parts/{N}`: marker written once part N is on disk, with its size and hash.
+Part writes hold a shared lock on `data` and `complete` an exclusive one, so a file is only hashed and stored
+once no part is being written, and a part arriving after that is refused.
+"""
+import fcntl
+import json
+import os
+import re
+import shutil
+import time
+import uuid
+
+import GlobalConfigContext
+from Service import Digest
+from Service import FileService
+import logging as L
+logging = L.getLogger('file')
+
+__id_pattern = re.compile(r'^[0-9a-f]{32}$')
+
+
+class UploadError(Exception):
+    """
+    The request can not be applied to the upload, `status` is the HTTP status to answer with.
+    """
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def __root():
+    return os.path.join(GlobalConfigContext.FileStore_Directory, '.chunked')
+
+
+def __upload_dir(upload_id):
+    if not isinstance(upload_id, str) or not __id_pattern.match(upload_id):
+        raise UploadError('unknown upload', 404)
+    path = os.path.join(__root(), upload_id)
+    if not os.path.isdir(path):
+        raise UploadError('unknown upload', 404)
+    return path
+
+
+def __read_json(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def __write_json(path, value):
+    temp_path = '%s.%s.tmp' % (path, uuid.uuid4().hex)
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(value, f, ensure_ascii=False)
+    os.replace(temp_path, path)
+
+
+def init(filename, size=None, part_size=None, mimetype=None):
+    """
+    :param size: total bytes if the client knows them, parts beyond it are refused
+    :param part_size: bytes per part, every part but the last has exactly this size
+    :return: status of the new upload
+    """
+    if not filename:
+        raise UploadError('filename is required')
+    if os.path.basename(filename) != filename or '\\' in filename or '\0' in filename or filename in ('.', '..'):
+        raise UploadError('filename must not contain a path')
+    if part_size is None:
+        part_size = GlobalConfigContext.Chunk_Upload_Part_Size
+    part_size = int(part_size)
+    if part_size < GlobalConfigContext.Chunk_Upload_Min_Part_Size or part_size > GlobalConfigContext.Chunk_Upload_Max_Part_Size:
+        raise UploadError('part_size must be within %d and %d' % (
+            GlobalConfigContext.Chunk_Upload_Min_Part_Size, GlobalConfigContext.Chunk_Upload_Max_Part_Size))
+    if size is not None:
+        size = int(size)
+        if size < 0:
+            raise UploadError('size must not be negative')
+
+    __prune()
+    upload_id = uuid.uuid4().hex
+    path = os.path.join(__root(), upload_id)
+    os.makedirs(os.path.join(path, 'parts'))
+    with open(os.path.join(path, 'data'), 'wb') as f:
+        if size:
+            # sparse until the parts arrive
+            f.truncate(size)
+    __write_json(os.path.join(path, 'upload.json'), {
+        'filename': filename,
+        'mime': mimetype,
+        'size': size,
+        'part_size': part_size,
+        'created': time.time(),
+    })
+    return status(upload_id)
+
+
+def put_part(upload_id, part, stream, expected_hash=None):
+    """
+    Write part `part` from `stream` at its offset, several parts of one upload may be written at once.
+    Sending a part again replaces it.
+    :param expected_hash: hash the client computed, the part is refused if it differs
+    :return: {'part', 'size', 'hash'}
+    """
+    path = __upload_dir(upload_id)
+    upload = __read_json(os.path.join(path, 'upload.json'))
+    part_size = upload['part_size']
+    part = int(part)
+    if part < 0:
+        raise UploadError('part must not be negative')
+    offset = part * part_size
+    limit = part_size
+    if upload['size'] is not None:
+        if offset >= upload['size'] and not (offset == 0 and upload['size'] == 0):
+            raise UploadError('part %d is beyond the upload size' % part)
+        limit = min(part_size, upload['size'] - offset)
+
+    try:
+        fd = os.open(os.path.join(path, 'data'), os.O_WRONLY)
+    except FileNotFoundError:
+        raise UploadError('unknown upload', 404)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_SH)
+        if not os.path.isdir(path):
+            # completed (the data is a stored file now) or aborted while this part waited
+            raise UploadError('unknown upload', 404)
+        return __write_part(path, fd, part, offset, limit, upload['size'], stream, expected_hash)
+    finally:
+        os.close(fd)
+
+
+def __write_part(path, fd, part, offset, limit, size, stream, expected_hash):
+    """
+    :param limit: bytes the part may have, exactly this many when the upload `size` is known
+    """
+    marker_path = os.path.join(path, 'parts', str(part))
+    if os.path.exists(marker_path):
+        # the data is about to change, the part counts as missing until it is whole again
+        os.remove(marker_path)
+
+    m = Digest.new()
+    written = 0
+    while True:
+        buf = stream.read(256 * 1024)
+        if not buf:
+            break
+        if written + len(buf) > limit:
+            raise UploadError('part %d is larger than %d bytes' % (part, limit))
+        view = memoryview(buf)
+        while view:
+            n = os.pwrite(fd, view, offset + written)
+            view = view[n:]
+            written += n
+        m.update(buf)
+    os.fsync(fd)
+
+    if size is not None and written != limit:
+        raise UploadError('part %d has %d bytes, expected %d' % (part, written, limit))
+    part_hash = m.hexdigest()
+    if expected_hash and expected_hash.lower() != part_hash:
+        raise UploadError('part %d hash mismatch' % part)
+    marker = {'part': part, 'size': written, 'hash': part_hash}
+    if not os.path.isdir(os.path.join(path, 'parts')):
+        # aborted meanwhile
+        raise UploadError('unknown upload', 404)
+    __write_json(marker_path, marker)
+    return marker
+
+
+def status(upload_id):
+    """
+    :return: {'upload_id', 'filename', 'size', 'part_size', 'parts': [{'part', 'size', 'hash'}], 'missing': [N] or None}
+    `missing` lists the parts still expected, it is None while the total size is unknown.
+    """
+    path = __upload_dir(upload_id)
+    upload = __read_json(os.path.join(path, 'upload.json'))
+    parts = __parts(path)
+    missing = None
+    if upload['size'] is not None:
+        count = max(1, -(-upload['size'] // upload['part_size']))
+        missing = [n for n in range(count) if n not in parts]
+    return {
+        'upload_id': upload_id,
+        'filename': upload['filename'],
+        'size': upload['size'],
+        'part_size': upload['part_size'],
+        'parts': [parts[n] for n in sorted(parts)],
+        'missing': missing,
+    }
+
+
+def __parts(path):
+    parts = {}
+    parts_dir = os.path.join(path, 'parts')
+    for name in os.listdir(parts_dir):
+        if name.isdigit():
+            try:
+                marker = __read_json(os.path.join(parts_dir, name))
+            except (OSError, ValueError):
+                continue
+            parts[marker['part']] = marker
+    return parts
+
+
+def complete(upload_id):
+    """
+    Check every part arrived, hash the assembled file and register it like a normal upload.
+    :return: tuple of FileService.perform_register
+    """
+    path = __upload_dir(upload_id)
+    try:
+        fd = os.open(os.path.join(path, 'data'), os.O_RDONLY)
+    except FileNotFoundError:
+        raise UploadError('unknown upload', 404)
+    try:
+        # wait for the parts being written, then keep new ones out until the file is stored or given back
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        return __complete(upload_id, path)
+    finally:
+        os.close(fd)
+
+
+def __complete(upload_id, path):
+    # claim the upload, later part writes and a second complete see it gone
+    claimed = os.path.join(__root(), '.%s.completing' % upload_id)
+    try:
+        os.rename(path, claimed)
+    except FileNotFoundError:
+        raise UploadError('unknown upload', 404)
+    try:
+        upload = __read_json(os.path.join(claimed, 'upload.json'))
+        parts = __parts(claimed)
+        part_size = upload['part_size']
+        count = max(parts) + 1 if parts else 0
+        missing = [n for n in range(count) if n not in parts]
+        if upload['size'] is not None:
+            expected = max(1, -(-upload['size'] // part_size))
+            missing += list(range(count, expected))
+        if missing or not parts:
+            raise UploadError('missing parts: %s' % missing, 409)
+        if any(parts[n]['size'] != part_size for n in range(count - 1)):
+            raise UploadError('only the last part may be shorter than part_size', 409)
+        size = (count - 1) * part_size + parts[count - 1]['size']
+
+        data_path = os.path.join(claimed, 'data')
+        with open(data_path, 'r+b') as f:
+            f.truncate(size)
+            f.seek(0)
+            digest = Digest.StreamDigest(None).copy_stream(f, buffer_size=1024 * 1024)
+        result = FileService.perform_register(data_path, upload['filename'], upload['mime'], digest)
+    except BaseException:
+        # give it back so the client can fix it
+        os.rename(claimed, path)
+        raise
+    if not result[0]:
+        os.rename(claimed, path)
+        return result
+    shutil.rmtree(claimed, ignore_errors=True)
+    return result
+
+
+def abort(upload_id):
+    path = __upload_dir(upload_id)
+    shutil.rmtree(path, ignore_errors=True)
+
+
+def __prune():
+    """
+    Remove uploads untouched for `Chunk_Upload_Expire` seconds.
+    """
+    root = __root()
+    if not os.path.isdir(root):
+        return
+    deadline = time.time() - GlobalConfigContext.Chunk_Upload_Expire
+    for name in os.listdir(root):
+        path = os.path.join(root, name)
+        try:
+            if os.stat(os.path.join(path, 'data')).st_mtime < deadline:
+                shutil.rmtree(path, ignore_errors=True)
+        except OSError:
+            pass
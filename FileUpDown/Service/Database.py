@@ -0,0 +1,61 @@
+# encoding: utf-8
+"""
+Thread local SQLite connections shared by the on-disk indexes.
+"""
+import sqlite3
+import threading
+
+__local = threading.local()
+__schema_lock = threading.Lock()
+__schema_ready = set()
+
+
+def connection(path, init=None):
+    """
+    :param path: database file
+    :param init: `init(conn)` creates or migrates the tables of one module, it runs once per database in this process
+    :return: autocommit connection owned by the current thread
+    """
+    connections = getattr(__local, 'connections', None)
+    if connections is None:
+        connections = __local.connections = {}
+    conn = connections.get(path)
+    if conn is None:
+        conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        connections[path] = conn
+    if init is not None and (path, init) not in __schema_ready:
+        with __schema_lock:
+            if (path, init) not in __schema_ready:
+                init(conn)
+                __schema_ready.add((path, init))
+    return conn
+
+
+def add_columns(conn, table, columns):
+    """
+    Create `table`, then add the `columns` (list of <name, sql type>) an older database misses.
+    """
+    conn.execute('CREATE TABLE IF NOT EXISTS %s (%s)' % (table, ', '.join('%s %s' % c for c in columns)))
+    exists = {row['name'] for row in conn.execute('PRAGMA table_info(%s)' % table)}
+    for column, sql_type in columns:
+        if column not in exists:
+            conn.execute('ALTER TABLE %s ADD COLUMN %s %s' % (table, column, sql_type))
+
+
+class transaction:
+    """
+    `with Database.transaction(conn):` runs the block in one write transaction.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        self.conn.execute('BEGIN IMMEDIATE')
+        return self.conn
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.conn.execute('COMMIT' if exc_type is None else 'ROLLBACK')
@@ -0,0 +1,332 @@
+# encoding: utf-8
+"""
+Derivatives (thumbnails, GIF variants, size-capped variants, audio/video/EPUB covers) by cache path.
+Each function returns the cache file, creating it once through CacheManager.produce and the transform pool.
+RangeResponse wraps these paths into responses, Pregenerate builds them ahead of the first request.
+"""
+import os
+import re
+
+import GlobalConfigContext
+from Service import CacheManager
+from Service import FileService
+from Service import Governor
+from Service import Transform
+from Service import TransformExecutor
+from Service import epub
+
+import logging as L
+logging = L.getLogger('file')
+
+# cache name of an `image_side` thumbnail: side, quality, format, suffix
+__thumbnail_name = re.compile(r'^@(\d+)x\1@quality_(\d+)(@format_\w+)?(.*)$')
+
+
+def image_quality(quality):
+    """
+    :param quality: 'high', 'low', a number or None
+    :return: JPEG/WebP quality used for thumbnails
+    """
+    if quality is not None:
+        if isinstance(quality, str):
+            if quality == 'high':
+                quality = 85
+            elif quality == 'low':
+                quality = 40
+            else:
+                quality = 85
+        elif isinstance(quality, int):
+            quality = min(int(quality), 85)
+    else:
+        quality = 85
+    return quality
+
+
+def output_format(requested, accept):
+    """
+    Output format of an image derivative: the `format=` param when given, else the first of
+    `Image_Negotiate_Formats` this Pillow can write and the client lists in its Accept header.
+    A bare `*/*` or `image/*` does not count, it is sent by clients that can not decode WebP or AVIF.
+    :param requested: 'webp', 'avif', 'jpeg', 'png', 'original' or None
+    :param accept: werkzeug MIMEAccept of the request
+    :return: <PIL format or None for the source format, whether the Accept header decided it>
+    """
+    if requested:
+        requested = requested.upper()
+        if requested == 'JPG':
+            requested = 'JPEG'
+        return (requested if requested in Transform.save_formats() else None), False
+    listed = {value for value, q in accept if q > 0}
+    for format in negotiated_formats():
+        if Transform.image_formats[format] in listed:
+            return format, True
+    return None, True
+
+
+def negotiated_formats():
+    """
+    :return: `Image_Negotiate_Formats` this Pillow can write, best first
+    """
+    available = Transform.save_formats()
+    return [format for format in GlobalConfigContext.Image_Negotiate_Formats if format in available]
+
+
+def __format_name(format):
+    return '@format_%s' % format.lower() if format else ''
+
+
+def image_copy(filename, source):
+    """
+    Extract an image that lives inside an archive (see Transform) into the cache of `filename`.
+    """
+    cache_name='@%s' % (FileService.RGCompressCacheThumbName)
+    cache_path = FileService.get_file_cache_path(filename=filename, cache_name=cache_name, mk_dir=True)
+    if CacheManager.lookup(cache_path):
+        return cache_path
+    with CacheManager.produce(cache_path) as temp_path:
+        if temp_path is not None:
+            TransformExecutor.run(Transform.image_copy, source, temp_path)
+    return cache_path
+
+
+def image_side(filename, source, side, quality, format=None):
+    """
+    :param quality: already normalized by `image_quality`
+    :param format: PIL output format, see `output_format`, None keeps the source format
+    :return: cache path of `source` fit in `side` x `side`
+    :raise Governor.TooLarge: when `source` is not built from for its pixel count
+    """
+    width, height = Transform.image_size(source)
+    if side > height and side > width:
+        side = int(max(height, width))
+
+    cache_name='@%dx%d@quality_%d%s%s' % (side, side, quality, __format_name(format), FileService.RGCompressCacheThumbName)
+    cache_path = FileService.get_file_cache_path(filename=filename, cache_name=cache_name, mk_dir=True)
+    if CacheManager.lookup(cache_path):
+        return cache_path
+    Governor.check_image(width, height)
+
+    with CacheManager.produce(cache_path) as temp_path:
+        if temp_path is not None:
+            larger = __larger_thumbnail(filename, side, quality, format)
+            try:
+                TransformExecutor.run(Transform.image_side, larger or source, temp_path, side, quality, format)
+            except FileNotFoundError:
+                if larger is None:
+                    raise
+                # evicted meanwhile
+                TransformExecutor.run(Transform.image_side, source, temp_path, side, quality, format)
+    return cache_path
+
+
+def __larger_thumbnail(filename, side, quality, format):
+    """
+    :return: the smallest cached `image_side` thumbnail of `filename` at least `Image_Derive_Min_Ratio` times `side`
+             and of `quality` or better, to build a smaller one from (e.g. 150 from 1080), None if there is none.
+             Without `format` the output takes the format of its source, so only source format thumbnails qualify.
+    """
+    ratio = GlobalConfigContext.Image_Derive_Min_Ratio
+    if not ratio:
+        return None
+    base_dir = FileService.get_file_cache_base_dir(filename)
+    best_side, best_path = None, None
+    try:
+        with os.scandir(base_dir) as entries:
+            for entry in entries:
+                match = __thumbnail_name.match(entry.name)
+                if match is None or match.group(4) != FileService.RGCompressCacheThumbName:
+                    continue
+                cached_side, cached_quality = int(match.group(1)), int(match.group(2))
+                if cached_side < side * ratio or cached_quality < quality or (format is None and match.group(3)):
+                    continue
+                if best_side is None or cached_side < best_side:
+                    best_side, best_path = cached_side, entry.path
+    except FileNotFoundError:
+        return None
+    if best_path is None or not CacheManager.lookup(best_path):
+        return None
+    return best_path
+
+
+def gif(path, side, quality, format=None):
+    """
+    :param format: negotiated output format, see `gif_format`
+    :return: cache path of the resized GIF (or animated WebP), None if gifsicle failed
+    :raise Governor.TooLarge: when the GIF is not resized for its pixel or frame count
+    """
+    color = 128
+    lossy = 20
+    optimize = 3
+    if quality is not None and isinstance(quality, str):
+        if quality == 'low':
+            color = 64
+            lossy = 80
+            optimize = 4
+
+    width, height = Transform.image_size(path)
+    if side > height and side > width:
+        side = int(max(height, width))
+
+    if GlobalConfigContext.Gif_Engine != 'pillow':
+        return __gifsicle(path, side, color, lossy, optimize, width, height)
+
+    mode = 'small' if quality == 'low' else GlobalConfigContext.Gif_Mode
+    if gif_format(format) == 'WEBP':
+        quality = image_quality(quality)
+        cache_name='@%dx%d@color_%d@mode_%s@quality_%d%s' % (side, side, color, mode, quality, FileService.RGCompressCacheAnimatedWebpName)
+    else:
+        cache_name='@%dx%d@color_%d@mode_%s%s' % (side, side, color, mode, FileService.RGCompressCacheGifName)
+    cache_path = FileService.get_file_cache_path(filename=path, cache_name=cache_name, mk_dir=True)
+    if CacheManager.lookup(cache_path):
+        return cache_path
+    # the resized frames are all held until encoded
+    Governor.check_animation(width, height, Transform.image_frames(path), side)
+    with CacheManager.produce(cache_path) as temp_path:
+        if temp_path is not None:
+            TransformExecutor.run(Transform.gif_resize, path, temp_path, side, color, mode, gif_format(format), quality)
+    return cache_path
+
+
+def gif_format(format):
+    """
+    :param format: negotiated output format, see `output_format`
+    :return: 'WEBP' for a client negotiating WebP or AVIF (animated AVIF is not written), with `Gif_Animated_WebP`
+             and the pillow `Gif_Engine`, else 'GIF'
+    """
+    if (format in ('WEBP', 'AVIF') and GlobalConfigContext.Gif_Animated_WebP
+            and GlobalConfigContext.Gif_Engine == 'pillow' and 'WEBP' in Transform.save_formats()):
+        return 'WEBP'
+    return 'GIF'
+
+
+def __gifsicle(path, side, color, lossy, optimize, width, height):
+    cache_name='@%dx%d@color_%d@lossy_%d@optimize_%d%s' % (side, side, color, lossy, optimize, FileService.RGCompressCacheGifName)
+    cache_path = FileService.get_file_cache_path(filename=path, cache_name=cache_name, mk_dir=True)
+    if CacheManager.lookup(cache_path):
+        return cache_path
+    Governor.check_image(width, height, Transform.image_frames(path))
+    with CacheManager.produce(cache_path) as temp_path:
+        if temp_path is not None:
+            if TransformExecutor.run(Transform.gif_compress, path, temp_path, side, color, lossy, optimize) == False:
+                logging.error('gifsicle compress failed')
+                return None
+    return cache_path
+
+
+def fit_size(image_path, max_size, side, name, format=None):
+    """
+    Compress images to a specified size
+    :param max_size: specified size in KB
+    :param name: given '/store/photo_2024.jpg', save to '/cache/photo_2024/@102400_compressCacheThumbnail.jpeg'
+    :param format: PIL output format, see `output_format`, None keeps the source format
+    :return: cache path, or `image_path` if it already fits
+    :raise Governor.TooLarge: when `image_path` is not built from for its pixel count
+    """
+    if max_size is None or max_size == 0:
+        return image_path
+
+    max_kb = max_size * 1024
+    if not isinstance(image_path, tuple) and os.path.getsize(image_path) <= max_kb:
+        # the original already fits: no cache lookup, no lock, no pool round trip
+        return image_path
+    width, height = Transform.image_size(image_path)
+    if side is None:
+        side = int(max(height, width))
+    else:
+        if side > height and side > width:
+            side = int(max(height, width))
+
+    cache_path = FileService.get_file_cache_path(filename=name, mk_dir=True, cache_name='@%dx%d@size_%d%s%s' % (side, side, max_kb, __format_name(format), FileService.RGCompressCacheThumbName))
+
+    if CacheManager.lookup(cache_path):
+        return cache_path
+    Governor.check_image(width, height)
+
+    with CacheManager.produce(cache_path) as temp_path:
+        if temp_path is not None:
+            hint = CacheManager.quality_hint(cache_path)
+            quality = TransformExecutor.run(Transform.image_fit_size, image_path, temp_path, side, max_kb, hint, format)
+            if quality != hint:
+                CacheManager.set_quality_hint(cache_path, quality)
+    return cache_path
+
+
+def audio_cover(path, art=None):
+    """
+    :param art: `FileInfo.indexed_art` of `path`
+    :return: cache path of the embedded cover art, None if the file has none
+    """
+    return __cover(cover_owner(path, art), path, Transform.audio_thumbnail)
+
+
+def cover_owner(path, art):
+    """
+    Name whose cache directory holds the cover of `path` and the derivatives of that cover.
+    With indexed art it is the art itself ('@art_{hash}', not a valid stored name), so the tracks of an album
+    sharing a picture extract it and build its sizes once.
+    :param art: `FileInfo.indexed_art` of `path`
+    """
+    if art is not None and art['art_hash']:
+        return '@art_%s' % art['art_hash']
+    return path
+
+
+def video_cover(path):
+    """
+    :return: cache path of a poster frame, None if no frame could be read
+    """
+    return __cover(path, path, Transform.video_capture)
+
+
+def video_frames(path, count, side):
+    """
+    :return: cache path of a strip of `count` frames fit in `side` x `side`, see Transform.video_frames,
+             None if no frame could be read
+    """
+    cache_name='@frames_%d@side_%d%s' % (count, side, FileService.RGCompressCacheThumbName)
+    cache_path = FileService.get_file_cache_path(filename=path, cache_name=cache_name, mk_dir=True)
+    if CacheManager.lookup(cache_path):
+        return cache_path
+    with CacheManager.produce(cache_path) as temp_path:
+        if temp_path is not None:
+            TransformExecutor.run(Transform.video_frames, path, temp_path, count, side)
+    if os.path.exists(cache_path):
+        return cache_path
+    return None
+
+
+def video_frame(path, count, side, index):
+    """
+    :return: cache path of frame `index` of the `video_frames` strip, cut out of it without decoding the video again
+    """
+    strip = video_frames(path, count, side)
+    if strip is None:
+        return None
+    cache_name='@frames_%d@side_%d@frame_%d%s' % (count, side, index, FileService.RGCompressCacheThumbName)
+    cache_path = FileService.get_file_cache_path(filename=path, cache_name=cache_name, mk_dir=True)
+    if CacheManager.lookup(cache_path):
+        return cache_path
+    with CacheManager.produce(cache_path) as temp_path:
+        if temp_path is not None:
+            TransformExecutor.run(Transform.image_tile, strip, temp_path, index, count)
+    return cache_path
+
+
+def epub_cover(path):
+    """
+    :return: <zip path, member> of the cover image, an image source for `image_side`
+    """
+    return path, epub.get_epub_cover_path(path)
+
+
+def __cover(owner, path, transform):
+    cache_name='@%s' % (FileService.RGCompressCacheThumbName)
+    cache_path = FileService.get_file_cache_path(filename=owner, cache_name=cache_name, mk_dir=True)
+    if CacheManager.lookup(cache_path):
+        return cache_path
+    with CacheManager.produce(cache_path) as destination:
+        if destination is not None:
+            TransformExecutor.run(transform, path, destination)
+    if os.path.exists(cache_path):
+        return cache_path
+    return None
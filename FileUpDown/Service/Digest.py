@@ -0,0 +1,91 @@
+# encoding: utf-8
+"""
+This module computes file digests while the data is streamed to disk.
+"""
+import hashlib
+import time
+import zlib
+
+import GlobalConfigContext
+from Service import Metrics
+
+hash_support = {
+    'md5': hashlib.md5,
+    'sha1': hashlib.sha1,
+    'sha256': hashlib.sha256,
+    'blake2b': lambda: hashlib.blake2b(digest_size=32),
+}
+
+
+def new(algorithm=None):
+    """
+    :param algorithm: key of `hash_support`, default `GlobalConfigContext.Upload_Hash_Algorithm`
+    :return: a hashlib object
+    """
+    if algorithm is None:
+        algorithm = GlobalConfigContext.Upload_Hash_Algorithm
+    if algorithm not in hash_support:
+        raise ValueError('unsupported hash algorithm: %s' % algorithm)
+    return hash_support[algorithm]()
+
+
+def file_digest(path, algorithm=None, buffer_size=1024 * 1024):
+    m = new(algorithm)
+    with open(path, 'rb') as f, Metrics.stage('hash'):
+        while True:
+            buf = f.read(buffer_size)
+            if not buf:
+                break
+            m.update(buf)
+    return m.hexdigest()
+
+
+class StreamDigest:
+    """
+    Write a stream to `fd` and compute everything upload needs in the same pass:
+    the digest, the CRC-32 (reused by ZIP exports), the byte count and the leading bytes used for MIME sniffing and EXIF.
+    With `fd` None the stream is only read, e.g. a file already assembled on disk.
+    """
+
+    def __init__(self, fd, algorithm=None, header_size=None):
+        self.fd = fd
+        self.algorithm = algorithm if algorithm is not None else GlobalConfigContext.Upload_Hash_Algorithm
+        self.hash = new(self.algorithm)
+        self.crc32 = 0
+        self.size = 0
+        self.header_size = header_size if header_size is not None else GlobalConfigContext.Upload_Header_Size
+        self.hash_seconds = 0.0
+        self.__header = bytearray()
+
+    def write(self, buf):
+        if len(self.__header) < self.header_size:
+            self.__header += buf[:self.header_size - len(self.__header)]
+        start = time.perf_counter()
+        self.hash.update(buf)
+        self.crc32 = zlib.crc32(buf, self.crc32)
+        self.hash_seconds += time.perf_counter() - start
+        self.size += len(buf)
+        if self.fd is not None:
+            self.fd.write(buf)
+
+    def copy_stream(self, stream, buffer_size=256 * 1024):
+        while True:
+            buf = stream.read(buffer_size)
+            if not buf:
+                break
+            self.write(buf)
+        # hashing is interleaved with the writes, only its own share is reported
+        Metrics.observe_stage('hash', self.hash_seconds)
+        return self
+
+    @property
+    def header(self):
+        return bytes(self.__header)
+
+    @property
+    def complete(self):
+        """ whether `header` holds the whole file """
+        return self.size <= self.header_size
+
+    def hexdigest(self):
+        return self.hash.hexdigest()
@@ -1,6 +1,10 @@
 # encoding: utf-8
+from collections import OrderedDict
 import difflib
+from io import BytesIO
 import mimetypes
+import mmap
+import threading
 import time
 import os
 
@@ -9,6 +13,11 @@ import exifread
 from exifread.utils import Ratio
 from exifread.classes import IfdTag
 from mutagen import File
+import GlobalConfigContext
+from Service import Digest
+from Service import Metrics
+from Service import MetaIndex
+from Service import StoreLayout
 import logging as L
 logging = L.getLogger('file')
 
@@ -44,19 +53,51 @@ image_support = [
     'xbm'
 ]
 
+__mime_lock = threading.Lock()
+__mime_cache = OrderedDict()
+__extension_lock = threading.Lock()
+__extension_table = {}
+
 
 def mime_type(buffer=None, path=None, mime_guess=None):
     mime_parse = None
     if buffer is not None:
-        mime_parse = magic.from_buffer(buffer.read(4096), mime=True)
+        with Metrics.stage('mime'):
+            mime_parse = magic.from_buffer(buffer.read(4096), mime=True)
         buffer.seek(0)
     elif path is not None:
-        mime_parse = magic.from_file(filename=path, mime=True)
+        mime_parse = __path_mime(path)
     else:
         assert "lack params"
     return __sure_mime(mime_parse=mime_parse, mime_guess=mime_guess)
 
 
+def __path_mime(path):
+    """
+    MIME of a file, memoized by <path, mtime, size> (`Mime_Cache_Size` entries).
+    A stored file takes the MIME indexed at upload, anything else is sniffed by libmagic once.
+    """
+    st = os.stat(path)
+    key = (path, st.st_mtime_ns, st.st_size)
+    with __mime_lock:
+        mime = __mime_cache.get(key)
+        if mime is not None:
+            __mime_cache.move_to_end(key)
+            return mime
+    name = os.path.basename(path)
+    info = MetaIndex.get(name, path) if StoreLayout.is_store_path(name, path) else None
+    if info is not None and info['mime']:
+        mime = info['mime']
+    else:
+        with Metrics.stage('mime'):
+            mime = magic.from_file(filename=path, mime=True)
+    with __mime_lock:
+        __mime_cache[key] = mime
+        while len(__mime_cache) > GlobalConfigContext.Mime_Cache_Size:
+            __mime_cache.popitem(last=False)
+    return mime
+
+
 def __sure_mime(mime_parse, mime_guess):
     """
     :param mime_parse: from magic
@@ -81,11 +122,11 @@ def extension(filename, mime, mime_guess):
         mime_guess1 = mime_guess.split(sep='/')[-1]
     ext = None
     if mime_guess is not None and (mime1.find(mime_guess1) >= 0 or mime_guess1.find(mime1) >= 0):
-        ext = __guess_extension(mime=mime, forward=mime1, filename=filename)
+        ext = __guess_extension(mime=mime, filename=filename)
         if ext is None:
-            ext = __guess_extension(mime=mime_guess, forward=mime_guess1, filename=filename)
+            ext = __guess_extension(mime=mime_guess, filename=filename)
     else:
-        ext = __guess_extension(mime=mime, forward=mime1, filename=filename)
+        ext = __guess_extension(mime=mime, filename=filename)
     if ext is None:
         ext = os.path.splitext(filename)[-1]
     if ext is None:
@@ -94,28 +135,35 @@ def extension(filename, mime, mime_guess):
     return ext
 
 
-def __guess_extension(mime, forward, filename):
-    forward_ext = '.' + forward
-    extensions = mimetypes.guess_all_extensions(type=mime)
+def __guess_extension(mime, filename):
+    """
+    :return: the extension of `filename` if `mime` allows it, else the preferred extension of `mime`, None if unknown
+    """
+    extensions, preferred = __extensions(mime)
+    o_ext = os.path.splitext(filename)[-1].lower()
+    if o_ext in extensions:
+        return o_ext
+    return preferred
+
 
-    o_ext = os.path.splitext(filename)[-1]
-    guess_extensions = difflib.get_close_matches(word=o_ext, possibilities=extensions, n=1)
-    if len(guess_extensions) > 0:
-        return guess_extensions[0]
-
-    guess_extension = None
-    guess_extensions = difflib.get_close_matches(word=forward, possibilities=extensions, n=1)
-    if len(guess_extensions) > 0:
-        return guess_extensions[0]
-    length = 0
-    for ext in extensions:
-        if forward == ext or forward == forward_ext:
-            return ext
-        this_length = len(ext)
-        if this_length > length:
-            length = this_length
-            guess_extension = ext
-    return guess_extension
+def __extensions(mime):
+    """
+    :return: <extensions registered for `mime`, the preferred one>, from a table filled once per MIME
+    """
+    entry = __extension_table.get(mime)
+    if entry is not None:
+        return entry
+    extensions = mimetypes.guess_all_extensions(type=mime)
+    if not extensions:
+        # unknown types come from clients, they are not kept
+        return (), None
+    # the registered extension closest to the subtype (computed once here, not per call), else the longest one
+    close = difflib.get_close_matches(word=mime.split(sep='/')[-1], possibilities=extensions, n=1)
+    preferred = close[0] if close else max(extensions, key=len)
+    entry = (frozenset(extensions), preferred)
+    with __extension_lock:
+        __extension_table[mime] = entry
+    return entry
 
 
 def support_image_compress(mime, extension):
@@ -126,87 +174,104 @@ def support_image_compress(mime, extension):
         return False
 
 
-def exif_data(filename):
+def exif_data(filename=None, fd=None, partial=False):
+    """
+    :param filename: file path
+    :param fd: seekable file object, used instead of `filename` (e.g. the header kept while uploading)
+    :param partial: `fd` only holds the leading bytes of the file, tags beyond them are skipped
+    """
+    if fd is not None:
+        fd.seek(0)
+        try:
+            with Metrics.stage('exif'):
+                return __exif_data(fd)
+        except Exception as ex:
+            if not partial:
+                raise
+            logging.info('exif_data skip truncated header: %s', ex)
+            return {}
     try:
         fd = open(filename, 'rb')
-
-        exif = {}
-        data = exifread.process_file(fd)
-        if data:
-            try:
-                original = {}
-                for key in data:
-                    ifd_tag = data[key]
-                    if isinstance(ifd_tag, IfdTag):
-
-                        if isinstance(ifd_tag.values, list):
-                            values = []
-                            for item in ifd_tag.values:
-                                if isinstance(item, Ratio):
-                                    values.append(item.__repr__())
-                                else:
-                                    values.append(item)
-                        else:
-                            values = ifd_tag.values
-
-                        original[key] = {
-                            'field_length': ifd_tag.field_length,
-                            'field_offset': ifd_tag.field_offset,
-                            'field_type': ifd_tag.field_type,
-                            'tag': ifd_tag.tag,
-                            'printable': ifd_tag.printable,
-                            'values': values
-                        }
-                exif.update(original=original)
-
-                if 'Image Orientation' in data:
-                    t = data['Image Orientation']
-                    exif.update(orientation=t.values[0] if len(t.values) > 0 else 0)
-
-                # 拍摄时间
-                if 'EXIF DateTimeOriginal' in data:
-                    t = data['EXIF DateTimeOriginal']
-
-                    # 转换为时间字符串
-                    t = str(t).replace("-", ":")
-
-                    # 转为时间数组
-                    time_array = time.strptime(t, '%Y:%m:%d %H:%M:%S')
-
-                    # 转化为时间戳
-                    timestamp = time.mktime(time_array) * 1000
-
-                    exif.update(timestamp=timestamp)
-                # # 如果没有取得 exif ，则用图像的创建日期，作为拍摄日期
-                # state = os.stat(filename)
-                # return time.strftime("%Y-%m-%d", time.localtime(state[-2]))
-
-                # 纬度 和 经度
-                if 'GPS GPSLongitudeRef' in data and 'GPS GPSLongitudeRef' in data:
-                    # 纬度
-                    lat_ref = data["GPS GPSLatitudeRef"].printable
-                    lat = data["GPS GPSLatitude"].printable[1:-1].replace(" ", "").replace("/", ",").split(",")
-                    lat = float(lat[0]) + float(lat[1]) / 60 + float(lat[2]) / float(lat[3]) / 3600
-                    if lat_ref != "N":
-                        lat = lat * (-1)
-
-                    # 经度
-                    lon_ref = data["GPS GPSLongitudeRef"].printable
-                    lon = data["GPS GPSLongitude"].printable[1:-1].replace(" ", "").replace("/", ",").split(",")
-                    lon = float(lon[0]) + float(lon[1]) / 60 + float(lon[2]) / float(lon[3]) / 3600
-                    if lon_ref != "E":
-                        lon = lon * (-1)
-
-                    exif.update(gps_lalo='%f,%f' % (lat, lon))
-                return exif
-            except Exception as ex:
-                logging.error(ex, exc_info=True)
-                return exif
-            finally:
-                fd.close()
-        return exif
     except Exception as ex:
-        raise "exif_data open file[%s] failed %s\n" % (filename, str(ex))
+        raise Exception("exif_data open file[%s] failed %s\n" % (filename, str(ex)))
+    with fd, Metrics.stage('exif'):
+        return __exif_data(fd)
+
+
+def __exif_data(fd):
+    exif = {}
+    data = exifread.process_file(fd)
+    if data:
+        try:
+            original = {}
+            for key in data:
+                ifd_tag = data[key]
+                if isinstance(ifd_tag, IfdTag):
+
+                    if isinstance(ifd_tag.values, list):
+                        values = []
+                        for item in ifd_tag.values:
+                            if isinstance(item, Ratio):
+                                values.append(item.__repr__())
+                            else:
+                                values.append(item)
+                    else:
+                        values = ifd_tag.values
+
+                    original[key] = {
+                        'field_length': ifd_tag.field_length,
+                        'field_offset': ifd_tag.field_offset,
+                        'field_type': ifd_tag.field_type,
+                        'tag': ifd_tag.tag,
+                        'printable': ifd_tag.printable,
+                        'values': values
+                    }
+            exif.update(original=original)
+
+            if 'Image Orientation' in data:
+                t = data['Image Orientation']
+                exif.update(orientation=t.values[0] if len(t.values) > 0 else 0)
+
+            # 拍摄时间
+            if 'EXIF DateTimeOriginal' in data:
+                t = data['EXIF DateTimeOriginal']
+
+                # 转换为时间字符串
+                t = str(t).replace("-", ":")
+
+                # 转为时间数组
+                time_array = time.strptime(t, '%Y:%m:%d %H:%M:%S')
+
+                # 转化为时间戳
+                timestamp = time.mktime(time_array) * 1000
+
+                exif.update(timestamp=timestamp)
+            # # 如果没有取得 exif ，则用图像的创建日期，作为拍摄日期
+            # state = os.stat(filename)
+            # return time.strftime("%Y-%m-%d", time.localtime(state[-2]))
+
+            # 纬度 和 经度
+            if 'GPS GPSLongitudeRef' in data and 'GPS GPSLongitudeRef' in data:
+                # 纬度
+                lat_ref = data["GPS GPSLatitudeRef"].printable
+                lat = data["GPS GPSLatitude"].printable[1:-1].replace(" ", "").replace("/", ",").split(",")
+                lat = float(lat[0]) + float(lat[1]) / 60 + float(lat[2]) / float(lat[3]) / 3600
+                if lat_ref != "N":
+                    lat = lat * (-1)
+
+                # 经度
+                lon_ref = data["GPS GPSLongitudeRef"].printable
+                lon = data["GPS GPSLongitude"].printable[1:-1].replace(" ", "").replace("/", ",").split(",")
+                lon = float(lon[0]) + float(lon[1]) / 60 + float(lon[2]) / float(lon[3]) / 3600
+                if lon_ref != "E":
+                    lon = lon * (-1)
+
+                exif.update(gps_lalo='%f,%f' % (lat, lon))
+            return exif
+        except Exception as ex:
+            logging.error(ex, exc_info=True)
+            return exif
+    return exif
 
 
 def audio_type(mime, mime_guess):
@@ -246,4 +311,42 @@ def audio_cover(path):
     if 'covr' in tags:
         # 这通常是m4a文件
         return tags['covr'][0]
-    return None
\ No newline at end of file
+    return None
+
+
+def audio_art(path):
+    """
+    Locate the cover art of an audio file, recorded in MetaIndex at upload so covers need no tag parsing later.
+    :return: dict of art_offset and art_length of the picture bytes inside the file (None when they are not stored
+             as is, e.g. base64 in Ogg comments or an unsynchronised ID3 tag), art_mime and art_hash,
+             art_hash '' when the file has no art, None if it can not be parsed
+    """
+    try:
+        data = audio_cover(path)
+    except Exception as ex:
+        logging.error(ex, exc_info=True)
+        return None
+    if not data:
+        return {'art_offset': None, 'art_length': None, 'art_mime': None, 'art_hash': ''}
+    data = bytes(data)
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+        offset = m.find(data)
+    digest = Digest.new()
+    digest.update(data)
+    return {
+        'art_offset': offset if offset >= 0 else None,
+        'art_length': len(data) if offset >= 0 else None,
+        'art_mime': mime_type(buffer=BytesIO(data[:4096])),
+        'art_hash': digest.hexdigest(),
+    }
+
+
+def indexed_art(path):
+    """
+    :return: the `audio_art` fields indexed for the stored file `path`, None if it was not indexed
+    """
+    name = os.path.basename(path)
+    info = MetaIndex.get(name, path) if StoreLayout.is_store_path(name, path) else None
+    if info is None or info['art_hash'] is None:
+        return None
+    return {key: info[key] for key in ('art_offset', 'art_length', 'art_mime', 'art_hash')}
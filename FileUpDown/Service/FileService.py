@@ -3,23 +3,29 @@
 """
 This module handles file upload and download procedure.
 """
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 import os
+import re
 import shutil
+import threading
 
-import magic
 import uuid
 import GlobalConfigContext
 import logging as L
 logging = L.getLogger('file')
 
-from Service import FileInfo
-import hashlib
+from Service import FileInfo, Digest, MetaIndex, CacheManager, Pregenerate, BlobStore, StoreLayout, Reaper
+from io import BytesIO
 from flask import request
 
 RGThumbnailName = '_thumbnail'
 RGQualityName = '_quality'
 RGCompressCacheThumbName = '_compressCacheThumbnail'
 RGCompressCacheGifName = '_compressCacheThumbnail.gif'
+RGCompressCacheAnimatedWebpName = '_compressCacheThumbnail.webp'
+
+__batch_lock = threading.Lock()
+__batch_executor = None
 
 # quant_file = GlobalConfigContext.Base_Directory + '/pngquant'
 # pngquant.config(quant_file=quant_file, max_quality=80, min_quality=65)
@@ -27,20 +33,41 @@ RGCompressCacheGifName = '_compressCacheThumbnail.gif'
 
 def perform_upload(data):
     """
-    Perform upload a file to server at `{FileStore_Directory}/{filename}`.
+    Perform upload a file to server at `{FileStore_Directory}/{filename}` (see StoreLayout for the shard).
     If there already exists a file with the same name,
     a random uuid string will be added at the front of
     the file preventing overwriting.
+    The stream is read only once: digest, size, MIME and EXIF are taken while writing.
     :param data: file object
     :return: tuple of <success flag, actual filename/exception>
     """
-    f = None
-    filename = None
+    staging_path = os.path.join(GlobalConfigContext.FileStore_Directory, '.uploading_' + uuid.uuid4().hex)
     try:
-        mime = FileInfo.mime_type(buffer=data.stream, mime_guess=data.mimetype)
-        filename = data.filename
-        name = os.path.splitext(filename)[0]
-        extension = FileInfo.extension(filename=filename, mime=mime, mime_guess=data.mimetype)
+        # stream write
+        digest = __write_to_path(path=staging_path, stream=data.stream)
+        return perform_register(staging_path, data.filename, data.mimetype, digest)
+    except Exception as ex:
+        logging.error(ex, exc_info=True)
+        return False, str(ex), data.filename, None, 0, 0, ""
+    finally:
+        if os.path.exists(staging_path):
+            os.remove(staging_path)
+
+
+def perform_register(staging_path, filename, mime_guess, digest):
+    """
+    Move a fully written file into the store under a name that does not exist yet, and index its metadata.
+    :param staging_path: the file, on the same file system as `FileStore_Directory`
+    :param filename: name given by the client
+    :param digest: Digest.StreamDigest that read the whole file
+    :return: tuple of <success flag, message, actual filename, mime, exif, size, hash>
+    """
+    try:
+        header = BytesIO(digest.header)
+        mime = FileInfo.mime_type(buffer=header, mime_guess=mime_guess)
+        # only the last component of the client name, without what StoreLayout.check_name refuses
+        name = re.sub(r'\.{2,}', '.', re.split(r'[/\\\0]', os.path.splitext(filename)[0])[-1]).lstrip('.')
+        extension = FileInfo.extension(filename=filename, mime=mime, mime_guess=mime_guess)
         random = ''
         upload_path = ''
 
@@ -49,35 +76,55 @@ def perform_upload(data):
             random = "_" + str(uuid.uuid1())
             # filename = secure_filename(prefix + data.filename)  # Origin Flask secure function not support CHS
             filename = name + random + extension
-            upload_path = os.path.join(GlobalConfigContext.FileStore_Directory, filename)
+            upload_path = StoreLayout.store_path(filename)
             condition = os.path.exists(upload_path)
         name = name + random
+        os.makedirs(os.path.dirname(upload_path), exist_ok=True)
 
-        # stream write
-        if not __write_to_path(path=upload_path, stream=data.stream):
-            raise Exception("write failed")
+        file_hash = digest.hexdigest()
+        duplicate = None
+        if BlobStore.enabled():
+            if BlobStore.store(staging_path, upload_path, file_hash, digest.algorithm):
+                # same bytes as a stored file: no extra space, no EXIF parsing, derivatives are shared
+                duplicate = MetaIndex.find_by_hash(file_hash, digest.algorithm)
+                if duplicate is None:
+                    duplicate = {'exif': FileInfo.exif_data(fd=header, partial=not digest.complete)}
+            BlobStore.link_cache_dir(__cache_link_dir(filename), upload_path, file_hash, digest.algorithm)
+        else:
+            os.rename(staging_path, upload_path)
 
-        exif = FileInfo.exif_data(upload_path)
-        file_size = os.path.getsize(upload_path)
-        return True, "", filename, mime, exif, file_size, __md5(upload_path)
+        if duplicate is not None:
+            exif = duplicate['exif']
+        else:
+            exif = FileInfo.exif_data(fd=header, partial=not digest.complete)
+        MetaIndex.put(filename, upload_path, mime=mime, extension=extension, exif=exif, hash=file_hash,
+                      hash_type=digest.algorithm, crc32=digest.crc32, **__audio_art(upload_path, mime, duplicate))
+        if duplicate is None:
+            Pregenerate.enqueue(filename)
+        return True, "", filename, mime, exif, digest.size, file_hash
     except Exception as ex:
-        logging.err(ex)
+        logging.error(ex, exc_info=True)
         return False, str(ex), filename, None, 0, 0, ""
-    finally:
-        if f is not None:
-            f.close()
+
+
+def __audio_art(path, mime, duplicate=None):
+    """
+    :param duplicate: MetaIndex row of the same content, whose art is reused
+    :return: MetaIndex art columns of an audio file (see FileInfo.audio_art), {} for anything else
+    """
+    if not FileInfo.audio_type(mime=mime, mime_guess=mime):
+        return {}
+    if duplicate is not None and duplicate.get('art_hash') is not None:
+        return {key: duplicate[key] for key in ('art_offset', 'art_length', 'art_mime', 'art_hash')}
+    return FileInfo.audio_art(path) or {}
 
 
 def __write_to_path(path, stream):
+    """
+    :return: Digest.StreamDigest of the written data
+    """
     with open(path, "wb") as f:
-        buffer_size = 4096
-        while f:
-            stream_buffer = stream.read(buffer_size)
-            if len(stream_buffer) == 0:
-                f.close()
-                return True
-            f.write(stream_buffer)
-    return False
+        return Digest.StreamDigest(f).copy_stream(stream)
 
 
 def __rotate_image_if_need(image, exif):
@@ -107,10 +154,12 @@ def perform_download(filename, at_import=False):
     :param at_import: file in import directory
     :return: tuple of <exist flag, file actual location>
     """
-    base_path = GlobalConfigContext.FileImport_Directory if at_import else GlobalConfigContext.FileStore_Directory
     paths = filename.split('/')
     filename = paths[0]
-    find_path = os.path.join(base_path, filename)
+    if at_import:
+        find_path = os.path.join(GlobalConfigContext.FileImport_Directory, filename)
+    else:
+        find_path = StoreLayout.store_path(filename)
     exist_flag = os.path.exists(find_path)
 
     paths.pop(0)
@@ -119,10 +168,32 @@ def perform_download(filename, at_import=False):
     return exist_flag, find_path, sub_path
 
 
-def perform_del(name):
-    path = os.path.join(GlobalConfigContext.FileStore_Directory, name)
-    paths = [path, get_file_cache_base_dir(name)]
+def perform_del(name, defer=False):
+    """
+    :param defer: hand the cache directory to the background Reaper, only the stored file is removed inline
+    """
+    path = StoreLayout.store_path(name)
+    cache_dir = __cache_link_dir(name)
+    paths = [path, cache_dir]
 
+    info = MetaIndex.get(name, path)
+    MetaIndex.delete(name)
+    Pregenerate.forget(name)
+    if os.path.islink(cache_dir):
+        # a name of deduplicated content: the blob and the shared derivatives go with the last name
+        shared_dir = os.path.realpath(cache_dir)
+        try:
+            os.unlink(cache_dir)
+            if info is None:
+                info = {'hash': Digest.file_digest(path), 'hash_type': GlobalConfigContext.Upload_Hash_Algorithm}
+            if not BlobStore.release(path, info['hash'], info['hash_type']):
+                return True
+        except Exception as ex:
+            logging.error(ex, exc_info=True)
+            return False
+        cache_dir = shared_dir
+        paths = [path, cache_dir]
+    CacheManager.forget_dir(cache_dir)
     result = True
     for path in paths:
         try:
@@ -130,7 +201,10 @@ def perform_del(name):
                 if os.path.isfile(path):
                     os.remove(path)
                 elif os.path.isdir(path):
-                    shutil.rmtree(path)
+                    if defer:
+                        Reaper.remove(path)
+                    else:
+                        shutil.rmtree(path)
             else:
                 pass
         except Exception as ex:
@@ -139,8 +213,87 @@ def perform_del(name):
     return result
 
 
+def perform_del_batch(names, defer=False):
+    """
+    Delete `names` on the batch thread pool.
+    :return: generator of <index in `names`, result> in completion order
+    """
+    return as_completed(lambda name: perform_del(name, defer=defer), names)
+
+
 def perform_info(name):
-    path = os.path.join(GlobalConfigContext.FileStore_Directory, name)
+    return perform_info_batch([name])[0]
+
+
+def perform_info_batch(names):
+    """
+    :return: list of <success flag, message, name, mime, exif, size, hash> in the order of `names`
+    """
+    results = [None] * len(names)
+    for index, result in iter_info_batch(names):
+        results[index] = result
+    return results
+
+
+def iter_info_batch(names):
+    """
+    Answer from the metadata index with one query, only names missing from it (or stale) read their file,
+    on the batch thread pool.
+    :return: generator of <index in `names`, <success flag, message, name, mime, exif, size, hash>>,
+             indexed names first, then the others in completion order
+    """
+    paths = [StoreLayout.store_path(name) for name in names]
+    indexed = MetaIndex.get_many(names, paths)
+    missing = []
+    for index, (name, path) in enumerate(zip(names, paths)):
+        info = indexed.get(name)
+        if info is not None and info['hash_type'] == GlobalConfigContext.Upload_Hash_Algorithm:
+            yield index, (True, "", name, info['mime'], info['exif'], info['size'], info['hash'])
+        else:
+            missing.append((index, name, path))
+    for i, result in as_completed(lambda item: __perform_info_from_file(item[1], item[2]), missing):
+        yield missing[i][0], result
+
+
+def __batch_pool():
+    global __batch_executor
+    with __batch_lock:
+        if __batch_executor is None:
+            __batch_executor = ThreadPoolExecutor(max_workers=GlobalConfigContext.Batch_Workers,
+                                                  thread_name_prefix='batch')
+        return __batch_executor
+
+
+def as_completed(fn, items, executor=None, workers=None):
+    """
+    Run `fn(item)` for each of `items` on the shared batch pool, with at most `2 * Batch_Workers` submitted
+    at a time so one large batch does not queue ahead of every other request.
+    Closing the generator early (e.g. the client of a stream went away) cancels what has not started.
+    :param executor: another pool to run on instead, of `workers` threads
+    :return: generator of <index in `items`, result> in completion order
+    """
+    if executor is None:
+        executor, workers = __batch_pool(), GlobalConfigContext.Batch_Workers
+    window = 2 * workers
+    iterator = enumerate(items)
+    pending = {}
+    try:
+        while True:
+            for index, item in iterator:
+                pending[executor.submit(fn, item)] = index
+                if len(pending) >= window:
+                    break
+            if not pending:
+                return
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield pending.pop(future), future.result()
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+def __perform_info_from_file(name, path):
     file_size = 0
     mime = None
     exif = None
@@ -149,10 +302,13 @@ def perform_info(name):
     msg = ""
     try:
         if os.path.exists(path):
-            mime = magic.from_file(path, mime=True)
+            mime = FileInfo.mime_type(path=path)
             file_size = os.path.getsize(path)
             exif = FileInfo.exif_data(path)
-            md5 = __md5(path)
+            md5 = Digest.file_digest(path)
+            extension = FileInfo.extension(filename=name, mime=mime, mime_guess=None)
+            MetaIndex.put(name, path, mime=mime, extension=extension, exif=exif, hash=md5,
+                          hash_type=GlobalConfigContext.Upload_Hash_Algorithm, **__audio_art(path, mime))
             result = True
         else:
             pass
@@ -163,24 +319,22 @@ def perform_info(name):
         return result, msg, name, mime, exif, file_size, md5
 
 
-def __md5(filename):
-    m = hashlib.md5()
-    with open(filename, 'rb') as f:
-        for line in f:
-            m.update(line)
-    md5code = m.hexdigest()
-    return md5code
-
-
 def get_file_cache_base_dir(filename, mk_dir=False):
-    basename = os.path.basename(filename)
-    basename = os.path.splitext(basename)[0]
-    base_dir = os.path.join(GlobalConfigContext.FileCache_Directory, basename)
+    base_dir = __cache_link_dir(filename)
+    if os.path.islink(base_dir):
+        # deduplicated content, see BlobStore.link_cache_dir
+        base_dir = os.path.realpath(base_dir)
     if mk_dir:
         os.makedirs(base_dir, exist_ok=True)
     return base_dir
 
 
+def __cache_link_dir(filename):
+    basename = os.path.basename(filename)
+    basename = os.path.splitext(basename)[0]
+    return StoreLayout.cache_dir(basename)
+
+
 def get_file_cache_path(filename, cache_name, mk_dir=False):
     base_dir = get_file_cache_base_dir(filename, mk_dir)
     return os.path.join(base_dir, cache_name)
@@ -0,0 +1,182 @@
+# encoding: utf-8
+"""
+Resource governor of the transforms.
+Inputs are checked against `Image_Max_Pixels` / `Image_Max_Frames` from their headers, before anything is decoded,
+and `TooLarge` lets the caller degrade (serve the original, a first-frame still) instead of decoding them.
+Transform subprocesses (gifsicle) run under the `Subprocess_*_Limit` rlimits.
+The peak RSS of every pool job (its worker and the subprocesses it ran) is measured, and the largest of a request
+is sent back in `X-Transform-Peak-RSS` (see Gateway.MetricsGateway). Linux only, elsewhere nothing is measured.
+"""
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+
+import GlobalConfigContext
+import logging as L
+logging = L.getLogger('file')
+
+__local = threading.local()
+
+
+class TooLarge(Exception):
+    """
+    An input is past a governor limit, `reason` is 'pixels' or 'frames'.
+    """
+
+    def __init__(self, reason, value, limit):
+        # every argument goes to Exception so it pickles back from a pool worker
+        super().__init__(reason, value, limit)
+        self.reason = reason
+        self.value = value
+        self.limit = limit
+
+    def __str__(self):
+        return '%s %d over the limit of %d' % (self.reason, self.value, self.limit)
+
+
+def check_image(width, height, frames=1):
+    """
+    :raise TooLarge: when the image has more pixels than `Image_Max_Pixels` or more frames than `Image_Max_Frames`
+    """
+    if not within_limits(width, height):
+        raise TooLarge('pixels', width * height, GlobalConfigContext.Image_Max_Pixels)
+    limit = GlobalConfigContext.Image_Max_Frames
+    if limit is not None and frames > limit:
+        raise TooLarge('frames', frames, limit)
+
+
+def check_animation(width, height, frames, side):
+    """
+    `check_image` for an animation resized to fit in `side` x `side` in this process, whose resized frames are all
+    held until encoded: together they may not have more than `Image_Max_Pixels` either.
+    :raise TooLarge:
+    """
+    check_image(width, height, frames)
+    limit = GlobalConfigContext.Image_Max_Pixels
+    if limit is None:
+        return
+    scale = min(1, side / max(width, height, 1))
+    frame_pixels = max(1, int(width * scale) * int(height * scale))
+    if frames * frame_pixels > limit:
+        raise TooLarge('frames', frames, limit // frame_pixels)
+
+
+def within_limits(width, height):
+    limit = GlobalConfigContext.Image_Max_Pixels
+    return limit is None or width * height <= limit
+
+
+def run(command):
+    """
+    Run `command` under the `Subprocess_Memory_Limit` and `Subprocess_CPU_Limit` rlimits, its peak RSS is recorded.
+    The limits are set by a small interpreter that then execs `command` (see `__limit_exec`): no `preexec_fn`,
+    which is not safe in a process with threads. The recorded peak includes that interpreter (about 10 MB).
+    :return: <exit status, stderr bytes>, the status is minus the signal when killed (e.g. -9 past the CPU limit)
+    :raise FileNotFoundError: when the program of `command` is not installed
+    """
+    executable = shutil.which(command[0])
+    if executable is None:
+        raise FileNotFoundError('%s not found' % command[0])
+    limits = [__limit_argument(GlobalConfigContext.Subprocess_Memory_Limit),
+              __limit_argument(GlobalConfigContext.Subprocess_CPU_Limit)]
+    with tempfile.TemporaryFile() as err:
+        process = subprocess.Popen([sys.executable, '-I', '-S', '-c', __limit_exec] + limits + [executable] + command,
+                                   stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=err)
+        try:
+            # wait4 rather than wait, for the rusage of this child alone
+            _, status, usage = os.wait4(process.pid, 0)
+        except BaseException:
+            process.kill()
+            process.wait()
+            raise
+        process.returncode = os.waitstatus_to_exitcode(status)
+        record(usage.ru_maxrss * 1024)
+        err.seek(0)
+        return process.returncode, err.read()
+
+
+# argv: memory limit, CPU limit ('' for none), executable, then the command line (argv[0] first)
+__limit_exec = """
+import os, resource, sys
+for kind, value in ((resource.RLIMIT_AS, sys.argv[1]), (resource.RLIMIT_CPU, sys.argv[2])):
+    if value:
+        soft, hard = resource.getrlimit(kind)
+        value = int(value) if hard == resource.RLIM_INFINITY else min(int(value), hard)
+        resource.setrlimit(kind, (value, hard))
+os.execv(sys.argv[3], sys.argv[4:])
+"""
+
+
+def __limit_argument(value):
+    return '' if value is None else str(int(value))
+
+
+def limit_worker():
+    """
+    Pool worker initializer: cap the worker address space at `Transform_Worker_Memory_Limit`.
+    """
+    __set_limit(resource.RLIMIT_AS, GlobalConfigContext.Transform_Worker_Memory_Limit)
+
+
+def __set_limit(kind, value):
+    if value is None:
+        return
+    soft, hard = resource.getrlimit(kind)
+    if hard != resource.RLIM_INFINITY:
+        value = min(value, hard)
+    resource.setrlimit(kind, (value, hard))
+
+
+def begin():
+    """
+    Start accounting the peak RSS of this thread's work (a request, a pool job).
+    """
+    __local.peak = 0
+
+
+def record(peak):
+    """
+    :param peak: bytes, kept when larger than what this thread recorded since `begin`
+    """
+    if peak and peak > getattr(__local, 'peak', 0):
+        __local.peak = peak
+
+
+def end():
+    """
+    :return: largest peak RSS in bytes recorded since `begin`, None if nothing was measured
+    """
+    peak = getattr(__local, 'peak', 0)
+    __local.peak = 0
+    return peak or None
+
+
+def reset_process_peak():
+    """
+    Reset the peak RSS of this process (Linux 4.0+), for a pool worker about to run a job.
+    :return: whether `process_peak` then measures from now on
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def process_peak():
+    """
+    :return: peak RSS of this process in bytes (since `reset_process_peak`), None if unknown
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
@@ -0,0 +1,133 @@
+# encoding: utf-8
+"""
+This module keeps an on-disk index of stored file metadata (SQLite at `GlobalConfigContext.FileMeta_Database`).
+Rows are written at upload time and are only trusted while the file's mtime and size still match.
+"""
+import json
+import os
+import sqlite3
+import time
+
+import GlobalConfigContext
+from Service import Database
+import logging as L
+logging = L.getLogger('file')
+
+# name, sql type; new columns are appended, `Database.add_columns` adds them to existing databases
+__columns = [
+    ('name', 'TEXT PRIMARY KEY'),
+    ('mtime_ns', 'INTEGER'),
+    ('size', 'INTEGER'),
+    ('mime', 'TEXT'),
+    ('exif', 'TEXT'),
+    ('hash', 'TEXT'),
+    ('hash_type', 'TEXT'),
+    ('updated', 'REAL'),
+    ('extension', 'TEXT'),
+    ('crc32', 'INTEGER'),
+    # embedded cover art of audio files, see FileInfo.audio_art; art_hash '' for audio without art
+    ('art_offset', 'INTEGER'),
+    ('art_length', 'INTEGER'),
+    ('art_mime', 'TEXT'),
+    ('art_hash', 'TEXT'),
+]
+__json_columns = {'exif'}
+
+
+def __connection():
+    return Database.connection(GlobalConfigContext.FileMeta_Database, init=__init_schema)
+
+
+def __init_schema(conn):
+    Database.add_columns(conn, 'file_meta', __columns)
+    conn.execute('CREATE INDEX IF NOT EXISTS file_meta_hash ON file_meta (hash)')
+
+
+def __row_to_dict(row):
+    info = dict(row)
+    for column in __json_columns:
+        if info.get(column) is not None:
+            info[column] = json.loads(info[column])
+    return info
+
+
+def __stat(path):
+    try:
+        return os.stat(path)
+    except OSError:
+        return None
+
+
+def __valid(info, st):
+    return st is not None and info['mtime_ns'] == st.st_mtime_ns and info['size'] == st.st_size
+
+
+def put(name, path, **fields):
+    """
+    Insert or replace the row of `name`, stamping it with the current mtime and size of `path`.
+    :param fields: column values, e.g. mime, exif, hash, hash_type
+    """
+    st = os.stat(path)
+    row = dict(fields)
+    row.update(name=name, mtime_ns=st.st_mtime_ns, size=st.st_size, updated=time.time())
+    for column in __json_columns:
+        if column in row and row[column] is not None:
+            row[column] = json.dumps(row[column], default=str)
+    keys = list(row.keys())
+    try:
+        __connection().execute(
+            'INSERT OR REPLACE INTO file_meta (%s) VALUES (%s)' % (', '.join(keys), ', '.join('?' * len(keys))),
+            [row[k] for k in keys])
+    except sqlite3.Error as ex:
+        logging.error(ex, exc_info=True)
+
+
+def get(name, path):
+    """
+    :return: dict of the indexed row, None if missing or stale
+    """
+    return get_many([name], [path]).get(name)
+
+
+def get_many(names, paths):
+    """
+    Look up all `names` with one query.
+    :param paths: file path of each name, stat-ed to validate the rows
+    :return: dict of name -> row, missing or stale names are left out
+    """
+    if not names:
+        return {}
+    try:
+        rows = __connection().execute(
+            'SELECT * FROM file_meta WHERE name IN (SELECT value FROM json_each(?))', (json.dumps(list(names)),))
+        found = {row['name']: row for row in rows}
+    except sqlite3.Error as ex:
+        logging.error(ex, exc_info=True)
+        return {}
+    results = {}
+    for name, path in zip(names, paths):
+        row = found.get(name)
+        if row is not None and __valid(row, __stat(path)):
+            results[name] = __row_to_dict(row)
+    return results
+
+
+def find_by_hash(file_hash, hash_type):
+    """
+    :return: dict of the latest row with this content hash, not validated against any file, None if none
+    """
+    try:
+        row = __connection().execute(
+            'SELECT * FROM file_meta WHERE hash = ? AND hash_type = ? ORDER BY updated DESC LIMIT 1',
+            (file_hash, hash_type)).fetchone()
+    except sqlite3.Error as ex:
+        logging.error(ex, exc_info=True)
+        return None
+    return __row_to_dict(row) if row is not None else None
+
+
+def delete(name):
+    try:
+        __connection().execute('DELETE FROM file_meta WHERE name = ?', (name,))
+    except sqlite3.Error as ex:
+        logging.error(ex, exc_info=True)
@@ -0,0 +1,172 @@
+# encoding: utf-8
+"""
+In-process metrics registry, exposed in the Prometheus text format at /metrics (see Gateway.MetricsGateway).
+Counters, gauges and histograms are declared below and updated by name with their label values:
+    Metrics.inc('rg_cache_lookups_total', kind='thumbnail', result='hit')
+    with Metrics.stage('encode'):
+        im.save(...)
+Every process keeps its own registry, with a multi-process server scrape each worker.
+Stages timed in the transform pool are captured there and merged into the registry of the caller, see TransformExecutor.
+"""
+from contextlib import contextmanager
+import threading
+import time
+
+import GlobalConfigContext
+
+__lock = threading.Lock()
+__local = threading.local()
+__families = {}
+
+__latency_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+__memory_buckets = tuple(m * 1024 * 1024 for m in (32, 64, 128, 256, 512, 1024, 2048, 4096))
+
+
+def __declare(name, kind, help, buckets=None):
+    __families[name] = {'kind': kind, 'help': help, 'buckets': buckets, 'values': {}}
+
+
+__declare('rg_http_requests_total', 'counter', 'Requests by route, method and status.')
+__declare('rg_http_request_duration_seconds', 'histogram',
+          'Time from the start of a request to the end of its response body, by route.', __latency_buckets)
+__declare('rg_http_received_bytes_total', 'counter', 'Request body bytes read by the application, by route.')
+__declare('rg_http_sent_bytes_total', 'counter', 'Response body bytes taken by the server, by route.')
+__declare('rg_http_requests_in_flight', 'gauge', 'Requests whose response body is not finished yet.')
+__declare('rg_http_streams_in_flight', 'gauge', 'Streamed response bodies still being sent, by route.')
+__declare('rg_stage_seconds', 'histogram',
+          'Time spent in one step of a request or transform: mime, exif, hash, decode, encode, gifsicle, cv2_seek.',
+          __latency_buckets)
+__declare('rg_cache_lookups_total', 'counter', 'Derivative cache lookups by derivative kind and result (hit, miss).')
+__declare('rg_transform_jobs_total', 'counter', 'Transform pool jobs by function and outcome (ok, error, busy).')
+__declare('rg_transform_peak_rss_bytes', 'histogram',
+          'Peak RSS of a transform pool job, its worker and subprocesses, by function.', __memory_buckets)
+__declare('rg_http_request_peak_rss_bytes', 'histogram',
+          'Largest transform peak RSS of a request, by route (requests running no transform are not counted).',
+          __memory_buckets)
+__declare('rg_governor_refused_total', 'counter',
+          'Inputs not decoded for being past a governor limit, by reason (pixels, frames) and what was served instead.')
+
+
+def enabled():
+    return GlobalConfigContext.Metrics_Enabled
+
+
+def inc(name, value=1, **labels):
+    """
+    Add `value` to a counter, or to a gauge (negative to decrease it).
+    """
+    if not enabled():
+        return
+    family = __families[name]
+    key = tuple(sorted(labels.items()))
+    with __lock:
+        family['values'][key] = family['values'].get(key, 0) + value
+
+
+def observe(name, value, **labels):
+    """
+    Record one sample of a histogram.
+    """
+    if not enabled():
+        return
+    family = __families[name]
+    key = tuple(sorted(labels.items()))
+    buckets = family['buckets']
+    with __lock:
+        state = family['values'].get(key)
+        if state is None:
+            state = family['values'][key] = [[0] * len(buckets), 0.0, 0]
+        for i, bound in enumerate(buckets):
+            if value <= bound:
+                state[0][i] += 1
+                break
+        state[1] += value
+        state[2] += 1
+
+
+def observe_stage(stage, seconds):
+    """
+    Record `seconds` spent in `stage`, kept aside instead while a `capture` of this thread is open.
+    """
+    samples = getattr(__local, 'capture', None)
+    if samples is not None:
+        samples.append((stage, seconds))
+        return
+    observe('rg_stage_seconds', seconds, stage=stage)
+
+
+@contextmanager
+def stage(name):
+    """
+    Time the block as one sample of `rg_stage_seconds{stage=name}`.
+    """
+    if not enabled():
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(name, time.perf_counter() - start)
+
+
+@contextmanager
+def capture():
+    """
+    Collect the stages timed by this thread into the yielded list, e.g. in a transform pool worker
+    whose own registry is never scraped. The caller hands the list to `merge`.
+    """
+    previous = getattr(__local, 'capture', None)
+    samples = __local.capture = []
+    try:
+        yield samples
+    finally:
+        __local.capture = previous
+
+
+def merge(samples):
+    """
+    :param samples: list of <stage, seconds> from `capture`
+    """
+    for name, seconds in samples:
+        observe_stage(name, seconds)
+
+
+def render():
+    """
+    :return: every metric in the Prometheus text exposition format 0.0.4
+    """
+    lines = []
+    with __lock:
+        for name, family in __families.items():
+            lines.append('# HELP %s %s' % (name, family['help']))
+            lines.append('# TYPE %s %s' % (name, family['kind']))
+            for key, value in sorted(family['values'].items()):
+                if family['kind'] != 'histogram':
+                    lines.append('%s%s %s' % (name, __labels(key), __number(value)))
+                    continue
+                counts, total, count = value
+                cumulative = 0
+                for bound, n in zip(family['buckets'], counts):
+                    cumulative += n
+                    lines.append('%s_bucket%s %d' % (name, __labels(key + (('le', __number(bound)),)), cumulative))
+                lines.append('%s_bucket%s %d' % (name, __labels(key + (('le', '+Inf'),)), count))
+                lines.append('%s_sum%s %s' % (name, __labels(key), __number(total)))
+                lines.append('%s_count%s %d' % (name, __labels(key), count))
+    return '\n'.join(lines) + '\n'
+
+
+def __labels(key):
+    if not key:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, __escape(v)) for k, v in key)
+
+
+def __escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def __number(value):
+    if isinstance(value, float) and not value.is_integer():
+        return repr(value)
+    return str(int(value))
@@ -0,0 +1,219 @@
+# encoding: utf-8
+"""
+Post-upload job queue building the standard derivatives (`Pregenerate_Sides` thumbnails, audio/video/EPUB covers)
+in the background, so the first viewer of an upload does not pay the decode.
+Jobs are rows of `derivative_job` in `GlobalConfigContext.FileMeta_Database`, so they survive a restart:
+a job left 'running' by a dead worker is picked up again once its lease expires, and every step
+is idempotent because derivatives are looked up in the cache before being built.
+"""
+from functools import partial
+import os
+import sqlite3
+import threading
+import time
+
+import GlobalConfigContext
+from Service import Database
+from Service import Derivative
+from Service import FileInfo
+from Service import Governor
+from Service import MetaIndex
+from Service import StoreLayout
+from Service import TransformExecutor
+import logging as L
+logging = L.getLogger('file')
+
+__columns = [
+    ('name', 'TEXT PRIMARY KEY'),
+    ('state', 'TEXT'),
+    ('total', 'INTEGER DEFAULT 0'),
+    ('finished', 'INTEGER DEFAULT 0'),
+    ('attempts', 'INTEGER DEFAULT 0'),
+    ('error', 'TEXT'),
+    ('updated', 'REAL'),
+]
+
+__wakeup = threading.Event()
+__threads = []
+__threads_lock = threading.Lock()
+
+
+def __connection():
+    return Database.connection(GlobalConfigContext.FileMeta_Database, init=__init_schema)
+
+
+def __init_schema(conn):
+    Database.add_columns(conn, 'derivative_job', __columns)
+    conn.execute('CREATE INDEX IF NOT EXISTS derivative_job_state ON derivative_job (state, updated)')
+
+
+def enqueue(name):
+    """
+    Queue the standard derivatives of the stored file `name`.
+    """
+    if not GlobalConfigContext.Pregenerate_Enabled:
+        return
+    try:
+        __connection().execute(
+            "INSERT OR REPLACE INTO derivative_job (name, state, total, finished, attempts, error, updated) VALUES (?, 'pending', 0, 0, 0, NULL, ?)",
+            (name, time.time()))
+        __wakeup.set()
+    except sqlite3.Error as ex:
+        logging.error(ex, exc_info=True)
+
+
+def forget(name):
+    try:
+        __connection().execute('DELETE FROM derivative_job WHERE name = ?', (name,))
+    except sqlite3.Error as ex:
+        logging.error(ex, exc_info=True)
+
+
+def progress(name):
+    """
+    :return: dict of state ('pending', 'running', 'done', 'failed'), total and finished steps, None if never queued
+    """
+    row = __connection().execute('SELECT * FROM derivative_job WHERE name = ?', (name,)).fetchone()
+    return dict(row) if row is not None else None
+
+
+def start():
+    """
+    Start `Pregenerate_Workers` background workers in this process.
+    """
+    if not GlobalConfigContext.Pregenerate_Enabled:
+        return
+    with __threads_lock:
+        if __threads:
+            return
+        for i in range(GlobalConfigContext.Pregenerate_Workers):
+            thread = threading.Thread(target=__worker, name='pregenerate-%d' % i, daemon=True)
+            thread.start()
+            __threads.append(thread)
+
+
+def __worker():
+    while True:
+        try:
+            job = __claim()
+        except sqlite3.Error as ex:
+            logging.error(ex, exc_info=True)
+            job = None
+        if job is None:
+            __wakeup.wait(GlobalConfigContext.Pregenerate_Poll_Interval)
+            __wakeup.clear()
+            continue
+        __run(job['name'], job['attempts'])
+
+
+def __claim():
+    now = time.time()
+    conn = __connection()
+    with Database.transaction(conn):
+        row = conn.execute(
+            "SELECT name, attempts FROM derivative_job WHERE state = 'pending' OR (state = 'running' AND updated < ?) ORDER BY updated LIMIT 1",
+            (now - GlobalConfigContext.Pregenerate_Lease,)).fetchone()
+        if row is None:
+            return None
+        conn.execute(
+            "UPDATE derivative_job SET state = 'running', attempts = attempts + 1, updated = ? WHERE name = ?",
+            (now, row['name']))
+    return {'name': row['name'], 'attempts': row['attempts'] + 1}
+
+
+def __update(name, **fields):
+    fields['updated'] = time.time()
+    keys = list(fields.keys())
+    __connection().execute(
+        'UPDATE derivative_job SET %s WHERE name = ?' % ', '.join('%s = ?' % k for k in keys),
+        [fields[k] for k in keys] + [name])
+
+
+def __run(name, attempts):
+    path = StoreLayout.store_path(name)
+    if not os.path.exists(path):
+        __update(name, state='failed', error='file not found')
+        return
+    try:
+        steps = __steps(name, path)
+        __update(name, total=len(steps), finished=0)
+        for i, step in enumerate(steps):
+            __run_step(step)
+            __update(name, finished=i + 1)
+        __update(name, state='done', error=None)
+    except Exception as ex:
+        logging.error(ex, exc_info=True)
+        state = 'pending' if attempts < GlobalConfigContext.Pregenerate_Max_Attempts else 'failed'
+        __update(name, state=state, error=str(ex))
+
+
+def __run_step(step):
+    while True:
+        try:
+            return step()
+        except TransformExecutor.Busy as ex:
+            # live requests come first
+            time.sleep(ex.retry_after)
+        except Governor.TooLarge as ex:
+            # requests serve the original or a still instead
+            logging.info('pregenerate: step skipped, %s', ex)
+            return None
+
+
+def __steps(name, path):
+    """
+    :return: list of callables, each building one derivative the same way a GET would
+    """
+    info = MetaIndex.get(name, path)
+    mime = info['mime'] if info is not None and info['mime'] else FileInfo.mime_type(path=path)
+    # largest first, the smaller thumbnails are then built from it (see Derivative.image_side)
+    sides = sorted(GlobalConfigContext.Pregenerate_Sides, reverse=True)
+    quality = Derivative.image_quality(GlobalConfigContext.Pregenerate_Quality)
+
+    if mime.find('image') >= 0:
+        if info is not None and info['extension']:
+            extension = info['extension']
+        else:
+            extension = FileInfo.extension(filename=path, mime=mime, mime_guess=None)
+        if not FileInfo.support_image_compress(mime=mime, extension=extension):
+            return []
+        if mime.find('gif') >= 0:
+            return [partial(Derivative.gif, path, side, None, format) for side in sides for format in __formats()]
+        return [partial(Derivative.image_side, path, path, side, quality, format)
+                for side in sides for format in __formats()]
+
+    owner = path
+    if FileInfo.audio_type(mime=mime, mime_guess=mime):
+        art = FileInfo.indexed_art(path)
+        if art is not None and not art['art_hash']:
+            return []
+        cover = partial(Derivative.audio_cover, art=art)
+        owner = Derivative.cover_owner(path, art)
+    elif FileInfo.video_type(mime=mime, mime_guess=mime):
+        cover = Derivative.video_cover
+    elif FileInfo.epub_type(mime=mime, mime_guess=mime):
+        cover = Derivative.epub_cover
+    else:
+        return []
+    return [partial(cover, path)] + [partial(__cover_side, cover, path, owner, side, quality, format)
+                                     for side in sides for format in __formats()]
+
+
+def __formats():
+    """
+    :return: output formats of pregenerated thumbnails, None for the source format
+    """
+    formats = [None]
+    negotiated = Derivative.negotiated_formats()
+    if GlobalConfigContext.Pregenerate_Negotiated and negotiated:
+        formats.append(negotiated[0])
+    return formats
+
+
+def __cover_side(cover, path, owner, side, quality, format):
+    """
+    :param owner: name the cover derivatives are cached under, see Derivative.cover_owner
+    """
+    source = cover(path)
+    if source is not None:
+        Derivative.image_side(owner, source, side, quality, format)
@@ -1,23 +1,47 @@
 # encoding: utf-8
-from datetime import datetime
-from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+import hashlib
+import io
 import os
 import subprocess
+import threading
+import time
+import uuid
 from urllib.parse import quote
 
-import cv2
-from PIL import Image, ImageOps, ExifTags
-from flask import Response, abort, current_app
-from numpy import ndarray
-from Service import gifsicle
-from Service import epub
+from flask import Response, abort, current_app, has_request_context, request
+from werkzeug.exceptions import HTTPException
+from werkzeug.http import is_resource_modified
+import GlobalConfigContext
+from Service import ArchiveIndex
+from Service import CacheManager
 from Service import FileInfo
-from Service.FileService import RGCompressCacheGifName, RGCompressCacheThumbName, get_file_cache_path, get_request_param, get_request_params
-import zipfile
+from Service import Governor
+from Service import MetaIndex
+from Service import StoreLayout
+from Service import Derivative
+from Service import Metrics
+from Service import Transform
+from Service import TransformExecutor
+from Service import ZipStream
+from Service.FileService import as_completed, get_request_param, get_request_params
 
 import logging as L
 logging = L.getLogger('file')
 
+__max_ranges = 64
+__cover_lock = threading.Lock()
+__cover_executor = None
+# already compressed: stored as is in ZIP exports, deflating them again only costs CPU
+__compressed_mimes = {
+    'application/zip', 'application/epub+zip', 'application/gzip', 'application/x-gzip', 'application/x-bzip2',
+    'application/x-xz', 'application/zstd', 'application/x-7z-compressed', 'application/x-rar',
+    'application/vnd.rar', 'application/pdf',
+}
+__uncompressed_media = {'image/bmp', 'image/x-ms-bmp', 'image/tiff', 'image/svg+xml', 'image/x-portable-pixmap',
+                        'audio/wav', 'audio/x-wav', 'audio/x-aiff'}
+
 
 def partial_response(request, path, sub_path, filename):
     logging.info('path:%s sub_path:%s filename:%s params:%s', path, sub_path, filename, get_request_params())
@@ -45,12 +69,43 @@ def partial_response(request, path, sub_path, filename):
         name = None
 
     cover = get_request_param('cover', 0, is_number=True)
+    # video covers: a strip of `frames` frames, or frame `frame` of it
+    frames = min(int(get_request_param('frames', 0, is_number=True)), GlobalConfigContext.Video_Frames_Max)
+    frame = get_request_param('frame', None, is_number=True)
+    if frame is not None:
+        frame = int(frame)
+
+    # derivatives may be re-encoded to WebP/AVIF, by `format=` or the Accept header
+    image_format, vary_accept = None, False
+    if cover or side or max_size:
+        image_format, vary_accept = Derivative.output_format(get_request_param('format', None), request.accept_mimetypes)
+
+    # revalidation costs one stat: answer 304 before any file is opened
+    st = os.stat(path)
+    last_modified = datetime.fromtimestamp(st.st_mtime, timezone.utc)
+    variant = (sub_path, cover, side * sf if side else None, max_size, quality, image_format, frames, frame)
+    use_range = not cover and 'Range' in request.headers
+    # ranges are always served from the stored file itself
+    etag = __etag(filename=filename, path=path, st=st, variant=(sub_path,) if use_range else variant)
+    if request.method in ('GET', 'HEAD') and not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        response = Response(status=304)
+        response.set_etag(etag)
+        response.last_modified = last_modified
+        response.headers['Accept-Ranges'] = 'bytes'
+        if vary_accept:
+            response.vary.add('Accept')
+        return response
+    if use_range and not __if_range_match(request, etag=etag, last_modified=last_modified):
+        use_range = False
+        etag = __etag(filename=filename, path=path, st=st, variant=variant)
+
     if cover:
-        response = cover_response(path=path, mime_guess=mime_guess, max_size=max_size, side=side, sf=sf, quality=quality)
+        response = cover_response(path=path, mime_guess=mime_guess, max_size=max_size, side=side, sf=sf, quality=quality,
+                                  image_format=image_format, frames=frames, frame=frame)
         name = os.path.splitext(name if name else filename)[0]
         ext = response.mimetype.split('/')[-1]
         name = f'{name}.{ext}'
-    elif 'Range' in request.headers:
+    elif use_range:
         response = __range_stream_response(request=request, path=path, sub_path=sub_path, mime_guess=mime_guess)
         if sub_path:
             name = os.path.basename(sub_path)
@@ -59,20 +114,57 @@ def partial_response(request, path, sub_path, filename):
             response = __full_stream_inzip_response(path=path, sub_path=sub_path, mime_guess=mime_guess)
             name = os.path.basename(sub_path)
         else:
-           response = stream_response(path=path, mime_guess=mime_guess, side=side, sf=sf, max_size=max_size, quality=quality)
+            response = stream_response(path=path, mime_guess=mime_guess, side=side, sf=sf, max_size=max_size, quality=quality,
+                                       image_format=image_format)
+            # GIFs negotiating WebP or AVIF are animated WebP
+            served = next((f for f, m in Transform.image_formats.items() if m == response.mimetype), None)
+            if image_format and served in (image_format, Derivative.gif_format(image_format)):
+                name = '%s.%s' % (os.path.splitext(name if name else filename)[0], served.lower())
 
     disposition = filename if name is None else name
     disposition = "inline; filename*=utf-8''{}".format(quote(disposition.encode('utf8')))
     response.headers['Content-Disposition'] = disposition
     
-    response.last_modified = datetime.fromtimestamp(os.path.getmtime(path))
+    response.last_modified = last_modified
+    response.set_etag(etag)
 
     # Accept request with Range header
     response.headers['Accept-Ranges'] = 'bytes'
+    if vary_accept:
+        response.vary.add('Accept')
     return response
 
 
-def stream_response(path, mime_guess, side, sf, max_size, quality):
+def __etag(filename, path, st, variant):
+    """
+    Strong ETag, the stored content hash for a stored file itself,
+    inode+mtime+size of the source plus the variant params for anything derived from it.
+    """
+    if not any(variant):
+        name = filename.split('/')[0]
+        if StoreLayout.is_store_path(name, path):
+            info = MetaIndex.get(name, path)
+            if info is not None and info['hash']:
+                return info['hash']
+    tag = '%x-%x-%x' % (st.st_ino, st.st_mtime_ns, st.st_size)
+    if any(variant):
+        tag += '-' + hashlib.md5(repr(variant).encode('utf8')).hexdigest()[:16]
+    return tag
+
+
+def __if_range_match(request, etag, last_modified):
+    """
+    :return: False if an `If-Range` validator no longer matches, the whole representation has to be sent then
+    """
+    if_range = request.if_range
+    if if_range.etag is not None:
+        return if_range.etag == etag
+    if if_range.date is not None:
+        return if_range.date == last_modified.replace(microsecond=0)
+    return True
+
+
+def stream_response(path, mime_guess, side, sf, max_size, quality, image_format=None):
     mimetype = FileInfo.mime_type(path=path, mime_guess=mime_guess)
     extension = FileInfo.extension(filename=path, mime=mimetype, mime_guess=mime_guess)
     if FileInfo.support_image_compress(mime=mimetype, extension=extension):
@@ -80,273 +172,373 @@ def stream_response(path, mime_guess, side, sf, max_size, quality):
             is_gif = mimetype.find('gif') >= 0
             if max_size is not None and is_gif == False:
                 s = side * sf if side is not None else None
-                return __compress_image_quality_response(path, max_size=max_size, side=s, name=path)
+                return __compress_image_quality_response(path, max_size=max_size, side=s, name=path, image_format=image_format)
             if side is not None:
                 if mimetype.find('gif') >= 0: # and quality is not None and quality == 'high'
-                    return __compress_gif_response(path, side, mimetype, quality=quality)
-                return __compress_image_side_response(filename=path, side=side * sf, data_path=path, quality=quality)
+                    return __compress_gif_response(path, side, mimetype, quality=quality, image_format=image_format)
+                return __compress_image_side_response(filename=path, side=side * sf, source=path, quality=quality,
+                                                      image_format=image_format)
+        except (TransformExecutor.Busy, CacheManager.Miss):
+            raise
         except Exception as ex:
             logging.error(ex, exc_info=True)
             abort(404)
     return __full_fd_response(path=path, mimetype=mimetype)
 
 
-def cover_response(path, mime_guess, max_size, side, sf, quality):
+def cover_response(path, mime_guess, max_size, side, sf, quality, image_format=None, frames=0, frame=None):
     mime = FileInfo.mime_type(path=path)
     if mime.find('image') >= 0:
-        return stream_response(path=path, mime_guess=mime_guess, side=side, sf=sf, max_size=max_size, quality=quality) 
+        return stream_response(path=path, mime_guess=mime_guess, side=side, sf=sf, max_size=max_size, quality=quality,
+                               image_format=image_format)
     if side:
         side = side * sf
     if FileInfo.audio_type(mime=mime, mime_guess=mime_guess):
-        return audio_cover_response(path=path, max_size=max_size, side=side, quality=quality)
+        return audio_cover_response(path=path, max_size=max_size, side=side, quality=quality, image_format=image_format)
     if FileInfo.video_type(mime=mime, mime_guess=mime_guess):
-        return video_cover_response(path=path, side=side, quality=quality)
+        if frames:
+            return video_frames_response(path=path, frames=frames, side=side, frame=frame)
+        return video_cover_response(path=path, side=side, quality=quality, image_format=image_format)
     if FileInfo.epub_type(mime=mime, mime_guess=mime_guess):
-        return epub_cover_response(path=path, side=side, quality=quality)
+        return epub_cover_response(path=path, side=side, quality=quality, image_format=image_format)
     abort(404)
 
 
-def audio_cover_response(path, max_size, side, quality):
-    cache_name='@%s' % (RGCompressCacheThumbName)
-    cache_path = get_file_cache_path(filename=path, cache_name=cache_name, mk_dir=True)
-    if os.path.exists(cache_path):
-        if max_size is not None:
-            return __compress_image_quality_response(cache_path, max_size=max_size, side=side, name=path)
-        if side is not None:
-            return __compress_image_side_response(filename=path, side=side, data_path=cache_path, quality=quality)
-        return __full_stream_response(cache_path)
-    if __createAudioThumbnail(path, cache_path):
-        return audio_cover_response(path, max_size, side, quality)
-    abort(404)
+def audio_cover_response(path, max_size, side, quality, image_format=None):
+    """
+    With the art located at upload (see FileInfo.audio_art) the picture is sent as a range of the audio file
+    when no resize is asked, and its derivatives are cached once per picture (see Derivative.cover_owner).
+    """
+    art = FileInfo.indexed_art(path)
+    if art is not None and not art['art_hash']:
+        abort(404)
+    if max_size is None and side is None and art is not None and art['art_offset'] is not None:
+        fd = open(path, 'rb')
+        return __full_fd_response(fd=fd, mimetype=art['art_mime'], size=art['art_length'], completion=fd.close,
+                                  offset=art['art_offset'])
+    cache_path = Derivative.audio_cover(path, art)
+    if cache_path is None:
+        abort(404)
+    owner = Derivative.cover_owner(path, art)
+    if max_size is not None:
+        return __compress_image_quality_response(cache_path, max_size=max_size, side=side, name=owner,
+                                                 image_format=image_format)
+    if side is not None:
+        return __compress_image_side_response(filename=owner, side=side, source=cache_path, quality=quality,
+                                              image_format=image_format)
+    return __full_stream_response(cache_path)
 
 
-def video_cover_response(path, side, quality):
-    cache_name='@%s' % (RGCompressCacheThumbName)
-    cache_path = get_file_cache_path(filename=path, cache_name=cache_name, mk_dir=True)
-    if os.path.exists(cache_path):
-        return __compress_image_side_response(filename=path, side=side, data_path=cache_path, quality=quality)
-    if __createVideoCapture(path, cache_path):
-        return __compress_image_side_response(filename=path, side=side, data_path=cache_path, quality=quality)
-    abort(404)
+def video_cover_response(path, side, quality, image_format=None):
+    cache_path = Derivative.video_cover(path)
+    if cache_path is None:
+        abort(404)
+    return __compress_image_side_response(filename=path, side=side, source=cache_path, quality=quality,
+                                          image_format=image_format)
 
 
-def epub_cover_response(path, side, quality):
-    with epub.open_cover(path) as fd:
-        return __compress_image_side_response(filename=path, side=side, fd=fd, quality=quality)
+def video_frames_response(path, frames, side, frame=None):
+    """
+    A strip of `frames` frames side by side, each fit in `side` (default `Video_Frame_Side`),
+    or with `frame` the one frame of that strip. The strip tells its tile size in X-Frame-* headers.
+    """
+    side = side or GlobalConfigContext.Video_Frame_Side
+    if frame is not None:
+        if not 0 <= frame < frames:
+            abort(404)
+        cache_path = Derivative.video_frame(path, frames, side, frame)
+    else:
+        cache_path = Derivative.video_frames(path, frames, side)
+    if cache_path is None:
+        abort(404)
+    response = __full_stream_response(cache_path)
+    if frame is None:
+        width, height = Transform.image_size(cache_path)
+        response.headers['X-Frame-Count'] = frames
+        response.headers['X-Frame-Width'] = width // frames
+        response.headers['X-Frame-Height'] = height
+    return response
 
 
-def __createVideoCapture(path, destination):
-    cap = cv2.VideoCapture(path)
+def epub_cover_response(path, side, quality, image_format=None):
+    return __compress_image_side_response(filename=path, side=side, source=Derivative.epub_cover(path), quality=quality,
+                                          image_format=image_format)
+
+
+def __compress_image_side_response(filename, side, source, quality=85, image_format=None):
+    """
+    :param source: image path, or <zip path, member> of an image inside an archive, see Transform
+    :param image_format: PIL output format of the thumbnail, None keeps the source format
+    """
     try:
-        sum_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-        fps = cap.get(cv2.CAP_PROP_FPS)
-        dur = sum_frames / fps
-        frame_number = min(15 if dur < 300 else 600, dur / 2) * fps
-        cap.set(1, frame_number - 1)
-        res, frame = cap.read()
-        if res is True and frame is not None and frame.data is not None:
-            frame_im = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-            with Image.fromarray(frame_im) as im:
-                im.thumbnail((1920, 1920), Image.Resampling.LANCZOS)
-                im = im.convert('RGB')
-                im.save(destination, format='JPEG', quality=85)
-                return True
+        if side is None or side == 0:
+            if not isinstance(source, tuple):
+                return __full_stream_response(source)
+            return __full_stream_response(Derivative.image_copy(filename, source))
+
+        quality = Derivative.image_quality(quality)
+        return __full_stream_response(Derivative.image_side(filename, source, side, quality, image_format),
+                                      Transform.image_formats.get(image_format))
+    except Governor.TooLarge as ex:
+        if isinstance(source, tuple):
+            return __refused(__full_stream_inzip_response(source[0], source[1], None), ex, 'original')
+        return __refused(__full_stream_response(source), ex, 'original')
+    except (TransformExecutor.Busy, CacheManager.Miss):
+        raise
     except Exception as ex:
         logging.error(ex, exc_info=True)
-        return False
-    finally:
-        if cap is not None:
-            cap.release()
+        abort(404)
 
 
-def __createAudioThumbnail(path, destination):
+def __compress_gif_response(path, side, mimetype, quality, image_format=None):
+    """
+    :param image_format: negotiated output format, an animated WebP when it is WebP or AVIF, see Derivative.gif_format
+    """
     try:
-        data = FileInfo.audio_cover(path=path)
-        if data is None:
-            return False
-        with Image.open(BytesIO(data)) as im:
-            im.thumbnail((1920, 1920), Image.Resampling.LANCZOS)
-            im = im.convert('RGB')
-            im.save(destination, format='JPEG', quality=85)
-            return True
-    except Exception as ex:
-        logging.error(ex, exc_info=True)
-        return False
+        cache_path = Derivative.gif(path, side, quality, image_format)
+    except Governor.TooLarge as ex:
+        if ex.reason != 'frames':
+            return __refused(__full_stream_response(path, mimetype), ex, 'original')
+        # the first frame only, which is all a still thumbnail decodes
+        return __refused(__compress_image_side_response(filename=path, side=side, source=path, quality=quality),
+                         ex, 'still')
+    if cache_path is None:
+        abort(404)
+    if Derivative.gif_format(image_format) == 'WEBP':
+        mimetype = Transform.image_formats['WEBP']
+    return __full_stream_response(cache_path, mimetype)
 
 
-def __compress_image_side_response(filename, side, fd=None, data=None, data_path=None, quality=85):
+def __compress_image_quality_response(path, max_size, side, name, image_format=None):
     try:
-        if side is None or side == 0:
-            if data_path is not None:
-                return __full_stream_response(data_path)
-            
-            cache_name='@%s' % (RGCompressCacheThumbName)
-            cache_path = get_file_cache_path(filename=filename, cache_name=cache_name, mk_dir=True)
-            if os.path.exists(cache_path):
-                return __full_stream_response(cache_path)
-            if fd is not None:
-                with Image.open(fd) as im:
-                    im.save(cache_path, format=im.format)
-                    return __full_stream_response(cache_path)
-            if data is not None:
-                with open(cache_path, 'wb') as f:
-                    f.write(data)
-                    return __full_stream_response(cache_path)
-            abort(404)
+        path = Derivative.fit_size(path, max_size=max_size, side=side, name=name, format=image_format)
+    except Governor.TooLarge as ex:
+        return __refused(__full_stream_response(path), ex, 'original')
+    # libmagic may not know AVIF yet
+    return __full_stream_response(path, Transform.image_formats.get(image_format))
 
-        if quality is not None:
-            if isinstance(quality, str):
-                if quality == 'high':
-                    quality = 85
-                elif quality == 'low':
-                    quality = 40
-                else:
-                    quality = 85
-            elif isinstance(quality, int):
-                quality = min(int(quality), 85)
-        else:
-            quality = 85
-        
-        if data_path is not None:
-            with Image.open(data_path) as im:
-                return __process_image_response(im, side, quality, filename)
-        if fd is not None:
-            with Image.open(fd) as im:
-                return __process_image_response(im, side, quality, filename)
-        if data is not None:
-            if isinstance(data, ndarray):
-                with Image.fromarray(data) as im:
-                    return __process_image_response(im, side, quality, filename)
-            else:
-                with Image.open(data) as im:
-                    return __process_image_response(im, side, quality, filename)
-        abort(404)
-    except Exception as ex:
-        logging.error(ex, exc_info=True)
+
+def __refused(response, ex, served):
+    """
+    `response` stands in for a derivative the governor refused to build, `X-Transform-Refused` tells why.
+    """
+    logging.info('governor: %s, serving the %s', ex, served)
+    Metrics.inc('rg_governor_refused_total', reason=ex.reason, served=served)
+    if 'X-Transform-Refused' not in response.headers:
+        response.headers['X-Transform-Refused'] = ex.reason
+    return response
+
+
+def archive_response(names, filename, side=None, quality=None, max_size=None, compress=True):
+    """
+    Stream stored files as one ZIP built on the fly, see ZipStream. Missing names are left out.
+    With `side` or `max_size` images are replaced by the same derivative a download would serve,
+    created when the stream reaches them.
+    :param compress: deflate entries that are not already compressed media
+    """
+    paths = [StoreLayout.store_path(name) for name in names]
+    indexed = MetaIndex.get_many(names, paths)
+    entries = []
+    used = set()
+    for name, path in zip(names, paths):
+        try:
+            st = os.stat(path)
+        except OSError:
+            logging.info('archive skip missing %s', name)
+            continue
+        info = indexed.get(name)
+        mime = info['mime'] if info is not None and info['mime'] else FileInfo.mime_type(path=path)
+        arcname = __unique_name(name, used)
+        resolve = __archive_derivative(path, mime, side, quality, max_size)
+        if resolve is not None:
+            entries.append(ZipStream.Entry(arcname, mtime=st.st_mtime, resolve=resolve))
+            continue
+        entries.append(ZipStream.Entry(arcname, path=path, size=st.st_size, mtime=st.st_mtime,
+                                       crc32=info.get('crc32') if info is not None else None,
+                                       compress=compress and __compressible(mime)))
+    if not entries:
         abort(404)
+    response = Response(ZipStream.stream(entries), mimetype='application/zip', direct_passthrough=True)
+    length = ZipStream.length(entries)
+    if length is not None:
+        response.headers['Content-Length'] = length
+    response.headers['Content-Disposition'] = "attachment; filename*=utf-8''{}".format(quote(filename.encode('utf8')))
+    return response
 
 
-def __process_image_response(im, side, quality, filename):
-    if side > im.height and side > im.width:
-        side = int(max(im.height, im.width))
+def covers_response(names, side=None, sf=1, quality=None, max_size=None, image_format=None):
+    """
+    Covers of many stored files in one `multipart/mixed` response, each part the body `/download/{name}?cover=1`
+    sends with the same params (a thumbnail for images). Parts are sent as soon as they are ready: first every one
+    needing no transform (cached, or served as is), then the others as the transform pool builds them,
+    on a pool of `Cover_Workers` threads of their own (waiting for the transform pool, they would otherwise hold up
+    /del and /info). Each part has the headers X-Status, Content-Disposition with the name, Content-Type and
+    Content-Length, a missing name, a file without a cover or a pool still busy is a part with its status only.
+    """
+    boundary = uuid.uuid4().hex
+
+    def cover(name):
+        return __batch_cover(name, side, sf, quality, max_size, image_format)
+
+    def body():
+        misses = []
+        for name in names:
+            with CacheManager.cached_only():
+                response = cover(name)
+            if response is None:
+                misses.append(name)
+                continue
+            yield from __batch_part(boundary, name, response)
+        results = as_completed(cover, misses, executor=__cover_pool(), workers=GlobalConfigContext.Cover_Workers)
+        try:
+            for index, response in results:
+                yield from __batch_part(boundary, misses[index], response)
+        finally:
+            results.close()
+        yield '--{0}--\r\n'.format(boundary).encode('latin-1')
+    return Response(body(), content_type='multipart/mixed; boundary=' + boundary, direct_passthrough=True)
 
-    cache_name='@%dx%d@quality_%d%s' % (side, side, quality, RGCompressCacheThumbName)
-    cache_path = get_file_cache_path(filename=filename, cache_name=cache_name, mk_dir=True)
-    if os.path.exists(cache_path):
-        return __full_stream_response(cache_path)
 
-    format = im.format
-    im.thumbnail((side, side), Image.Resampling.LANCZOS)
-    im = __rotate_image_if_need(image=im, exif=im.getexif())
-    im.save(cache_path, format=format, quality=quality)
-    return __full_stream_response(cache_path)
-        
-        
-def __compress_gif_response(path, side, mimetype, quality):
-    color = 128
-    lossy = 20
-    optimize = 3
-    if quality is not None and isinstance(quality, str):
-        if quality == 'low':
-            color = 64
-            lossy = 80
-            optimize = 4
-
-    with Image.open(path) as im:
-        if side > im.height and side > im.width:
-            side = int(max(im.height, im.width))
-
-    cache_name='@%dx%d@color_%d@lossy_%d@optimize_%d%s' % (side, side, color, lossy, optimize, RGCompressCacheGifName)
-    cache_path = get_file_cache_path(filename=path, cache_name=cache_name, mk_dir=True)
-    if os.path.exists(cache_path):
-        return __full_stream_response(path=cache_path, mime_guess='image/gif')
-    if gifsicle.compress(path, cache_path, width=side, height=side, colors=color, lossy=lossy, optimize=optimize) == False:
-        logging.error('gifsicle compress failed')
-        abort(404)
-    else:
-        return __full_stream_response(cache_path, mimetype)
+def __cover_pool():
+    global __cover_executor
+    with __cover_lock:
+        if __cover_executor is None:
+            __cover_executor = ThreadPoolExecutor(max_workers=GlobalConfigContext.Cover_Workers,
+                                                  thread_name_prefix='covers')
+        return __cover_executor
 
 
-def __compress_image_quality_response(path, max_size, side, name):
-    path = __compress_image_quality(path, max_size=max_size, side=side, name=name)
-    return __full_stream_response(path)
+def __batch_cover(name, side, sf, quality, max_size, image_format):
+    """
+    :return: the response of `cover_response` for the stored `name`, a bodiless one with the status of an error
+             (503 once the transform pool stayed busy past `Transform_Stream_Retries` waits),
+             None for a derivative not cached yet under CacheManager.cached_only
+    """
+    try:
+        path = StoreLayout.store_path(name)
+    except StoreLayout.InvalidName:
+        return Response(status=400)
+    retries = GlobalConfigContext.Transform_Stream_Retries
+    while True:
+        try:
+            if not os.path.isfile(path):
+                abort(404)
+            mime = FileInfo.mime_type(path=path)
+            return cover_response(path=path, mime_guess=mime, max_size=max_size, side=side, sf=sf, quality=quality,
+                                  image_format=image_format)
+        except CacheManager.Miss:
+            return None
+        except TransformExecutor.Busy as ex:
+            if retries <= 0:
+                return Response(status=503)
+            retries -= 1
+            # the response has started, wait for the pool a few times instead of failing the part
+            time.sleep(ex.retry_after)
+        except HTTPException as ex:
+            return Response(status=ex.code)
+        except Exception as ex:
+            logging.error(ex, exc_info=True)
+            return Response(status=500)
 
 
-def __compress_image_quality(image_path, max_size, side, name):
+def __batch_part(boundary, name, response):
     """
-    Compress images to a specified size
-    :param image_data: image data
-    :param max_size: specified size
-    :param name: given '/store/photo_2024.jpg', save to '/cache/photo_2024/@102400_compressCacheThumbnail.jpeg'
-    :return: new image data
+    :return: generator of the part of `covers_response` for `name`, `response` is closed once it is sent
     """
-    
+    try:
+        head = ['--' + boundary, 'X-Status: %d' % response.status_code,
+                "Content-Disposition: inline; filename*=utf-8''" + quote(name.encode('utf8'))]
+        send_body = response.status_code < 400
+        if send_body:
+            head.append('Content-Type: ' + response.content_type)
+            if 'Content-Length' in response.headers:
+                head.append('Content-Length: ' + response.headers['Content-Length'])
+        yield ('\r\n'.join(head) + '\r\n\r\n').encode('latin-1')
+        if send_body:
+            for chunk in response.response:
+                yield chunk
+        yield b'\r\n'
+    finally:
+        response.close()
 
-    with Image.open(image_path) as im:
-        if max_size is None or max_size == 0:
-            return image_path
 
-        max_kb = max_size * 1024
-        format = im.format
-        
-        with BytesIO() as output:
-            im.save(output, format=format)
-            size = output.tell()
-            
-            if size <= max_kb:
-                return image_path
+def __unique_name(name, used):
+    arcname = name
+    root, ext = os.path.splitext(name)
+    n = 1
+    while arcname in used:
+        n += 1
+        arcname = '%s (%d)%s' % (root, n, ext)
+    used.add(arcname)
+    return arcname
 
+
+def __compressible(mime):
+    if not mime or mime in __compressed_mimes or mime.endswith('+zip') or 'openxmlformats' in mime:
+        return False
+    if mime.startswith(('image/', 'video/', 'audio/')):
+        return mime in __uncompressed_media
+    return True
+
+
+def __archive_derivative(path, mime, side, quality, max_size):
+    """
+    :return: `resolve()` -> derivative path (the original if it can not be made, or the pool stays busy
+             past `Transform_Stream_Retries` waits), None to add the original
+    """
+    if side is None and max_size is None:
+        return None
+    extension = FileInfo.extension(filename=path, mime=mime, mime_guess=None)
+    if not FileInfo.support_image_compress(mime=mime, extension=extension):
+        return None
+    if mime.find('gif') >= 0:
         if side is None:
-            side = int(max(im.height, im.width))
-        else:
-            if side > im.height and side > im.width:
-                side = int(max(im.height, im.width))
-
-        cache_path = get_file_cache_path(filename=name, mk_dir=True, cache_name='@%dx%d@size_%d%s' % (side, side, max_kb, RGCompressCacheThumbName))
-        
-        if os.path.exists(cache_path):
-            return cache_path
-
-        with BytesIO() as img_byte_arr:
-            low, high = 1, 100
-            count = 0
-            
-            im.thumbnail((side, side), Image.Resampling.LANCZOS)
-            while low < high - 1:
-                mid = (low + high) // 2
-                im.save(img_byte_arr, format=format, quality=mid)
-                count += 1
-                size = img_byte_arr.tell()
-                if size > max_kb:
-                    high = mid - 1
-                else:
-                    low = mid
-                img_byte_arr.seek(0)
-                img_byte_arr.truncate(0)
-
-            logging.info('result count:%d max size:%d output size:%d', count + 1, max_kb, size)
-            im.save(cache_path, format=format, quality=low)
-            return cache_path
-
-
-def __rotate_image_if_need(image, exif):
-    if exif:
-        for key in ExifTags.TAGS.keys():
-            if ExifTags.TAGS[key]=='Orientation':
-                if key in exif:
-                    image = ImageOps.exif_transpose(image)
-                break
-    return image
+            return None
+        build = lambda: Derivative.gif(path, side, quality)
+    elif max_size is not None:
+        build = lambda: Derivative.fit_size(path, max_size=max_size, side=side, name=path)
+    else:
+        build = lambda: Derivative.image_side(path, path, side, Derivative.image_quality(quality))
+
+    def resolve():
+        retries = GlobalConfigContext.Transform_Stream_Retries
+        while True:
+            try:
+                return build() or path
+            except TransformExecutor.Busy as ex:
+                if retries <= 0:
+                    logging.warning('archive: transform pool still busy, adding the original of %s', path)
+                    return path
+                retries -= 1
+                # the response has started, wait for the pool a few times instead of failing it
+                time.sleep(ex.retry_after)
+            except Exception as ex:
+                logging.error(ex, exc_info=True)
+                return path
+    return resolve
 
 
 def __get_ranges(request, file_size):
+    """
+    :return: list of satisfiable {'start', 'length'}, empty if none is satisfiable,
+             None if the header can not be parsed and should be ignored
+    """
     buffer_range = request.headers.get('Range')
+    if not buffer_range or not buffer_range.strip().startswith('bytes='):
+        return None
     group = buffer_range.split('bytes=')[-1]
     ranges = group.split(',')
+    if len(ranges) > __max_ranges:
+        return None
     buffer_ranges = []
     logging.info('group ---------->')
     for range in ranges:
-        start, length = __get_range(range=range, file_size=file_size)
+        try:
+            start, length = __get_range(range=range.strip(), file_size=file_size)
+        except ValueError:
+            return None
+        if length <= 0:
+            continue
         buffer_ranges.append({
             'start': start,
             'length': length
@@ -359,9 +551,11 @@ def __get_ranges(request, file_size):
 def __get_range(range, file_size):
     index = range.find('-')
     items = range.split('-')
+    if index < 0 or len(items) != 2:
+        raise ValueError(range)
     if index == 0:
         # bytes=-500
-        length = int(items[-1])
+        length = min(int(items[-1]), file_size)
         start = file_size - length
     elif index == len(range) - 1:
         # bytes=500-
@@ -370,46 +564,132 @@ def __get_range(range, file_size):
     else:
         # bytes=500-999
         start = int(items[0])
-        length = int(items[-1]) - start + 1
+        end = int(items[-1])
+        if end < start:
+            raise ValueError(range)
+        length = min(end, file_size - 1) - start + 1
     return start, length
 
 
 def __range_stream_response(request, path, sub_path, mime_guess):
-    file_size = os.path.getsize(path)
-    buffer_ranges = __get_ranges(request, file_size)
-
-    buffer_range = buffer_ranges[0]
-    start = buffer_range['start']
-    length = buffer_range['length']
-
     if sub_path:
-        with zipfile.ZipFile(path) as z:
-            fd = z.open(sub_path)
-            size = z.getinfo(sub_path).file_size
-            mimetype = FileInfo.mime_type(buffer=fd, mime_guess=mime_guess)
-            return __range_fd_response(fd=fd, mimetype=mimetype, size=size, start=start, length=length)
+        fd, size, offset = ArchiveIndex.open_member(path, sub_path)
+        try:
+            mimetype = __inzip_mime_type(fd, offset, mime_guess)
+        except Exception:
+            fd.close()
+            raise
+        return __range_fd_response(request=request, fd=fd, mimetype=mimetype, size=size, completion=fd.close,
+                                   zero_copy=offset is not None, offset=offset or 0)
     try:
         file_size = os.path.getsize(path)
         mimetype = FileInfo.mime_type(path=path, mime_guess=mime_guess)
-        with open(path, 'rb') as fd:
-            return __range_fd_response(fd=fd, mimetype=mimetype, size=file_size, start=start, length=length)
+        fd = open(path, 'rb')
     except:
         abort(404)
+    return __range_fd_response(request=request, fd=fd, mimetype=mimetype, size=file_size, completion=fd.close, zero_copy=True)
 
 
-def __range_fd_response(fd, mimetype, size, start, length):
-    fd.seek(start)
-    read_bytes = fd.read(length)
+def __range_fd_response(request, fd, mimetype, size, completion, zero_copy=False, offset=0):
+    """
+    Serve the Range header of `request` from `fd`: one range as a plain 206 body,
+    several ranges as `multipart/byteranges`, each read in bounded chunks.
+    `completion` is called once the body is done or abandoned.
+    :param zero_copy: `fd` is a plain file only closed by `completion`, it may go to `wsgi.file_wrapper`
+    :param offset: the `size` bytes served start at this position of `fd` (a stored archive member)
+    """
+    buffer_ranges = __get_ranges(request, size)
+    if buffer_ranges is None:
+        if offset:
+            return __full_fd_response(mimetype=mimetype, fd=fd, size=size, completion=completion, offset=offset)
+        return __full_fd_response(mimetype=mimetype, fd=fd, size=size, completion=completion)
+    if len(buffer_ranges) == 0:
+        completion()
+        response = Response(status=416)  # Range Not Satisfiable
+        response.headers['Content-Range'] = 'bytes */{0}'.format(size)
+        return response
+
+    if len(buffer_ranges) == 1:
+        start = buffer_ranges[0]['start']
+        length = buffer_ranges[0]['length']
+        body = __file_wrapper(fd, offset + start, offset + start + length) if zero_copy else None
+        if body is None:
+            body = __range_send_streaming(fd, [(None, offset + start, length)], None, completion)
+        response = Response(
+            body,
+            206,  # Partial Content
+            mimetype=mimetype,
+            direct_passthrough=True,  # Identity encoding
+            )
+        response.headers['Content-Range'] = 'bytes {0}-{1}/{2}'.format(start, start + length - 1, size)
+        response.headers['Content-Length'] = length
+        return response
+
+    boundary = uuid.uuid4().hex
+    parts = []
+    content_length = 0
+    for buffer_range in buffer_ranges:
+        start = buffer_range['start']
+        length = buffer_range['length']
+        head = '--{0}\r\nContent-Type: {1}\r\nContent-Range: bytes {2}-{3}/{4}\r\n\r\n'.format(
+            boundary, mimetype, start, start + length - 1, size).encode('latin-1')
+        parts.append((head, offset + start, length))
+        content_length += len(head) + length + 2
+    tail = '--{0}--\r\n'.format(boundary).encode('latin-1')
+    content_length += len(tail)
     response = Response(
-        read_bytes,
+        __range_send_streaming(fd, parts, tail, completion),
         206,  # Partial Content
-        mimetype=mimetype,
+        content_type='multipart/byteranges; boundary=' + boundary,
         direct_passthrough=True,  # Identity encoding
         )
-    response.headers['Content-Range'] = 'bytes {0}-{1}/{2}'.format(start, start + length - 1, size)
+    response.headers['Content-Length'] = content_length
     return response
 
 
+def __range_send_streaming(fd, parts, tail, completion, buffer_size=256 * 1024):
+    """
+    :param parts: list of <part head bytes or None, start, length>
+    :param tail: bytes sent after the last part, None for a single plain range
+    """
+    try:
+        for head, start, length in parts:
+            if head is not None:
+                yield head
+            fd.seek(start)
+            while length > 0:
+                buf = fd.read(min(buffer_size, length))
+                if not buf:
+                    break
+                length -= len(buf)
+                yield buf
+            if tail is not None:
+                yield b'\r\n'
+        if tail is not None:
+            yield tail
+    finally:
+        completion()
+
+
+def __file_wrapper(fd, start=0, end=None, buffer_size=256 * 1024):
+    """
+    Hand a plain file to the server's `wsgi.file_wrapper` (e.g. gunicorn sends it with `os.sendfile`).
+    A wrapper sends up to the end of the file and not every server stops at Content-Length (werkzeug's does not),
+    so a body ending before the end of the file is not handed over.
+    :param end: position the body ends at, default the end of the file
+    :return: None if the server has no file wrapper or the body ends before the end of the file
+    """
+    if not GlobalConfigContext.Response_Use_File_Wrapper or not isinstance(fd, io.BufferedReader):
+        return None
+    wrapper = request.environ.get('wsgi.file_wrapper') if has_request_context() else None
+    if wrapper is None:
+        return None
+    if end is not None and end != os.fstat(fd.fileno()).st_size:
+        return None
+    fd.seek(start)
+    return wrapper(fd, buffer_size)
+
+
 def __full_stream_response(path, mime_guess=None):
     mimetype = FileInfo.mime_type(path=path, mime_guess=mime_guess)
     return __full_fd_response(path=path, mimetype=mimetype, size=os.path.getsize(path))
@@ -417,20 +697,30 @@ def __full_stream_response(path, mime_guess=None):
 
 def __full_stream_inzip_response(path, sub_path, mime_guess):
     try:
-        with zipfile.ZipFile(path) as z:
-            sub_path = sub_path.encode('gbk').decode('cp437')
-            fd = z.open(sub_path)
-            size = z.getinfo(sub_path).file_size
-            mimetype = FileInfo.mime_type(buffer=fd, mime_guess=mime_guess)
-            def completion():
-                fd.close()
-            return __full_fd_response(fd=fd, mimetype=mimetype, size=size, completion=completion)
+        fd, size, offset = ArchiveIndex.open_member(path, sub_path)
     except Exception as ex:
         logging.error(ex, exc_info=True)
         abort(404)
+    try:
+        mimetype = __inzip_mime_type(fd, offset, mime_guess)
+    except Exception as ex:
+        logging.error(ex, exc_info=True)
+        fd.close()
+        abort(404)
+    return __full_fd_response(fd=fd, mimetype=mimetype, size=size, completion=fd.close, offset=offset)
+
 
+def __inzip_mime_type(fd, offset, mime_guess):
+    if offset is None:
+        return FileInfo.mime_type(buffer=fd, mime_guess=mime_guess)
+    fd.seek(offset)
+    return FileInfo.mime_type(buffer=io.BytesIO(fd.read(4096)), mime_guess=mime_guess)
 
-def __full_fd_response(mimetype, fd=None, path=None, size=0, completion=None):
+
+def __full_fd_response(mimetype, fd=None, path=None, size=0, completion=None, offset=None):
+    """
+    :param offset: `fd` is an archive holding the `size` bytes to send at this position (a stored member)
+    """
     completion_called = False
     def once_completion():
         nonlocal completion_called
@@ -443,16 +733,26 @@ def __full_fd_response(mimetype, fd=None, path=None, size=0, completion=None):
     if path and os.path.exists(path):
         size = os.path.getsize(path)
         fd = open(path, 'rb')
+        if completion is None:
+            body = __file_wrapper(fd)
+            if body is not None:
+                response = Response(body, content_type=__charset_mimetype(mimetype), direct_passthrough=True)
+                response.headers['Content-Length'] = size
+                return response
         def __completion():
             fd.close()
             once_completion()
         return __full_fd_response(mimetype=mimetype, fd=fd, size=size, completion=__completion)
+    if fd and offset is not None:
+        body = __file_wrapper(fd, offset, offset + size)
+        if body is None:
+            body = __range_send_streaming(fd, [(None, offset, size)], None, once_completion)
+        response = Response(body, content_type=__charset_mimetype(mimetype), direct_passthrough=True)
+        response.headers['Content-Length'] = size
+        return response
     if fd:
         try:
-            if mimetype:
-                if mimetype.startswith('text') or mimetype.endswith('json') or mimetype.endswith('rtf'):
-                    mimetype+=';charset=UTF-8'
-
+            mimetype = __charset_mimetype(mimetype)
             response = Response(__full_fd_response_send_streaming(fd, once_completion), content_type=mimetype)
             response.headers['Content-Length'] = size
             return response
@@ -462,11 +762,20 @@ def __full_fd_response(mimetype, fd=None, path=None, size=0, completion=None):
     abort(404)
 
 
+def __charset_mimetype(mimetype):
+    if mimetype:
+        if mimetype.startswith('text') or mimetype.endswith('json') or mimetype.endswith('rtf'):
+            mimetype+=';charset=UTF-8'
+    return mimetype
+
+
 def __full_fd_response_send_streaming(fd, completion):
-    while True:
-        buf = fd.read(256 * 1024)
-        if not buf:
-            if completion:
-                completion()
-            break
-        yield buf
+    try:
+        while True:
+            buf = fd.read(256 * 1024)
+            if not buf:
+                break
+            yield buf
+    finally:
+        if completion:
+            completion()
@@ -0,0 +1,83 @@
+# encoding: utf-8
+"""
+Deferred removal of derivative cache directories. `remove` renames a directory into
+`{FileCache_Directory}/.trash` (one rename, so a delete request returns at once) and a background
+thread deletes it from there. Whatever a stopped process left in the trash goes when the reaper starts.
+"""
+import os
+import shutil
+import threading
+import uuid
+
+import GlobalConfigContext
+import logging as L
+logging = L.getLogger('file')
+
+__lock = threading.Lock()
+__wake = threading.Event()
+__thread = None
+
+
+def trash_dir():
+    return os.path.join(GlobalConfigContext.FileCache_Directory, '.trash')
+
+
+def remove(path):
+    """
+    Take `path` out of the cache now and delete it in the background.
+    It is deleted inline when it can not be renamed into the trash (e.g. another file system).
+    """
+    trash = trash_dir()
+    os.makedirs(trash, exist_ok=True)
+    try:
+        os.rename(path, os.path.join(trash, uuid.uuid4().hex))
+    except FileNotFoundError:
+        return
+    except OSError as ex:
+        logging.info('reaper: removing %s inline: %s', path, ex)
+        shutil.rmtree(path, ignore_errors=True)
+        return
+    start()
+    __wake.set()
+
+
+def reap():
+    """
+    Delete everything in the trash.
+    :return: number of entries deleted
+    """
+    trash = trash_dir()
+    try:
+        entries = list(os.scandir(trash))
+    except FileNotFoundError:
+        return 0
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            shutil.rmtree(entry.path, ignore_errors=True)
+        else:
+            try:
+                os.remove(entry.path)
+            except OSError as ex:
+                logging.error(ex, exc_info=True)
+    if entries:
+        logging.info('reaper: deleted %d cache directories', len(entries))
+    return len(entries)
+
+
+def start():
+    global __thread
+    with __lock:
+        if __thread is not None:
+            return
+        __thread = threading.Thread(target=__run, name='cache-reaper', daemon=True)
+        __thread.start()
+
+
+def __run():
+    while True:
+        __wake.clear()
+        try:
+            reap()
+        except Exception as ex:
+            logging.error(ex, exc_info=True)
+        __wake.wait()
@@ -0,0 +1,189 @@
+# encoding: utf-8
+"""
+Where a stored file and its derivative cache directory live on disk.
+With `GlobalConfigContext.Store_Sharded` new entries go two hex levels down, by the md5 of their name:
+`{FileStore_Directory}/.s/3f/a2/{name}` and `{FileCache_Directory}/.s/3f/a2/{name without extension}`,
+so no directory grows to millions of entries. The shards live under the hidden `.s`, out of the way of flat names,
+which are never hidden (see check_name), even a name of two hex digits. Names stored flat before keep resolving,
+and `migrate` (run as `python -m Service.StoreLayout` next to a live server, or in the background with
+`Store_Migrate_On_Start`) moves them into their shard without downtime.
+"""
+import hashlib
+import os
+import shutil
+import threading
+import time
+
+import GlobalConfigContext
+from Service import CacheManager
+import logging as L
+logging = L.getLogger('file')
+
+__shard_root = '.s'
+__migration = None
+__migration_lock = threading.Lock()
+
+
+class InvalidName(ValueError):
+    """
+    A name that is not a single entry of the store: empty, a path, or hidden (`.chunked`, `.blobs`, ...).
+    """
+    pass
+
+
+def check_name(name):
+    """
+    Raise InvalidName unless `name` is one entry of the store, not a path into or out of it.
+    """
+    if not isinstance(name, str) or not name or name.startswith('.') or '..' in name \
+            or '/' in name or '\\' in name or '\0' in name:
+        raise InvalidName('invalid name: %r' % (name,))
+
+
+def shard_path(base, key):
+    digest = hashlib.md5(key.encode('utf-8')).hexdigest()
+    return os.path.join(base, __shard_root, digest[:2], digest[2:4], key)
+
+
+def __resolve(base, key):
+    """
+    :return: the existing location of `key`, or where a new one goes
+    """
+    check_name(key)
+    path = __locate(base, key)
+    real_base = os.path.realpath(base)
+    if os.path.commonpath([real_base, os.path.realpath(path)]) != real_base:
+        raise InvalidName('%r resolves outside of %s' % (key, base))
+    return path
+
+
+def __locate(base, key):
+    sharded = shard_path(base, key)
+    flat = os.path.join(base, key)
+    first, second = (sharded, flat) if GlobalConfigContext.Store_Sharded else (flat, sharded)
+    if os.path.lexists(first):
+        return first
+    if os.path.lexists(second):
+        return second
+    # `migrate` links into the shard before removing the flat name, so a file missing from both is new
+    return first
+
+
+def store_path(name):
+    """
+    :param name: stored file name, without sub path
+    :raise InvalidName: see check_name
+    """
+    return __resolve(GlobalConfigContext.FileStore_Directory, name)
+
+
+def cache_dir(key):
+    """
+    :param key: stored file name without extension
+    :raise InvalidName: see check_name
+    """
+    return __resolve(GlobalConfigContext.FileCache_Directory, key)
+
+
+def is_store_path(name, path):
+    try:
+        return path == store_path(name)
+    except InvalidName:
+        return False
+
+
+def migrate(pause=None, batch=100):
+    """
+    Move flat store files and cache directories into their shards, safe while the server runs:
+    a file is hard linked into its shard before its flat name is removed, so it always resolves,
+    and a cache directory is renamed in one step (its cache rows follow it).
+    :param pause: seconds slept every `batch` moves, default `Store_Migrate_Pause`
+    :return: dict of moved files and cache directories
+    """
+    if pause is None:
+        pause = GlobalConfigContext.Store_Migrate_Pause
+    result = {'files': 0, 'cache_dirs': 0, 'conflicts': 0}
+    moved = 0
+    for base, move in ((GlobalConfigContext.FileStore_Directory, __move_file),
+                       (GlobalConfigContext.FileCache_Directory, __move_cache_dir)):
+        if not os.path.isdir(base):
+            continue
+        for entry in os.scandir(base):
+            # the shards, and the hidden entries of the store and the cache
+            if entry.name.startswith('.'):
+                continue
+            try:
+                kind = move(base, entry)
+            except OSError as ex:
+                logging.error(ex, exc_info=True)
+                continue
+            if kind is None:
+                continue
+            result[kind] += 1
+            moved += 1
+            if pause and moved % batch == 0:
+                time.sleep(pause)
+    logging.info('store layout migration: %s', result)
+    return result
+
+
+def __move_file(base, entry):
+    if not entry.is_file(follow_symlinks=False):
+        return None
+    target = shard_path(base, entry.name)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    if os.path.lexists(target):
+        if not os.path.samefile(entry.path, target):
+            logging.error('store layout conflict: %s and %s', entry.path, target)
+            return 'conflicts'
+    else:
+        # a link keeps the inode, so its mtime, the metadata index row and dedup links stay valid
+        os.link(entry.path, target)
+    os.unlink(entry.path)
+    return 'files'
+
+
+def __move_cache_dir(base, entry):
+    target = shard_path(base, entry.name)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    if entry.is_symlink():
+        # shared by deduplicated content, its rows are kept under the shared path
+        if not os.path.lexists(target):
+            os.symlink(os.readlink(entry.path), target)
+        os.unlink(entry.path)
+        return 'cache_dirs'
+    if not entry.is_dir(follow_symlinks=False):
+        return None
+    if not os.path.lexists(target):
+        os.rename(entry.path, target)
+    else:
+        # recreated by a request racing the previous pass, merge it
+        for name in os.listdir(entry.path):
+            os.replace(os.path.join(entry.path, name), os.path.join(target, name))
+        shutil.rmtree(entry.path, ignore_errors=True)
+    CacheManager.move_dir(entry.path, target)
+    return 'cache_dirs'
+
+
+def start_migration():
+    """
+    Run `migrate` once in a background thread of this process.
+    """
+    global __migration
+    with __migration_lock:
+        if __migration is not None:
+            return
+        __migration = threading.Thread(target=__run_migration, name='store-layout-migration', daemon=True)
+        __migration.start()
+
+
+def __run_migration():
+    try:
+        migrate()
+    except Exception as ex:
+        logging.error(ex, exc_info=True)
+
+
+if __name__ == '__main__':
+    L.basicConfig(level=L.INFO)
+    print(migrate())
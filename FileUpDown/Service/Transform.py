@@ -0,0 +1,432 @@
+# encoding: utf-8
+"""
+CPU heavy derivative work: image thumbnails, size-targeted compression, GIF resizing, video and audio covers.
+Functions here only take paths and plain values and write their result to `destination`,
+so they can run in the transform process pool (see TransformExecutor) without the Flask request.
+A `source` is an image path, or a tuple <zip path, member> for an image inside an archive (e.g. an EPUB cover).
+PIL decodes lazily on the first pixel access, the 'decode' stage therefore includes the downscale (see `__downscale`).
+"""
+from io import BytesIO
+
+import cv2
+from PIL import Image, ImageOps, ImageSequence, ExifTags
+import GlobalConfigContext
+from Service import ArchiveIndex
+from Service import gifsicle
+from Service import FileInfo
+from Service import Governor
+from Service import Metrics
+
+import logging as L
+logging = L.getLogger('file')
+
+try:
+    # AVIF encoder plugin for Pillow versions without built-in AVIF
+    import pillow_avif
+except ImportError:
+    pass
+
+# PIL format -> MIME of the output formats a derivative may be converted to
+image_formats = {
+    'JPEG': 'image/jpeg',
+    'PNG': 'image/png',
+    'WEBP': 'image/webp',
+    'AVIF': 'image/avif',
+}
+
+# animated GIF modes of `gif_resize`: <resampling, dithering, GIF optimize, WebP method, share of the colors kept>
+__gif_modes = {
+    'fast': (Image.Resampling.BILINEAR, Image.Dither.NONE, False, 0, 1),
+    'balanced': (Image.Resampling.LANCZOS, Image.Dither.FLOYDSTEINBERG, True, 2, 1),
+    'small': (Image.Resampling.LANCZOS, Image.Dither.NONE, True, 4, 0.5),
+}
+
+# Pillow's own decompression bomb check, a backstop for decodes the governor does not see (e.g. EPUB covers):
+# past the limit Pillow warns, past twice the limit it refuses to open the image
+Image.MAX_IMAGE_PIXELS = GlobalConfigContext.Image_Max_Pixels
+
+
+def open_image(source):
+    if isinstance(source, tuple):
+        archive, member = source
+        return Image.open(BytesIO(ArchiveIndex.read(archive, member)))
+    return Image.open(source)
+
+
+def image_size(source):
+    """
+    :return: <width, height>, only the image header is read, that of an archive member once per archive version
+    :raise Governor.TooLarge: past twice `Image_Max_Pixels`, when Pillow refuses to even open the image
+    """
+    try:
+        if isinstance(source, tuple):
+            archive, member = source
+            return ArchiveIndex.memo(archive, ('image_size', member), lambda zip_file: __member_size(zip_file, member))
+        with Image.open(source) as im:
+            return im.width, im.height
+    except Image.DecompressionBombError as ex:
+        raise Governor.TooLarge('pixels', 2 * GlobalConfigContext.Image_Max_Pixels + 1,
+                                GlobalConfigContext.Image_Max_Pixels) from ex
+
+
+def __member_size(zip_file, member):
+    # the member stream is only decompressed as far as Pillow reads the header
+    with zip_file.open(member) as fd, Image.open(fd) as im:
+        return im.width, im.height
+
+
+def image_frames(source):
+    """
+    :return: frame count, 1 for still images, the frames are walked without being decoded
+    """
+    with open_image(source) as im:
+        return getattr(im, 'n_frames', 1)
+
+
+def image_copy(source, destination):
+    with open_image(source) as im, Metrics.stage('encode'):
+        im.save(destination, format=im.format)
+    return True
+
+
+def save_formats():
+    """
+    :return: the `image_formats` this Pillow build can write
+    """
+    Image.init()
+    return {format for format in image_formats if format in Image.SAVE}
+
+
+def image_side(source, destination, side, quality, format=None):
+    """
+    :param format: PIL format of the output, None keeps the source format
+    """
+    with open_image(source) as im:
+        format = format or im.format
+        with Metrics.stage('decode'):
+            __downscale(im, side)
+            im = __rotate_image_if_need(image=im, exif=im.getexif())
+        with Metrics.stage('encode'):
+            __for_format(im, format).save(destination, format=format, quality=quality)
+    return True
+
+
+def __downscale(im, side):
+    """
+    Fit `im` in `side` x `side` in place with Pillow's `thumbnail`.
+    Small thumbnails mostly come from a larger cached one rather than the original, see Derivative.image_side.
+    """
+    im.thumbnail((side, side), Image.Resampling.LANCZOS)
+
+
+def __for_format(im, format):
+    """
+    :return: `im` in a mode `format` can write (JPEG has no alpha, WebP and AVIF no palette)
+    """
+    alpha = im.mode in ('RGBA', 'LA', 'PA') or 'transparency' in im.info
+    if format == 'JPEG' and im.mode not in ('RGB', 'L', 'CMYK'):
+        return im.convert('RGB')
+    if format in ('WEBP', 'AVIF') and im.mode not in ('RGB', 'RGBA'):
+        return im.convert('RGBA' if alpha else 'RGB')
+    return im
+
+
+def image_fit_size(source, destination, side, max_kb, quality_hint=None, format=None):
+    """
+    Compress an image below `max_kb` bytes at the highest quality that fits (within `Fit_Size_Tolerance`).
+    Each encode goes to memory and the best one is written as is, never encoded again.
+    The first quality tried comes from `quality_hint` (found earlier for the same file, side and size),
+    or from a search on a downscaled copy, or from the bytes per pixel the budget allows.
+    :param format: PIL format of the output, None keeps the source format
+    :return: quality written
+    """
+    with open_image(source) as im:
+        format = format or im.format
+        with Metrics.stage('decode'):
+            __downscale(im, side)
+            im = __for_format(im, format)
+
+        guess = quality_hint
+        if guess is None:
+            guess = __guess_quality(im.width * im.height, max_kb)
+            scale = GlobalConfigContext.Fit_Size_Search_Scale
+            if scale < 1 and im.width * im.height * scale * scale >= GlobalConfigContext.Fit_Size_Search_Min_Pixels:
+                size = (max(1, int(im.width * scale)), max(1, int(im.height * scale)))
+                with im.resize(size, Image.Resampling.BILINEAR) as small:
+                    guess, data, count = __search_quality(small, format, max_kb * scale * scale, guess, max_count=4)
+                logging.info('downscaled search count:%d quality:%d', count, guess)
+
+        quality, data, count = __search_quality(im, format, max_kb, guess)
+        logging.info('result count:%d max size:%d output size:%d quality:%d', count, max_kb, len(data), quality)
+        with open(destination, 'wb') as f:
+            f.write(data)
+    return quality
+
+
+def __guess_quality(pixels, max_kb):
+    bits_per_pixel = max_kb * 8 / max(1, pixels)
+    if bits_per_pixel < 0.5:
+        return 40
+    if bits_per_pixel < 1:
+        return 60
+    if bits_per_pixel < 2:
+        return 80
+    return 92
+
+
+def __search_quality(im, format, max_kb, guess, max_count=8):
+    """
+    Interpolation search of the highest quality whose encode fits `max_kb`,
+    stopping early once an encode fills at least `Fit_Size_Tolerance` of the budget.
+    :return: <quality, encoded bytes, encode count>, the lowest quality's bytes if nothing fits
+    """
+    tolerance = GlobalConfigContext.Fit_Size_Tolerance
+    fit_q, fit_size, fit_data = 0, 0, None
+    over_q, over_size = 101, None
+    q = min(100, max(1, int(guess)))
+    count = 0
+    while count < max_count:
+        with BytesIO() as output, Metrics.stage('encode'):
+            im.save(output, format=format, quality=q)
+            data = output.getvalue()
+        count += 1
+        size = len(data)
+        if size <= max_kb:
+            fit_q, fit_size, fit_data = q, size, data
+            if size >= max_kb * tolerance:
+                break
+        else:
+            over_q, over_size = q, size
+        if over_q - fit_q <= 1:
+            break
+        if fit_data is None:
+            # nothing fits yet, scale the quality down with the overshoot
+            q = max(1, min(over_q - 1, int(q * max_kb / size)))
+        elif over_size is None:
+            # everything fits so far, scale the quality up with the room left, at least half way up
+            q = min(100, max(fit_q + max(1, (101 - fit_q) // 2), int(q * max_kb / size)))
+        else:
+            # size grows about linearly with quality between the two bounds
+            q = fit_q + int((max_kb - fit_size) * (over_q - fit_q) / max(1, over_size - fit_size))
+            q = max(fit_q + 1, min(over_q - 1, q))
+    if fit_data is None:
+        if over_q > 1:
+            with BytesIO() as output:
+                im.save(output, format=format, quality=1)
+                return 1, output.getvalue(), count + 1
+        return over_q, data, count
+    return fit_q, fit_data, count
+
+
+def gif_compress(source, destination, side, colors, lossy, optimize):
+    return gifsicle.compress(source, destination, width=side, height=side, colors=colors, lossy=lossy, optimize=optimize)
+
+
+def gif_resize(source, destination, side, colors, mode, format='GIF', quality=85):
+    """
+    Animated GIF fit in `side` x `side`, in this process (no gifsicle fork): each frame is composited by Pillow,
+    resampled, then quantized to `colors` for a GIF (the last palette index is kept for transparency)
+    or encoded as is into an animated WebP. Frame durations and the loop count (or its absence) are kept.
+    :param mode: 'fast', 'balanced' or 'small', see `__gif_modes`
+    :param format: 'GIF' or 'WEBP'
+    :param quality: WebP quality
+    """
+    resample, dither, optimize, method, share = __gif_modes[mode]
+    colors = max(2, min(256, int(colors * share)))
+    with open_image(source) as im:
+        scale = min(1, side / max(im.width, im.height))
+        size = (max(1, round(im.width * scale)), max(1, round(im.height * scale)))
+        # a GIF without a loop count plays once, saving it with loop=0 would repeat it forever (a WebP always has
+        # a count, 1 plays once)
+        loop = {'loop': im.info['loop']} if 'loop' in im.info else {}
+        frames = []
+        durations = []
+        with Metrics.stage('decode'):
+            for frame in ImageSequence.Iterator(im):
+                durations.append(frame.info.get('duration', 100))
+                frame = frame.convert('RGBA')
+                if frame.size != size:
+                    # reduced by an integer factor first, then resampled from twice the size, as `thumbnail` does
+                    frame = frame.resize(size, resample, reducing_gap=2.0)
+                frames.append(__gif_palette(frame, colors, dither) if format == 'GIF' else frame)
+        with Metrics.stage('encode'):
+            if format == 'GIF':
+                frames[0].save(destination, format='GIF', save_all=True, append_images=frames[1:], duration=durations,
+                               disposal=2, optimize=optimize, transparency=colors - 1, **loop)
+            else:
+                frames[0].save(destination, format='WEBP', save_all=True, append_images=frames[1:], duration=durations,
+                               loop=loop.get('loop', 1), quality=quality, method=method)
+    return True
+
+
+def __gif_palette(frame, colors, dither):
+    """
+    :return: RGBA `frame` in `colors - 1` colors, transparent pixels on index `colors - 1`
+    """
+    transparent = frame.getchannel('A').point(lambda a: 255 if a < 128 else 0)
+    palette = frame.convert('RGB').quantize(colors - 1, method=Image.Quantize.FASTOCTREE, dither=dither)
+    palette.paste(colors - 1, mask=transparent)
+    return palette
+
+
+def video_capture(path, destination):
+    """
+    Poster frame, 15 s in (10 min for videos longer than 5 min), at most half way.
+    The position is a timestamp (`CAP_PROP_POS_MSEC`): the demuxer jumps to the keyframe before it
+    and decodes from there, which holds for variable frame rate files too, unlike a frame number.
+    """
+    cap = cv2.VideoCapture(path)
+    try:
+        if not __video_within_limits(cap, path):
+            return False
+        duration = __video_duration(cap)
+        position = min(15 if duration < 300 else 600, duration / 2) * 1000 if duration else 0
+        frame = __video_read_at(cap, position)
+        if frame is None and position:
+            # the duration was wrong, or the seek failed
+            frame = __video_read_at(cap, 0)
+        if frame is None:
+            return False
+        with __frame_image(frame) as im:
+            __downscale(im, 1920)
+            im = im.convert('RGB')
+            with Metrics.stage('encode'):
+                im.save(destination, format='JPEG', quality=85)
+            return True
+    except Exception as ex:
+        logging.error(ex, exc_info=True)
+        return False
+    finally:
+        if cap is not None:
+            cap.release()
+
+
+def video_frames(path, destination, count, side, quality=85):
+    """
+    Sprite strip of `count` frames spread evenly over the video, each fit in `side` x `side`, side by side,
+    taken in one forward pass: a close frame is reached by decoding on (`grab`, no color conversion),
+    a far one by a timestamp seek. A frame that can not be read repeats the previous one,
+    so tile `i` always starts at x = i * width / count.
+    """
+    cap = cv2.VideoCapture(path)
+    try:
+        if not __video_within_limits(cap, path):
+            return False
+        duration = __video_duration(cap)
+        tiles = []
+        tile = None
+        for i in range(count):
+            # without a duration: one frame per second from the start
+            target = (i + 0.5) * duration * 1000 / count if duration else i * 1000
+            frame = __video_frame_at(cap, target)
+            if frame is not None:
+                with __frame_image(frame) as im:
+                    __downscale(im, side)
+                    tile = im.convert('RGB')
+            tiles.append(tile)
+        first = next((t for t in tiles if t is not None), None)
+        if first is None:
+            return False
+        strip = Image.new('RGB', (first.width * count, first.height))
+        for i, t in enumerate(tiles):
+            strip.paste(t if t is not None else first, (i * first.width, 0))
+        with Metrics.stage('encode'):
+            strip.save(destination, format='JPEG', quality=quality)
+        return True
+    except Exception as ex:
+        logging.error(ex, exc_info=True)
+        return False
+    finally:
+        if cap is not None:
+            cap.release()
+
+
+def image_tile(source, destination, index, count, quality=85):
+    """
+    Tile `index` of a strip of `count` equal tiles, see `video_frames`.
+    """
+    with open_image(source) as im:
+        width = im.width // count
+        with Metrics.stage('decode'):
+            tile = im.crop((index * width, 0, (index + 1) * width, im.height))
+        with Metrics.stage('encode'):
+            tile.save(destination, format='JPEG', quality=quality)
+    return True
+
+
+def __video_within_limits(cap, path):
+    width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    if Governor.within_limits(width, height):
+        return True
+    logging.warning('governor: %s not decoded, %dx%d frames', path, width, height)
+    return False
+
+
+def __video_duration(cap):
+    """
+    :return: seconds from the frame count and the (average) frame rate, None if the container does not tell
+    """
+    frames = cap.get(cv2.CAP_PROP_FRAME_COUNT)
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    if frames > 0 and 0 < fps < 1000:
+        return frames / fps
+    return None
+
+
+def __video_read_at(cap, position):
+    with Metrics.stage('cv2_seek'):
+        cap.set(cv2.CAP_PROP_POS_MSEC, position)
+        res, frame = cap.read()
+    if res and frame is not None and frame.data is not None:
+        return frame
+    return None
+
+
+def __video_frame_at(cap, target):
+    """
+    Read the first frame at or after `target` ms, never going back.
+    """
+    current = cap.get(cv2.CAP_PROP_POS_MSEC)
+    if current <= 0 or not 0 <= target - current <= GlobalConfigContext.Video_Grab_Window * 1000:
+        return __video_read_at(cap, target)
+    with Metrics.stage('cv2_seek'):
+        while cap.get(cv2.CAP_PROP_POS_MSEC) < target:
+            if not cap.grab():
+                return None
+        res, frame = cap.retrieve()
+    return frame if res else None
+
+
+def __frame_image(frame):
+    return Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+
+
+def audio_thumbnail(path, destination):
+    try:
+        data = FileInfo.audio_cover(path=path)
+        if data is None:
+            return False
+        with Image.open(BytesIO(data)) as im:
+            if not Governor.within_limits(im.width, im.height):
+                logging.warning('governor: cover of %s not decoded, %dx%d', path, im.width, im.height)
+                return False
+            with Metrics.stage('decode'):
+                __downscale(im, 1920)
+                im = im.convert('RGB')
+            with Metrics.stage('encode'):
+                im.save(destination, format='JPEG', quality=85)
+            return True
+    except Exception as ex:
+        logging.error(ex, exc_info=True)
+        return False
+
+
+def __rotate_image_if_need(image, exif):
+    if exif:
+        for key in ExifTags.TAGS.keys():
+            if ExifTags.TAGS[key]=='Orientation':
+                if key in exif:
+                    image = ImageOps.exif_transpose(image)
+                break
+    return image
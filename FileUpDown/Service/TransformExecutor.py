@@ -0,0 +1,118 @@
+# encoding: utf-8
+"""
+This module runs Transform functions on a bounded process pool, off the request threads.
+At most `Transform_Workers` jobs run and `Transform_Queue_Depth` more may wait, anything beyond
+that raises `Busy` right away, which the gateway answers with 503 + Retry-After.
+Cache hits never come here, they are served before a transform is submitted, so they stay fast under load.
+Stages a job times in its worker (see Metrics.stage) travel back with its result into the registry of this process,
+and so does the peak RSS of the job (see Governor).
+"""
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+import threading
+
+import GlobalConfigContext
+from Service import Governor
+from Service import Metrics
+import logging as L
+logging = L.getLogger('file')
+
+__lock = threading.Lock()
+__executor = None
+__slots = None
+
+
+class Busy(Exception):
+    """
+    The transform pool is saturated, retry after `retry_after` seconds.
+    """
+
+    def __init__(self, retry_after):
+        super().__init__('transform pool is busy')
+        self.retry_after = retry_after
+
+
+def __pool():
+    global __executor, __slots
+    with __lock:
+        if __executor is None:
+            workers = GlobalConfigContext.Transform_Workers
+            context = multiprocessing.get_context(GlobalConfigContext.Transform_Start_Method)
+            __executor = ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=Governor.limit_worker)
+            __slots = threading.BoundedSemaphore(workers + GlobalConfigContext.Transform_Queue_Depth)
+        return __executor, __slots
+
+
+def __reset(broken):
+    global __executor
+    with __lock:
+        if __executor is broken:
+            __executor = None
+    broken.shutdown(wait=False)
+
+
+def run(fn, *args, **kwargs):
+    """
+    Run `fn(*args, **kwargs)` in the pool and wait for its result.
+    With `Transform_Workers` 0 it runs inline in the calling thread.
+    :raise Busy: when all workers and queue slots are taken
+    """
+    name = getattr(fn, '__name__', 'transform')
+    if GlobalConfigContext.Transform_Workers <= 0:
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException:
+            Metrics.inc('rg_transform_jobs_total', function=name, outcome='error')
+            raise
+        Metrics.inc('rg_transform_jobs_total', function=name, outcome='ok')
+        return result
+    executor, slots = __pool()
+    if not slots.acquire(blocking=False):
+        Metrics.inc('rg_transform_jobs_total', function=name, outcome='busy')
+        raise Busy(GlobalConfigContext.Transform_Retry_After)
+    try:
+        future = executor.submit(__call, fn, args, kwargs)
+    except BaseException:
+        slots.release()
+        raise
+    # the slot is held until the job really ends, even if this request stops waiting
+    future.add_done_callback(lambda f: slots.release())
+    try:
+        result, stages, peak = future.result(timeout=GlobalConfigContext.Transform_Timeout)
+    except BrokenProcessPool:
+        logging.error('transform pool broken, it will be recreated')
+        Metrics.inc('rg_transform_jobs_total', function=name, outcome='error')
+        __reset(executor)
+        raise
+    except BaseException:
+        Metrics.inc('rg_transform_jobs_total', function=name, outcome='error')
+        raise
+    Metrics.inc('rg_transform_jobs_total', function=name, outcome='ok')
+    Metrics.merge(stages)
+    if peak is not None:
+        Metrics.observe('rg_transform_peak_rss_bytes', peak, function=name)
+        Governor.record(peak)
+    return result
+
+
+def __call(fn, args, kwargs):
+    """
+    Runs in a pool worker.
+    :return: <result of fn, stages it timed, peak RSS in bytes of the worker and its subprocesses or None>
+    """
+    Governor.begin()
+    if Governor.reset_process_peak():
+        Governor.record(Governor.process_peak())
+    with Metrics.capture() as stages:
+        result = fn(*args, **kwargs)
+    Governor.record(Governor.process_peak())
+    return result, stages, Governor.end()
+
+
+def shutdown():
+    global __executor
+    with __lock:
+        executor, __executor = __executor, None
+    if executor is not None:
+        executor.shutdown(wait=True)
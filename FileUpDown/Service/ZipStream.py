@@ -0,0 +1,212 @@
+# encoding: utf-8
+"""
+ZIP archives written on the fly, in constant memory: `stream` yields the archive in chunks as it reads the files.
+Stored (uncompressed) entries carry their CRC-32 and sizes in the local header, their CRC comes from the metadata
+index when known, else from a first read of the file. Deflated entries are followed by a data descriptor.
+ZIP64 fields are written for entries, offsets and archives past 4 GB or 65535 entries.
+With only stored entries of known size, `length` gives the archive size before anything is read.
+"""
+import struct
+import time
+import zlib
+
+import logging as L
+logging = L.getLogger('file')
+
+__limit = 0xFFFFFFFF
+__count_limit = 0xFFFF
+__flag_descriptor = 0x0008
+__flag_utf8 = 0x0800
+__external_attributes = 0o100644 << 16
+# version made by: 4.5 on unix
+__made_by = (3 << 8) | 45
+
+
+class Entry:
+
+    def __init__(self, name, path=None, size=None, mtime=None, crc32=None, compress=False, resolve=None):
+        """
+        :param name: name inside the archive
+        :param path: file to add, or None with `resolve`
+        :param resolve: `resolve()` -> path, called right before the entry is written (e.g. a derivative), None skips it
+        :param crc32: CRC-32 of the file if already known (stored entries skip reading it twice)
+        :param compress: deflate the entry, for anything not already compressed
+        """
+        self.name = name
+        self.path = path
+        self.size = size
+        self.mtime = mtime
+        self.crc32 = crc32
+        self.compress = compress
+        self.resolve = resolve
+
+
+def length(entries):
+    """
+    :return: byte size of the archive `stream` writes, None if it depends on compression or unresolved entries
+    """
+    offset = 0
+    central = 0
+    count = 0
+    for entry in entries:
+        if entry.compress or entry.resolve is not None or entry.size is None:
+            return None
+        zip64 = entry.size >= __limit
+        name = entry.name.encode('utf-8')
+        central += 46 + len(name) + len(__central_extra(entry.size, entry.size, offset))
+        offset += 30 + len(name) + (20 if zip64 else 0) + entry.size
+        count += 1
+    return offset + central + len(__end(count, central, offset))
+
+
+def stream(entries, buffer_size=256 * 1024):
+    """
+    :param entries: iterable of Entry, read lazily
+    :return: generator of the archive bytes
+    """
+    offset = 0
+    central = []
+    for entry in entries:
+        path = entry.path
+        if entry.resolve is not None:
+            path = entry.resolve()
+            if path is None:
+                continue
+        with open(path, 'rb') as f:
+            size = f.seek(0, 2)
+            f.seek(0)
+            if entry.size is not None and entry.size != size:
+                raise IOError('%s changed while archiving' % entry.name)
+            name = entry.name.encode('utf-8')
+            date_time = __dos_time(entry.mtime)
+            header_offset = offset
+            if entry.compress:
+                # sizes and CRC follow the data
+                zip64 = size + size // 1000 + 1024 >= __limit
+                flags = __flag_utf8 | __flag_descriptor
+                method, crc, compressed = zlib.DEFLATED, 0, 0
+            else:
+                zip64 = size >= __limit
+                flags = __flag_utf8
+                method, compressed = 0, size
+                crc = entry.crc32 if entry.crc32 is not None else __crc32(f, size, buffer_size)
+            head = __local_header(name, flags, method, date_time, crc, compressed, size, zip64)
+            yield head
+            offset += len(head)
+
+            if entry.compress:
+                crc, compressed = yield from __deflate(f, size, buffer_size)
+                if compressed >= __limit and not zip64:
+                    raise IOError('%s grew past 4 GB when deflated' % entry.name)
+                if zip64:
+                    descriptor = struct.pack('<4sLQQ', b'PK\x07\x08', crc, compressed, size)
+                else:
+                    descriptor = struct.pack('<4sLLL', b'PK\x07\x08', crc, compressed, size)
+                yield descriptor
+                offset += compressed + len(descriptor)
+            else:
+                yield from __copy(f, size, buffer_size)
+                offset += size
+        central.append(__central_header(name, flags, method, date_time, crc, compressed, size, header_offset, zip64))
+
+    directory_offset = offset
+    directory_size = 0
+    for header in central:
+        yield header
+        directory_size += len(header)
+    yield __end(len(central), directory_size, directory_offset)
+
+
+def __local_header(name, flags, method, date_time, crc, compressed, size, zip64):
+    if zip64:
+        extra = struct.pack('<HHQQ', 1, 16, size, compressed)
+        compressed = size = __limit
+    else:
+        extra = b''
+    return struct.pack('<4sHHHHHLLLHH', b'PK\x03\x04', 45 if zip64 else 20, flags, method, date_time[1],
+                       date_time[0], crc, compressed, size, len(name), len(extra)) + name + extra
+
+
+def __central_extra(compressed, size, offset):
+    values = [v for v in (size, compressed, offset) if v >= __limit]
+    if not values:
+        return b''
+    return struct.pack('<HH', 1, 8 * len(values)) + b''.join(struct.pack('<Q', v) for v in values)
+
+
+def __central_header(name, flags, method, date_time, crc, compressed, size, offset, zip64):
+    extra = __central_extra(compressed, size, offset)
+    version = 45 if zip64 or extra else 20
+    return struct.pack('<4sHHHHHHLLLHHHHHLL', b'PK\x01\x02', __made_by, version, flags, method,
+                       date_time[1], date_time[0], crc, min(compressed, __limit), min(size, __limit),
+                       len(name), len(extra), 0, 0, 0, __external_attributes, min(offset, __limit)) + name + extra
+
+
+def __end(count, directory_size, directory_offset):
+    end = b''
+    if count >= __count_limit or directory_size >= __limit or directory_offset >= __limit:
+        end64_offset = directory_offset + directory_size
+        end += struct.pack('<4sQHHLLQQQQ', b'PK\x06\x06', 44, __made_by, 45, 0, 0,
+                           count, count, directory_size, directory_offset)
+        end += struct.pack('<4sLQL', b'PK\x06\x07', 0, end64_offset, 1)
+    end += struct.pack('<4sHHHHLLH', b'PK\x05\x06', 0, 0, min(count, __count_limit), min(count, __count_limit),
+                       min(directory_size, __limit), min(directory_offset, __limit), 0)
+    return end
+
+
+def __dos_time(mtime):
+    """
+    :return: <date, time> in MS-DOS format, local time as zip tools expect
+    """
+    t = time.localtime(mtime if mtime is not None else time.time())
+    if t.tm_year < 1980:
+        return (1 << 5) | 1, 0
+    return ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday, (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2)
+
+
+def __crc32(f, size, buffer_size):
+    crc = 0
+    left = size
+    while left > 0:
+        buf = f.read(min(buffer_size, left))
+        if not buf:
+            break
+        crc = zlib.crc32(buf, crc)
+        left -= len(buf)
+    f.seek(0)
+    return crc
+
+
+def __copy(f, size, buffer_size):
+    left = size
+    while left > 0:
+        buf = f.read(min(buffer_size, left))
+        if not buf:
+            raise IOError('file shrank while archiving')
+        left -= len(buf)
+        yield buf
+
+
+def __deflate(f, size, buffer_size):
+    """
+    :return: (through `yield from`) <CRC-32, compressed size>
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+    crc = 0
+    compressed = 0
+    left = size
+    while left > 0:
+        buf = f.read(min(buffer_size, left))
+        if not buf:
+            raise IOError('file shrank while archiving')
+        left -= len(buf)
+        crc = zlib.crc32(buf, crc)
+        out = compressor.compress(buf)
+        if out:
+            compressed += len(out)
+            yield out
+    out = compressor.flush()
+    compressed += len(out)
+    if out:
+        yield out
+    return crc, compressed
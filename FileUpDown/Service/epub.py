@@ -1,8 +1,9 @@
 import os
 import sys
-import zipfile
+from io import BytesIO
 from lxml import etree
 from PIL import Image
+from Service import ArchiveIndex
 
 namespaces = {
    "calibre":"http://calibre.kovidgoyal.net/2009/metadata",
@@ -15,54 +16,60 @@ namespaces = {
 
 def get_epub_cover(epub_path):
     ''' Return the cover image file from an epub archive. '''
+    cover_path = get_epub_cover_path(epub_path)
+    return BytesIO(ArchiveIndex.read(epub_path, cover_path))
+
+
+def get_epub_cover_path(epub_path):
+    ''' Return the archive member name of the cover image of an epub, parsed once per archive version. '''
+    return ArchiveIndex.memo(epub_path, 'epub_cover', find_cover_path)
+
+
+def find_cover_path(z):
+    ''' Return the cover member name of the epub opened as the zipfile.ZipFile `z`. '''
+    # We load "META-INF/container.xml" using lxml.etree.fromString():
+    t = etree.fromstring(z.read("META-INF/container.xml"))
+    # We use xpath() to find the attribute "full-path":
+    '''
+    <container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
+      <rootfiles>
+        <rootfile full-path="OEBPS/content.opf" ... />
+      </rootfiles>
+    </container>
+    '''
+    rootfile_path =  t.xpath("/u:container/u:rootfiles/u:rootfile",
+                                         namespaces=namespaces)[0].get("full-path")
+    # print("Path of root file found: " + rootfile_path)
+    
+    # We load the "root" file, indicated by the "full_path" attribute of "META-INF/container.xml", using lxml.etree.fromString():
+    t = etree.fromstring(z.read(rootfile_path))
+    # We use xpath() to find the attribute "content":
+    '''
+    <metadata xmlns:dc="http://purl.org/dc/elements/1.1/" xmlns:opf="http://www.idpf.org/2007/opf">
+      ...
+      <meta content="my-cover-image" name="cover"/>
+      ...
+    </metadata>
+    '''
+    cover_id = t.xpath("//opf:metadata/opf:meta[@name='cover']",
+                                namespaces=namespaces)[0].get("content")
+    # print("ID of cover image found: " + cover_id)
     
-    # We open the epub archive using zipfile.ZipFile():
-    with zipfile.ZipFile(epub_path) as z:
+    # We use xpath() to find the attribute "href":
+    '''
+    <manifest>
+        ...
+        <item id="my-cover-image" href="images/978.jpg" ... />
+        ... 
+    </manifest>
+    '''
+    cover_href = t.xpath("//opf:manifest/opf:item[@id='" + cover_id + "']",
+                                     namespaces=namespaces)[0].get("href")
+    # In order to get the full path for the cover image, we have to join rootfile_path and cover_href:
+    cover_path = os.path.join(os.path.dirname(rootfile_path), cover_href)
+    # print("Path of cover image found: " + cover_path)
     
-        # We load "META-INF/container.xml" using lxml.etree.fromString():
-        t = etree.fromstring(z.read("META-INF/container.xml"))
-        # We use xpath() to find the attribute "full-path":
-        '''
-        <container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
-          <rootfiles>
-            <rootfile full-path="OEBPS/content.opf" ... />
-          </rootfiles>
-        </container>
-        '''
-        rootfile_path =  t.xpath("/u:container/u:rootfiles/u:rootfile",
-                                             namespaces=namespaces)[0].get("full-path")
-        # print("Path of root file found: " + rootfile_path)
-        
-        # We load the "root" file, indicated by the "full_path" attribute of "META-INF/container.xml", using lxml.etree.fromString():
-        t = etree.fromstring(z.read(rootfile_path))
-        # We use xpath() to find the attribute "content":
-        '''
-        <metadata xmlns:dc="http://purl.org/dc/elements/1.1/" xmlns:opf="http://www.idpf.org/2007/opf">
-          ...
-          <meta content="my-cover-image" name="cover"/>
-          ...
-        </metadata>
-        '''
-        cover_id = t.xpath("//opf:metadata/opf:meta[@name='cover']",
-                                    namespaces=namespaces)[0].get("content")
-        # print("ID of cover image found: " + cover_id)
-        
-        # We use xpath() to find the attribute "href":
-        '''
-        <manifest>
-            ...
-            <item id="my-cover-image" href="images/978.jpg" ... />
-            ... 
-        </manifest>
-        '''
-        cover_href = t.xpath("//opf:manifest/opf:item[@id='" + cover_id + "']",
-                                         namespaces=namespaces)[0].get("href")
-        # In order to get the full path for the cover image, we have to join rootfile_path and cover_href:
-        cover_path = os.path.join(os.path.dirname(rootfile_path), cover_href)
-        # print("Path of cover image found: " + cover_path)
-        
-        # We return the image
-        return z.open(cover_path)
+    return cover_path
 
 # fd = get_epub_cover('./安达与岛村8.epub')
 # im = Image.open(fd)
@@ -1,9 +1,11 @@
 #! /usr/bin/env python
 # -*- coding: utf-8 -*-
-import subprocess
 import os
 import logging as L
 
+from Service import Governor
+from Service import Metrics
+
 logging = L.getLogger("file")
 
 
@@ -36,18 +38,15 @@ def compress(input, output, optimize=3, colors=64, lossy=20, width=200, height=2
 
     re = False
     try:
-        result = subprocess.run(
-            command, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE
-        )
-        re = result.returncode == 0
+        with Metrics.stage('gifsicle'):
+            # under the Subprocess_*_Limit rlimits, see Governor
+            returncode, stderr = Governor.run(command)
+        re = returncode == 0
         if re == False:
+            logging.error('gifsicle exited with %d: %s', returncode, stderr.decode(errors='replace'))
             if os.path.exists(output):
                 os.remove(output)
         return re
-    except subprocess.CalledProcessError as e:
-        logging.error(e.stderr.decode(), exc_info=True)
-        if os.path.exists(output):
-            os.remove(output)
     except Exception as e:
         logging.error(e, exc_info=True)
         if os.path.exists(output):
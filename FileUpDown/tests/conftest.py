@@ -0,0 +1,78 @@
+# encoding: utf-8
+"""
+Tests run the Flask app against a temporary store, cache and databases (see Benchmark.configure),
+with transforms inline. Run them from the FileUpDown directory: `python -m pytest tests`.
+"""
+import io
+import os
+import shutil
+import sys
+import tempfile
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import Benchmark
+import GlobalConfigContext
+
+__base = tempfile.mkdtemp(prefix='rgfileserver-test-')
+Benchmark.configure(__base)
+GlobalConfigContext.Transform_Workers = 0
+
+from FileUpDownApp import app
+
+
+def pytest_sessionfinish(session, exitstatus):
+    shutil.rmtree(__base, ignore_errors=True)
+
+
+@pytest.fixture
+def client():
+    return app.test_client()
+
+
+@pytest.fixture
+def upload(client):
+    """
+    :return: `upload(filename, data, mime)` -> the /upload/ item of the stored file
+    """
+    def upload(filename, data, mime='application/octet-stream'):
+        response = client.post('/file/upload/', data={'file': (io.BytesIO(data), filename, mime)},
+                               content_type='multipart/form-data')
+        assert response.status_code == 200
+        item = response.json[0]
+        assert item['flag'], item['err_msg']
+        return item
+    return upload
+
+
+@pytest.fixture
+def jpeg():
+    """
+    :return: `jpeg(width, height, exif=None)` -> bytes of a noisy JPEG (noise so sizes and qualities differ)
+    """
+    from PIL import Image
+
+    def jpeg(width, height, exif=None, quality=90):
+        im = Image.frombytes('RGB', (width, height), os.urandom(width * height * 3))
+        buf = io.BytesIO()
+        if exif is not None:
+            im.save(buf, 'JPEG', quality=quality, exif=exif)
+        else:
+            im.save(buf, 'JPEG', quality=quality)
+        return buf.getvalue()
+    return jpeg
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    """
+    :return: a per-file cache directory of an empty cache of its own
+    """
+    monkeypatch.setattr(GlobalConfigContext, 'FileCache_Directory', str(tmp_path / 'cache'))
+    monkeypatch.setattr(GlobalConfigContext, 'FileCache_Database', str(tmp_path / 'cache.sqlite3'))
+    monkeypatch.setattr(GlobalConfigContext, 'FileCache_Touch_Interval', 0)
+    directory = tmp_path / 'cache' / 'photo'
+    directory.mkdir(parents=True)
+    return directory
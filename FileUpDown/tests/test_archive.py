@@ -0,0 +1,97 @@
+# encoding: utf-8
+import io
+import os
+import zipfile
+
+from PIL import Image
+
+import GlobalConfigContext
+from Service import Derivative, TransformExecutor, ZipStream
+
+
+def __zip(data):
+    archive = zipfile.ZipFile(io.BytesIO(data))
+    assert archive.testzip() is None
+    return archive
+
+
+def test_stream_stored_deflated_and_resolved_entries(tmp_path):
+    stored = tmp_path / 'stored.bin'
+    stored.write_bytes(os.urandom(5000))
+    text = tmp_path / 'text.txt'
+    text.write_bytes(b'words ' * 2000)
+    entries = [
+        ZipStream.Entry('stored.bin', path=str(stored), size=5000, mtime=0),
+        ZipStream.Entry('text.txt', path=str(text), size=12000, mtime=0, compress=True),
+        ZipStream.Entry('resolved.bin', mtime=0, resolve=lambda: str(stored)),
+        ZipStream.Entry('skipped.bin', mtime=0, resolve=lambda: None),
+    ]
+    archive = __zip(b''.join(ZipStream.stream(entries)))
+    assert archive.namelist() == ['stored.bin', 'text.txt', 'resolved.bin']
+    assert archive.read('resolved.bin') == stored.read_bytes()
+    assert archive.read('text.txt') == text.read_bytes()
+    assert archive.getinfo('text.txt').compress_type == zipfile.ZIP_DEFLATED
+    assert archive.getinfo('stored.bin').compress_type == zipfile.ZIP_STORED
+
+
+def test_length_of_stored_entries_is_known_ahead(tmp_path):
+    entries = []
+    for i in range(3):
+        path = tmp_path / ('%d.bin' % i)
+        path.write_bytes(os.urandom(1000 * i))
+        entries.append(ZipStream.Entry('%d.bin' % i, path=str(path), size=1000 * i, mtime=0))
+    assert ZipStream.length(entries) == len(b''.join(ZipStream.stream(entries)))
+    entries[0].compress = True
+    assert ZipStream.length(entries) is None
+
+
+def test_archive_endpoint(client, upload, jpeg):
+    text = upload('notes.txt', b'some notes ' * 500, 'text/plain')['path']
+    photo = upload('photo.jpg', jpeg(640, 480), 'image/jpeg')['path']
+    response = client.post('/file/archive', json={'names': [text, photo, text, 'missing.bin'], 'filename': 'all.zip'})
+    assert response.status_code == 200
+    assert response.mimetype == 'application/zip'
+    assert "filename*=utf-8''all.zip" in response.headers['Content-Disposition']
+    archive = __zip(response.data)
+    root, ext = os.path.splitext(text)
+    assert archive.namelist() == [text, photo, '%s (2)%s' % (root, ext)]
+    assert archive.read(text) == b'some notes ' * 500
+    assert archive.getinfo(text).compress_type == zipfile.ZIP_DEFLATED
+    assert archive.getinfo(photo).compress_type == zipfile.ZIP_STORED
+
+    response = client.get('/file/archive', query_string={'names': [text, photo], 'compress': 'false'})
+    assert int(response.headers['Content-Length']) == len(response.data)
+    assert client.post('/file/archive', json={'names': ['missing.bin']}).status_code == 404
+
+
+def test_archive_of_thumbnails(client, upload, jpeg):
+    photo = upload('big.jpg', jpeg(800, 600), 'image/jpeg')['path']
+    archive = __zip(client.post('/file/archive', json={'names': [photo], 'side': 200}).data)
+    assert max(Image.open(io.BytesIO(archive.read(photo))).size) == 200
+
+
+def test_busy_pool_gives_the_original_after_bounded_waits(client, upload, jpeg, monkeypatch):
+    original = jpeg(400, 300)
+    photo = upload('busy.jpg', original, 'image/jpeg')['path']
+    calls = []
+
+    def busy(*args, **kwargs):
+        calls.append(args)
+        raise TransformExecutor.Busy(0)
+
+    monkeypatch.setattr(Derivative, 'image_side', busy)
+    monkeypatch.setattr('GlobalConfigContext.Transform_Stream_Retries', 2)
+    archive = __zip(client.post('/file/archive', json={'names': [photo], 'side': 100}).data)
+    assert archive.read(photo) == original
+    assert len(calls) == 3
+
+
+def test_names_outside_the_store_are_refused(client, tmp_path):
+    secret = tmp_path / 'secret.txt'
+    secret.write_bytes(b'not yours')
+    relative = os.path.relpath(str(secret), GlobalConfigContext.FileStore_Directory)
+    for name in (relative, str(secret), '.chunked', 'a\\..\\b'):
+        response = client.post('/file/archive', json={'names': [name]})
+        assert response.status_code == 400, name
+        assert b'not yours' not in response.data
+        assert client.get('/file/archive', query_string={'names': name}).status_code == 400
@@ -0,0 +1,85 @@
+# encoding: utf-8
+import io
+import zipfile
+
+import pytest
+from PIL import Image
+
+from Service import ArchiveIndex, Transform
+
+
+def __zip(path, members, compress_type=zipfile.ZIP_STORED):
+    with zipfile.ZipFile(path, 'w', compress_type) as z:
+        for name, data in members.items():
+            z.writestr(name, data)
+    return str(path)
+
+
+def test_stored_member_is_served_from_the_archive_file(tmp_path):
+    path = __zip(tmp_path / 'a.zip', {'a.txt': b'first', 'b.txt': b'second member'})
+    fd, size, offset = ArchiveIndex.open_member(path, 'b.txt')
+    with fd:
+        assert size == len(b'second member')
+        fd.seek(offset)
+        assert fd.read(size) == b'second member'
+    assert ArchiveIndex.read(path, 'a.txt') == b'first'
+    with pytest.raises(KeyError):
+        ArchiveIndex.member_info(path, 'missing.txt')
+
+
+def test_deflated_member_is_a_stream(tmp_path):
+    path = __zip(tmp_path / 'd.zip', {'d.txt': b'z' * 10000}, zipfile.ZIP_DEFLATED)
+    fd, size, offset = ArchiveIndex.open_member(path, 'd.txt')
+    with fd:
+        assert offset is None
+        assert fd.read() == b'z' * 10000
+
+
+def test_memo_is_recomputed_when_the_archive_changes(tmp_path):
+    path = __zip(tmp_path / 'm.zip', {'one': b'1'})
+    calls = []
+
+    def names(zip_file):
+        calls.append(1)
+        return sorted(zip_file.namelist())
+    assert ArchiveIndex.memo(path, 'names', names) == ['one']
+    assert ArchiveIndex.memo(path, 'names', names) == ['one']
+    assert len(calls) == 1
+    __zip(tmp_path / 'm.zip', {'one': b'1', 'two': b'22'})
+    assert ArchiveIndex.memo(path, 'names', names) == ['one', 'two']
+    assert len(calls) == 2
+
+
+def test_member_image_size_reads_the_member_once(tmp_path, monkeypatch):
+    buf = io.BytesIO()
+    Image.new('RGB', (320, 200)).save(buf, 'PNG')
+    path = __zip(tmp_path / 'cover.epub', {'OEBPS/cover.png': buf.getvalue()}, zipfile.ZIP_DEFLATED)
+    assert Transform.image_size((path, 'OEBPS/cover.png')) == (320, 200)
+
+    def refuse(*args, **kwargs):
+        raise AssertionError('the member was read again')
+    monkeypatch.setattr(ArchiveIndex, 'read', refuse)
+    monkeypatch.setattr(zipfile.ZipFile, 'open', refuse)
+    assert Transform.image_size((path, 'OEBPS/cover.png')) == (320, 200)
+
+
+def test_epub_cover_thumbnail(client, upload):
+    buf = io.BytesIO()
+    Image.new('RGB', (400, 600), 'red').save(buf, 'JPEG')
+    epub = io.BytesIO()
+    with zipfile.ZipFile(epub, 'w') as z:
+        z.writestr('mimetype', 'application/epub+zip')
+        z.writestr('META-INF/container.xml',
+                   '<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container"><rootfiles>'
+                   '<rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/>'
+                   '</rootfiles></container>')
+        z.writestr('OEBPS/content.opf',
+                   '<package xmlns="http://www.idpf.org/2007/opf" version="2.0"><metadata>'
+                   '<meta name="cover" content="cover-image"/></metadata><manifest>'
+                   '<item id="cover-image" href="images/cover.jpg" media-type="image/jpeg"/></manifest></package>')
+        z.writestr('OEBPS/images/cover.jpg', buf.getvalue())
+    name = upload('book.epub', epub.getvalue(), 'application/epub+zip')['path']
+    for _ in range(2):
+        response = client.get('/file/download/%s?cover=1&side=100&mime=application/epub%%2Bzip' % name)
+        assert response.status_code == 200
+        assert Image.open(io.BytesIO(response.data)).size == (67, 100)
@@ -0,0 +1,158 @@
+# encoding: utf-8
+import asyncio
+import hashlib
+import os
+import threading
+
+from werkzeug.exceptions import ClientDisconnected
+
+import FileUpDownAsgi
+
+
+def __request(method, path, body=b'', headers=(), chunks=None, extensions=None, receive=None):
+    """
+    Run one request through the ASGI app.
+    :param chunks: body messages, default the body in one message
+    :param receive: the ASGI receive callable, instead of one handing out `chunks`
+    :return: <status, dict of headers, body bytes, sent messages>
+    """
+    if chunks is None:
+        chunks = [body]
+    messages = [{'type': 'http.request', 'body': chunk, 'more_body': i < len(chunks) - 1}
+                for i, chunk in enumerate(chunks)]
+    path, _, query = path.partition('?')
+    scope = {
+        'type': 'http', 'method': method, 'path': path, 'raw_path': path.encode(), 'query_string': query.encode(),
+        'headers': [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in headers],
+        'http_version': '1.1', 'scheme': 'http', 'server': ('testserver', 80), 'client': ('127.0.0.1', 1234),
+        'extensions': extensions or {},
+    }
+    sent = []
+
+    async def next_message():
+        if messages:
+            return messages.pop(0)
+        await asyncio.sleep(3600)
+
+    async def send(message):
+        if message['type'] == 'http.response.zerocopysend':
+            message = dict(message, body=os.pread(message['file'].fileno(), message['count'], message['offset']))
+        sent.append(message)
+
+    asyncio.run(FileUpDownAsgi.app(scope, receive or next_message, send))
+    start = sent[0]
+    headers = {k.decode('latin-1'): v.decode('latin-1') for k, v in start['headers']}
+    return start['status'], headers, b''.join(m.get('body', b'') for m in sent[1:]), sent
+
+
+def test_chunked_request_body_reaches_the_handler(client):
+    upload_id = client.post('/file/upload/chunked/', json={'filename': 'asgi.txt', 'size': 10}).json['upload_id']
+    # Transfer-Encoding: chunked, no Content-Length
+    status, _, body, _ = __request('PUT', '/file/upload/chunked/%s/0' % upload_id,
+                                   headers=[('transfer-encoding', 'chunked')], chunks=[b'01234', b'56789', b''])
+    assert status == 200, body
+    status, _, body, _ = __request('PUT', '/file/upload/chunked/%s/0' % upload_id, body=b'0123456789',
+                                   headers=[('content-length', '10')])
+    assert status == 200, body
+    item = client.post('/file/upload/chunked/%s/complete' % upload_id).json
+    assert item['hash'] == hashlib.md5(b'0123456789').hexdigest()
+
+
+def test_file_is_sent_from_its_descriptor(upload):
+    data = os.urandom(600 * 1024)
+    name = upload('asgi.bin', data)['path']
+    status, headers, body, sent = __request('GET', '/file/download/' + name)
+    assert status == 200
+    assert int(headers['content-length']) == len(data)
+    assert body == data
+    assert sent[-1] == {'type': 'http.response.body', 'body': b'', 'more_body': False}
+    status, _, body, sent = __request('GET', '/file/download/' + name,
+                                      extensions={'http.response.zerocopysend': {}})
+    assert body == data
+    assert sent[1]['type'] == 'http.response.zerocopysend'
+
+
+def test_range_and_streamed_bodies(upload):
+    data = os.urandom(10000)
+    name = upload('asgi-range.bin', data)['path']
+    status, headers, body, _ = __request('GET', '/file/download/' + name, headers=[('range', 'bytes=100-199')])
+    assert status == 206
+    assert body == data[100:200]
+    status, headers, body, _ = __request('GET', '/file/download/' + name, headers=[('range', 'bytes=0-0,-1')])
+    assert status == 206
+    assert headers['content-type'].startswith('multipart/byteranges')
+    assert int(headers['content-length']) == len(body)
+
+
+def test_write_callable(monkeypatch):
+    class App:
+        @staticmethod
+        def wsgi_app(environ, start_response):
+            write = start_response('200 OK', [('Content-Type', 'text/plain')])
+            write(b'written ')
+            return [b'then ', b'returned']
+    monkeypatch.setattr(FileUpDownAsgi, 'flask_app', App)
+    status, _, body, _ = __request('GET', '/')
+    assert status == 200
+    assert body == b'written then returned'
+
+
+def test_handler_reads_the_body_while_it_is_received(monkeypatch):
+    first_read = threading.Event()
+    seen = {}
+
+    class App:
+        @staticmethod
+        def wsgi_app(environ, start_response):
+            stream = environ['wsgi.input']
+            head = stream.read(5)
+            first_read.set()
+            rest = stream.read()
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            return [head, b'|', rest]
+
+    async def receive():
+        if 'first' not in seen:
+            seen['first'] = True
+            return {'type': 'http.request', 'body': b'01234', 'more_body': True}
+        # the last message only comes once the handler has read the first one
+        seen['streamed'] = await asyncio.get_running_loop().run_in_executor(None, first_read.wait, 5)
+        return {'type': 'http.request', 'body': b'56789', 'more_body': False}
+
+    monkeypatch.setattr(FileUpDownAsgi, 'flask_app', App)
+    status, _, body, _ = __request('PUT', '/', receive=receive)
+    assert seen['streamed']
+    assert status == 200
+    assert body == b'01234|56789'
+
+
+def test_client_gone_before_the_end_of_the_body(monkeypatch):
+    errors = []
+
+    class App:
+        @staticmethod
+        def wsgi_app(environ, start_response):
+            try:
+                environ['wsgi.input'].read()
+            except ClientDisconnected as ex:
+                errors.append(ex)
+            start_response('400 Bad Request', [])
+            return []
+
+    monkeypatch.setattr(FileUpDownAsgi, 'flask_app', App)
+    messages = [{'type': 'http.request', 'body': b'0123', 'more_body': True}, {'type': 'http.disconnect'}]
+
+    async def receive():
+        return messages.pop(0)
+
+    status, _, _, _ = __request('PUT', '/', receive=receive)
+    assert status == 400
+    assert len(errors) == 1
+
+
+def test_max_content_length_holds_without_content_length(client, monkeypatch):
+    upload_id = client.post('/file/upload/chunked/', json={'filename': 'big.txt', 'size': 100}).json['upload_id']
+    monkeypatch.setitem(FileUpDownAsgi.flask_app.config, 'MAX_CONTENT_LENGTH', 10)
+    status, _, _, _ = __request('PUT', '/file/upload/chunked/%s/0' % upload_id,
+                                headers=[('transfer-encoding', 'chunked')], chunks=[b'x' * 8, b'x' * 8, b''])
+    assert status == 413
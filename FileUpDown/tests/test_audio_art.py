@@ -0,0 +1,89 @@
+# encoding: utf-8
+import io
+import os
+
+import pytest
+from mutagen.id3 import ID3, APIC
+from PIL import Image
+
+from Service import Derivative, FileInfo, FileService, MetaIndex, StoreLayout, Transform
+
+COVER = {'cover': 1, 'mime': 'audio/mpeg'}
+
+
+@pytest.fixture
+def picture():
+    buf = io.BytesIO()
+    Image.frombytes('RGB', (300, 300), os.urandom(300 * 300 * 3)).save(buf, 'JPEG')
+    return buf.getvalue()
+
+
+@pytest.fixture
+def mp3(tmp_path):
+    """
+    :return: `mp3(picture=None, frames=20)` -> bytes of a short silent MP3, with `picture` as its ID3 cover art
+    """
+    def mp3(picture=None, frames=20):
+        path = tmp_path / 'track.mp3'
+        # MPEG-1 layer III frames, 128 kbit/s at 44.1 kHz
+        path.write_bytes((b'\xff\xfb\x90\x64' + b'\x00' * 413) * frames)
+        if picture is not None:
+            tags = ID3()
+            tags.add(APIC(encoding=3, mime='image/jpeg', type=3, desc='', data=picture))
+            tags.save(str(path))
+        return path.read_bytes()
+    return mp3
+
+
+def __no_parse(monkeypatch):
+    """
+    Fail any tag parse from now on: covers of indexed tracks must not need one.
+    """
+    def parse(path):
+        raise AssertionError('tags parsed for ' + path)
+    monkeypatch.setattr(FileInfo, 'audio_cover', parse)
+
+
+def test_art_is_indexed_at_upload(upload, mp3, picture):
+    name = upload('indexed.mp3', mp3(picture), 'audio/mpeg')['path']
+    path = StoreLayout.store_path(name)
+    info = MetaIndex.get(name, path)
+    assert info['art_mime'] == 'image/jpeg'
+    assert info['art_length'] == len(picture)
+    with open(path, 'rb') as f:
+        f.seek(info['art_offset'])
+        assert f.read(info['art_length']) == picture
+
+
+def test_original_art_is_a_range_of_the_track(client, upload, mp3, picture, monkeypatch):
+    name = upload('raw.mp3', mp3(picture), 'audio/mpeg')['path']
+    __no_parse(monkeypatch)
+    response = client.get('/file/download/' + name, query_string=COVER)
+    assert response.status_code == 200
+    assert response.mimetype == 'image/jpeg'
+    assert response.data == picture
+    assert not os.path.exists(FileService.get_file_cache_base_dir(name))
+
+
+def test_tracks_sharing_art_share_its_derivatives(client, upload, mp3, picture, monkeypatch):
+    built = []
+    audio_thumbnail = Transform.audio_thumbnail
+    monkeypatch.setattr(Transform, 'audio_thumbnail', lambda *args: built.append(args) or audio_thumbnail(*args))
+    names = [upload('album-%d.mp3' % i, mp3(picture, frames=20 + i), 'audio/mpeg')['path'] for i in range(3)]
+    for name in names:
+        response = client.get('/file/download/' + name, query_string=dict(COVER, side=100))
+        assert response.status_code == 200
+        assert Image.open(io.BytesIO(response.data)).size == (100, 100)
+    assert len(built) == 1
+    art = FileInfo.indexed_art(StoreLayout.store_path(names[0]))
+    owner = Derivative.cover_owner(StoreLayout.store_path(names[0]), art)
+    assert owner == '@art_' + art['art_hash']
+    assert any(entry.startswith('@100x100') for entry in os.listdir(FileService.get_file_cache_base_dir(owner)))
+
+
+def test_track_without_art(client, upload, mp3, monkeypatch):
+    name = upload('bare.mp3', mp3(), 'audio/mpeg')['path']
+    __no_parse(monkeypatch)
+    assert MetaIndex.get(name, StoreLayout.store_path(name))['art_hash'] == ''
+    assert client.get('/file/download/' + name, query_string=COVER).status_code == 404
+    assert client.get('/file/download/' + name, query_string=dict(COVER, side=100)).status_code == 404
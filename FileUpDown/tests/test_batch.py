@@ -0,0 +1,96 @@
+# encoding: utf-8
+import json
+import os
+import threading
+import time
+
+from Service import FileService, Reaper, StoreLayout
+
+
+def __stored(upload, count, prefix):
+    return [upload('%s-%d.txt' % (prefix, i), b'batch %s %d' % (prefix.encode(), i), 'text/plain')['path']
+            for i in range(count)]
+
+
+def __cache_dir(name):
+    path = FileService.get_file_cache_base_dir(name, mk_dir=True)
+    with open(os.path.join(path, 'derivative'), 'wb') as f:
+        f.write(b'x')
+    return path
+
+
+def __lines(response):
+    return [json.loads(line) for line in response.data.decode('utf-8').splitlines()]
+
+
+def test_del_answers_in_the_order_of_names(client, upload):
+    names = __stored(upload, 5, 'del')
+    cache_dir = __cache_dir(names[0])
+    response = client.post('/file/del', json={'names': names})
+    assert response.status_code == 200
+    assert [item['name'] for item in response.json] == names
+    assert all(item['result'] for item in response.json)
+    for name in names:
+        assert not os.path.exists(StoreLayout.store_path(name))
+    assert not os.path.exists(cache_dir)
+
+
+def test_deferred_del_hands_the_cache_directory_to_the_reaper(client, upload):
+    name = __stored(upload, 1, 'defer')[0]
+    cache_dir = __cache_dir(name)
+    response = client.post('/file/del', json={'names': [name], 'defer': True})
+    assert response.json == [{'name': name, 'result': True}]
+    assert not os.path.exists(cache_dir)
+    deadline = time.time() + 5
+    while os.listdir(Reaper.trash_dir()) and time.time() < deadline:
+        time.sleep(0.01)
+    Reaper.reap()
+    assert os.listdir(Reaper.trash_dir()) == []
+
+
+def test_del_streams_ndjson(client, upload):
+    names = __stored(upload, 4, 'stream')
+    response = client.post('/file/del', json={'names': names, 'stream': True})
+    assert response.mimetype == 'application/x-ndjson'
+    lines = __lines(response)
+    assert sorted(line['name'] for line in lines) == sorted(names)
+    assert all(line['result'] for line in lines)
+
+
+def test_info_batch(client, upload):
+    names = __stored(upload, 3, 'info') + ['missing-info.txt']
+    items = client.get('/file/info', json={'names': names}).json
+    assert [item['name'] for item in items] == names
+    assert [item['flag'] for item in items] == [True, True, True, False]
+    assert items[0]['mime'] == 'text/plain'
+    response = client.get('/file/info', json={'names': names}, headers={'Accept': 'application/x-ndjson'})
+    assert response.mimetype == 'application/x-ndjson'
+    assert sorted(line['name'] for line in __lines(response)) == sorted(names)
+
+
+def test_as_completed_keeps_a_window_and_cancels_on_close(monkeypatch):
+    monkeypatch.setattr('GlobalConfigContext.Batch_Workers', 2)
+    lock = threading.Lock()
+    running = [0, 0]
+    started = []
+
+    def work(item):
+        with lock:
+            started.append(item)
+            running[0] += 1
+            running[1] = max(running[1], running[0])
+        time.sleep(0.01)
+        with lock:
+            running[0] -= 1
+        return item * 2
+
+    results = FileService.as_completed(work, range(100))
+    for _ in range(10):
+        index, result = next(results)
+        assert result == index * 2
+    results.close()
+    time.sleep(0.1)
+    # the window is 2 * Batch_Workers submitted at a time, the rest is never started
+    assert running[1] <= 4
+    assert len(started) <= 10 + 4
+    assert dict(FileService.as_completed(work, range(5))) == {i: i * 2 for i in range(5)}
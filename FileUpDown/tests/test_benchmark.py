@@ -0,0 +1,60 @@
+# encoding: utf-8
+import json
+
+from Benchmark import Cases
+from Benchmark import Run
+
+
+def __report(path, commit, **cases):
+    with open(path, 'w') as f:
+        json.dump({'meta': {'commit': commit}, 'cases': cases}, f)
+    return str(path)
+
+
+def test_compare_flags_a_slower_case(tmp_path, capsys):
+    before = __report(tmp_path / 'before.json', 'a', upload={'p50_ms': 10.0, 'throughput_rps': 100.0})
+    after = __report(tmp_path / 'after.json', 'b', upload={'p50_ms': 12.0, 'throughput_rps': 100.0})
+    assert Run.main(['--compare', before, after]) == 1
+    assert 'p50_ms +20.0% REGRESSION' in capsys.readouterr().out
+
+
+def test_compare_within_threshold_passes(tmp_path, capsys):
+    before = __report(tmp_path / 'before.json', 'a', upload={'p50_ms': 10.0, 'throughput_rps': 100.0})
+    after = __report(tmp_path / 'after.json', 'b', upload={'p50_ms': 10.5, 'throughput_rps': 95.0},
+                     gif_side={'p50_ms': 1.0})
+    assert Run.compare(before, after) == 0
+    out = capsys.readouterr().out
+    assert 'REGRESSION' not in out
+    assert 'only in after' in out
+
+
+def test_compare_lower_throughput_is_a_regression(tmp_path):
+    before = __report(tmp_path / 'before.json', 'a', upload={'throughput_rps': 100.0})
+    after = __report(tmp_path / 'after.json', 'b', upload={'throughput_rps': 50.0})
+    assert Run.compare(before, after, threshold=0.4) == 1
+    assert Run.compare(before, after, threshold=0.6) == 0
+
+
+def test_drive_counts_statuses_and_bytes():
+    sent = []
+
+    def send(method, url, headers, body):
+        sent.append(url)
+        return (200, 10) if url != '/3' else (500, 0)
+
+    case = Cases.Case('fake', 'fake path', lambda i: ('GET', '/%d' % i, {}, None), iterations=8, warmup=2)
+    result = getattr(Run, '__drive')(send, case, 4)
+    assert sorted(sent[:2]) == ['/-1', '/-2']
+    assert result['requests'] == 8
+    assert result['errors'] == 1
+    assert result['statuses'] == {'200': 7, '500': 1}
+    assert result['bytes'] == 70
+    assert result['p50_ms'] <= result['p99_ms'] <= result['max_ms']
+
+
+def test_percentile_nearest_rank():
+    percentile = getattr(Run, '__percentile')
+    values = list(range(1, 101))
+    assert percentile(values, 50) == 50
+    assert percentile(values, 99) == 99
+    assert percentile([7], 99) == 7
@@ -0,0 +1,122 @@
+# encoding: utf-8
+import os
+import time
+
+import pytest
+
+import GlobalConfigContext
+from Service import CacheManager, Reaper
+
+
+def __store(directory, name, size):
+    path = str(directory / name)
+    with open(path, 'wb') as f:
+        f.write(b'x' * size)
+    CacheManager.commit(path)
+    return path
+
+
+def test_commit_counts_bytes(cache):
+    __store(cache, '@150x150@quality_85_compressCacheThumbnail', 1000)
+    __store(cache, '@300x300@quality_85_compressCacheThumbnail', 3000)
+    stats = CacheManager.stats()
+    assert stats['bytes'] == 4000
+    assert stats['entries'] == 2
+    assert stats['stores'] == 2
+
+
+def test_least_recently_used_are_evicted_below_the_low_water_mark(cache, monkeypatch):
+    monkeypatch.setattr(GlobalConfigContext, 'FileCache_Max_Bytes', 2500)
+    monkeypatch.setattr(GlobalConfigContext, 'FileCache_Low_Water', 0.8)
+    old = __store(cache, '@1x1@quality_85_compressCacheThumbnail', 1000)
+    used = __store(cache, '@2x2@quality_85_compressCacheThumbnail', 1000)
+    time.sleep(0.01)
+    assert CacheManager.lookup(used)
+    # over budget: down to 2000 bytes, the oldest access goes first
+    new = __store(cache, '@3x3@quality_85_compressCacheThumbnail', 1000)
+    assert not os.path.exists(old)
+    assert os.path.exists(used) and os.path.exists(new)
+    stats = CacheManager.stats()
+    assert stats['bytes'] == 2000
+    assert stats['evictions'] == 1
+    assert stats['evicted_bytes'] == 1000
+
+
+def test_lookup_counts_hits_and_misses(cache):
+    path = __store(cache, '@cover', 10)
+    assert CacheManager.lookup(path)
+    assert not CacheManager.lookup(path + '.missing')
+    stats = CacheManager.stats()
+    assert (stats['hits'], stats['misses']) == (1, 1)
+
+
+def test_cached_only_raises_miss_before_building(cache):
+    cache_path = str(cache / '@cover')
+    with CacheManager.cached_only():
+        with pytest.raises(CacheManager.Miss):
+            with CacheManager.produce(cache_path):
+                pass
+    with CacheManager.produce(cache_path) as temp_path:
+        with open(temp_path, 'wb') as f:
+            f.write(b'x')
+    with CacheManager.cached_only():
+        with CacheManager.produce(cache_path) as temp_path:
+            assert temp_path is None
+
+
+def test_cached_only_pass_then_build_counts_a_miss_once(cache):
+    cache_path = str(cache / '@cover')
+    cached = str(cache / '@150x150@quality_80')
+    with open(cached, 'wb') as f:
+        f.write(b'x')
+    # what a batch does: a first pass serving only what is cached, then the build of what it missed
+    with CacheManager.cached_only():
+        assert CacheManager.lookup(cached)
+        assert not CacheManager.lookup(cache_path)
+        try:
+            with CacheManager.produce(cache_path):
+                pass
+        except CacheManager.Miss:
+            pass
+    assert (CacheManager.stats()['hits'], CacheManager.stats()['misses']) == (0, 0)
+    assert CacheManager.lookup(cached)
+    assert not CacheManager.lookup(cache_path)
+    assert (CacheManager.stats()['hits'], CacheManager.stats()['misses']) == (1, 1)
+    # a block served from the cache counts its lookups
+    with CacheManager.cached_only():
+        assert CacheManager.lookup(cached)
+    assert CacheManager.stats()['hits'] == 2
+
+
+def test_rebuild_tracks_untracked_files_and_drops_missing_ones(cache):
+    tracked = __store(cache, '@tracked', 100)
+    with open(str(cache / '@untracked'), 'wb') as f:
+        f.write(b'y' * 50)
+    os.remove(tracked)
+    CacheManager.rebuild()
+    stats = CacheManager.stats()
+    assert stats['entries'] == 1
+    assert stats['bytes'] == 50
+
+
+
+def test_rebuild_counts_an_entry_committed_during_its_scan_once(cache, monkeypatch):
+    trash_dir = Reaper.trash_dir
+
+    def committed_meanwhile():
+        # called once the known rows are read, before the walk
+        __store(cache, '@raced', 70)
+        return trash_dir()
+
+    monkeypatch.setattr(Reaper, 'trash_dir', committed_meanwhile)
+    CacheManager.rebuild()
+    stats = CacheManager.stats()
+    assert stats['entries'] == 1
+    assert stats['bytes'] == 70
+
+def test_forget_dir(cache):
+    __store(cache, '@a', 10)
+    __store(cache, '@b', 20)
+    CacheManager.forget_dir(str(cache))
+    stats = CacheManager.stats()
+    assert (stats['entries'], stats['bytes']) == (0, 0)
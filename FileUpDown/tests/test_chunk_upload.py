@@ -0,0 +1,94 @@
+# encoding: utf-8
+import hashlib
+import io
+import os
+import threading
+import time
+
+import pytest
+
+from Service import ChunkUpload, StoreLayout
+
+PART = 64 * 1024
+
+
+@pytest.fixture
+def data():
+    return os.urandom(PART * 2 + 1000)
+
+
+def __init(client, data, filename='chunked.bin'):
+    response = client.post('/file/upload/chunked/', json={'filename': filename, 'size': len(data), 'part_size': PART})
+    assert response.status_code == 200
+    return response.json['upload_id']
+
+
+def __put(client, upload_id, part, body, **params):
+    return client.put('/file/upload/chunked/%s/%d' % (upload_id, part), data=body, query_string=params)
+
+
+def test_parts_in_any_order_then_complete(client, data):
+    upload_id = __init(client, data)
+    assert __put(client, upload_id, 2, data[2 * PART:]).status_code == 200
+    assert __put(client, upload_id, 0, data[:PART]).status_code == 200
+    assert client.get('/file/upload/chunked/' + upload_id).json['missing'] == [1]
+    assert client.post('/file/upload/chunked/%s/complete' % upload_id).status_code == 409
+    # a refused complete gives the upload back
+    part_hash = hashlib.md5(data[PART:2 * PART]).hexdigest()
+    assert __put(client, upload_id, 1, data[PART:2 * PART], hash=part_hash).status_code == 200
+    item = client.post('/file/upload/chunked/%s/complete' % upload_id).json
+    assert item['flag']
+    assert item['size'] == len(data)
+    assert item['hash'] == hashlib.md5(data).hexdigest()
+    with open(StoreLayout.store_path(item['path']), 'rb') as f:
+        assert f.read() == data
+    assert client.get('/file/upload/chunked/' + upload_id).status_code == 404
+
+
+def test_refused_parts(client, data):
+    upload_id = __init(client, data)
+    assert __put(client, upload_id, 0, data[:PART - 1]).status_code == 400
+    assert __put(client, upload_id, 0, data[:PART], hash='0' * 32).status_code == 400
+    assert __put(client, upload_id, 3, b'x').status_code == 400
+    assert client.get('/file/upload/chunked/' + upload_id).json['parts'] == []
+    assert client.delete('/file/upload/chunked/' + upload_id).status_code == 200
+    assert __put(client, upload_id, 0, data[:PART]).status_code == 404
+
+
+@pytest.mark.parametrize('filename', ['../escape.bin', 'a/b.bin', 'a\\b.bin', '..'])
+def test_filename_with_a_path_is_refused(client, filename):
+    response = client.post('/file/upload/chunked/', json={'filename': filename, 'size': 1, 'part_size': PART})
+    assert response.status_code == 400
+
+
+class __SlowStream:
+
+    def __init__(self, data, started):
+        self.data = io.BytesIO(data)
+        self.started = started
+
+    def read(self, size):
+        self.started.set()
+        time.sleep(0.01)
+        return self.data.read(4096)
+
+
+def test_complete_waits_for_a_part_being_written(data):
+    upload = ChunkUpload.init('racing.bin', size=len(data), part_size=PART)
+    upload_id = upload['upload_id']
+    ChunkUpload.put_part(upload_id, 0, io.BytesIO(data[:PART]))
+    ChunkUpload.put_part(upload_id, 2, io.BytesIO(data[2 * PART:]))
+    started = threading.Event()
+    writer = threading.Thread(target=ChunkUpload.put_part, args=(upload_id, 1, __SlowStream(data[PART:2 * PART], started)))
+    writer.start()
+    started.wait()
+    flag, message, name, mime, exif, size, file_hash = ChunkUpload.complete(upload_id)
+    writer.join()
+    assert flag, message
+    assert file_hash == hashlib.md5(data).hexdigest()
+    with open(StoreLayout.store_path(name), 'rb') as f:
+        assert f.read() == data
+    # a part arriving once the file is stored does not touch it
+    with pytest.raises(ChunkUpload.UploadError) as ex:
+        ChunkUpload.put_part(upload_id, 1, io.BytesIO(b'\0' * PART))
+    assert ex.value.status == 404
@@ -0,0 +1,53 @@
+# encoding: utf-8
+import hashlib
+import os
+
+import pytest
+
+
+@pytest.fixture
+def stored(upload):
+    data = os.urandom(4096)
+    return upload('conditional.bin', data)['path'], data
+
+
+def test_stored_file_etag_is_its_hash(client, stored):
+    name, data = stored
+    response = client.get('/file/download/' + name)
+    assert response.headers['ETag'] == '"%s"' % hashlib.md5(data).hexdigest()
+    assert response.headers['Last-Modified']
+
+
+def test_if_none_match_and_if_modified_since_answer_304(client, stored):
+    name, _ = stored
+    first = client.get('/file/download/' + name)
+    response = client.get('/file/download/' + name, headers={'If-None-Match': first.headers['ETag']})
+    assert response.status_code == 304
+    assert response.data == b''
+    assert response.headers['ETag'] == first.headers['ETag']
+    response = client.get('/file/download/' + name, headers={'If-Modified-Since': first.headers['Last-Modified']})
+    assert response.status_code == 304
+    response = client.get('/file/download/' + name, headers={'If-None-Match': '"other"'})
+    assert response.status_code == 200
+
+
+def test_variants_have_their_own_etag(client, upload, jpeg):
+    name = upload('variant.jpg', jpeg(200, 100), 'image/jpeg')['path']
+    full = client.get('/file/download/' + name).headers['ETag']
+    small = client.get('/file/download/%s?side=50' % name).headers['ETag']
+    larger = client.get('/file/download/%s?side=80' % name).headers['ETag']
+    assert len({full, small, larger}) == 3
+    response = client.get('/file/download/%s?side=50' % name, headers={'If-None-Match': small})
+    assert response.status_code == 304
+
+
+def test_if_range(client, stored):
+    name, data = stored
+    etag = client.get('/file/download/' + name).headers['ETag']
+    response = client.get('/file/download/' + name, headers={'Range': 'bytes=0-9', 'If-Range': etag})
+    assert response.status_code == 206
+    assert response.data == data[:10]
+    # a stale validator gets the whole file
+    response = client.get('/file/download/' + name, headers={'Range': 'bytes=0-9', 'If-Range': '"stale"'})
+    assert response.status_code == 200
+    assert response.data == data
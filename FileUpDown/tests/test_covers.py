@@ -0,0 +1,91 @@
+# encoding: utf-8
+import email
+import io
+import os
+import threading
+
+from PIL import Image
+
+import GlobalConfigContext
+from Service import CacheManager, TransformExecutor
+
+
+def __parts(response):
+    """
+    :return: list of <name, X-Status, body> of a /covers response, in the order they were sent
+    """
+    assert response.status_code == 200
+    message = email.message_from_bytes(b'Content-Type: ' + response.headers['Content-Type'].encode() + b'\r\n\r\n'
+                                       + response.data)
+    parts = []
+    for part in message.get_payload():
+        name = part.get_filename()
+        parts.append((name, int(part['X-Status']), part.get_payload(decode=True)))
+    return parts
+
+
+def test_covers_of_many_files(client, upload, jpeg):
+    names = [upload('cover-%d.jpg' % i, jpeg(400, 300), 'image/jpeg')['path'] for i in range(3)]
+    parts = __parts(client.post('/file/covers', json={'names': names + ['missing.jpg'], 'side': 100}))
+    assert sorted(name for name, _, _ in parts) == sorted(names + ['missing.jpg'])
+    for name, status, body in parts:
+        if name == 'missing.jpg':
+            assert status == 404
+            assert not body
+        else:
+            assert status == 200
+            assert Image.open(io.BytesIO(body)).size == (100, 75)
+
+
+def test_cached_covers_come_first(client, upload, jpeg):
+    names = [upload('order-%d.jpg' % i, jpeg(400, 300), 'image/jpeg')['path'] for i in range(4)]
+    client.post('/file/covers', json={'names': names[2:], 'side': 100})
+    parts = __parts(client.post('/file/covers', json={'names': names, 'side': 100}))
+    assert [name for name, _, _ in parts[:2]] == names[2:]
+    assert [status for _, status, _ in parts] == [200] * 4
+
+
+def test_builds_run_on_the_cover_pool_and_count_a_miss_once(client, upload, jpeg, monkeypatch):
+    name = upload('pool.jpg', jpeg(400, 300), 'image/jpeg')['path']
+    threads = []
+    run = TransformExecutor.run
+
+    def recorded(fn, *args, **kwargs):
+        threads.append(threading.current_thread().name)
+        return run(fn, *args, **kwargs)
+
+    monkeypatch.setattr(TransformExecutor, 'run', recorded)
+    before = CacheManager.stats()
+    assert __parts(client.post('/file/covers', json={'names': [name], 'side': 120}))[0][1] == 200
+    after = CacheManager.stats()
+    assert threads and all(thread.startswith('covers') for thread in threads)
+    assert after['misses'] - before['misses'] == 1
+    assert after['hits'] == before['hits']
+
+
+def test_busy_pool_gives_a_503_part_after_bounded_waits(client, upload, jpeg, monkeypatch):
+    name = upload('busy-cover.jpg', jpeg(400, 300), 'image/jpeg')['path']
+    calls = []
+
+    def busy(*args, **kwargs):
+        calls.append(args)
+        raise TransformExecutor.Busy(0)
+
+    monkeypatch.setattr(TransformExecutor, 'run', busy)
+    monkeypatch.setattr('GlobalConfigContext.Transform_Stream_Retries', 2)
+    parts = __parts(client.post('/file/covers', json={'names': [name], 'side': 100}))
+    assert len(parts) == 1
+    assert parts[0][:2] == (name, 503)
+    assert not parts[0][2]
+    assert len(calls) == 3
+
+
+def test_names_outside_the_store_are_refused(client, tmp_path, jpeg):
+    secret = tmp_path / 'secret.jpg'
+    secret.write_bytes(jpeg(400, 300))
+    relative = os.path.relpath(str(secret), GlobalConfigContext.FileStore_Directory)
+    for name in (relative, str(secret)):
+        response = client.post('/file/covers', json={'names': [name]})
+        assert response.status_code == 400
+        assert secret.read_bytes() not in response.data
+        assert client.get('/file/covers', query_string={'names': name, 'side': 100}).status_code == 400
@@ -0,0 +1,48 @@
+# encoding: utf-8
+import os
+
+import pytest
+
+import GlobalConfigContext
+from Service import BlobStore, FileService, StoreLayout
+
+
+@pytest.fixture
+def dedup(monkeypatch):
+    monkeypatch.setattr(GlobalConfigContext, 'Dedup_Enabled', True)
+
+
+def test_same_bytes_are_stored_once(dedup, client, upload):
+    data = os.urandom(50000)
+    before = BlobStore.stats()
+    first = upload('dup-a.bin', data)
+    second = upload('dup-b.bin', data)
+    a, b = StoreLayout.store_path(first['path']), StoreLayout.store_path(second['path'])
+    assert os.path.samefile(a, b)
+    assert os.path.samefile(a, BlobStore.blob_path(first['hash'], 'md5'))
+    stats = client.get('/file/dedup/stats').json
+    assert stats['duplicates'] == before['duplicates'] + 1
+    assert stats['saved_bytes'] == before['saved_bytes'] + len(data)
+    # both names share one derivative cache directory
+    assert (FileService.get_file_cache_base_dir(first['path'])
+            == FileService.get_file_cache_base_dir(second['path'])
+            == BlobStore.shared_cache_dir(first['hash'], 'md5'))
+
+
+def test_blob_goes_with_the_last_name(dedup, client, upload):
+    data = os.urandom(20000)
+    items = [upload('release-%d.bin' % i, data) for i in range(3)]
+    blob = BlobStore.blob_path(items[0]['hash'], 'md5')
+    shared = BlobStore.shared_cache_dir(items[0]['hash'], 'md5')
+    response = client.post('/file/del', json={'names': [item['path'] for item in items[:2]]})
+    assert [r['result'] for r in response.json] == [True, True]
+    assert os.path.exists(blob) and os.path.isdir(shared)
+    assert client.post('/file/del', json={'names': [items[2]['path']]}).json[0]['result']
+    assert not os.path.exists(blob)
+    assert not os.path.exists(shared)
+
+
+def test_different_bytes_keep_their_own_blob(dedup, upload):
+    first = upload('own-a.bin', b'a' * 1000)
+    second = upload('own-b.bin', b'b' * 1000)
+    assert not os.path.samefile(StoreLayout.store_path(first['path']), StoreLayout.store_path(second['path']))
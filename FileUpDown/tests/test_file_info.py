@@ -0,0 +1,86 @@
+# encoding: utf-8
+import difflib
+
+import magic
+import pytest
+
+from Service import FileInfo, MetaIndex, StoreLayout
+
+
+@pytest.fixture
+def sniffed(monkeypatch):
+    """
+    :return: list of the paths libmagic sniffed, from an empty MIME cache
+    """
+    getattr(FileInfo, '__mime_cache').clear()
+    calls = []
+    from_file = magic.from_file
+
+    def counted(filename, mime=False):
+        calls.append(filename)
+        return from_file(filename, mime=mime)
+
+    monkeypatch.setattr(magic, 'from_file', counted)
+    return calls
+
+
+def test_mime_is_sniffed_once_per_file_version(tmp_path, sniffed):
+    path = tmp_path / 'page.html'
+    path.write_bytes(b'<html><body>hello</body></html>')
+    assert FileInfo.mime_type(path=str(path)) == 'text/html'
+    assert FileInfo.mime_type(path=str(path)) == 'text/html'
+    assert sniffed == [str(path)]
+    path.write_bytes(b'plain words, longer than before')
+    assert FileInfo.mime_type(path=str(path)) == 'text/plain'
+    assert len(sniffed) == 2
+
+
+def test_mime_cache_is_bounded(tmp_path, sniffed, monkeypatch):
+    monkeypatch.setattr('GlobalConfigContext.Mime_Cache_Size', 2)
+    paths = []
+    for i in range(3):
+        path = tmp_path / ('%d.txt' % i)
+        path.write_bytes(b'text %d' % i)
+        paths.append(str(path))
+        FileInfo.mime_type(path=paths[-1])
+    assert len(getattr(FileInfo, '__mime_cache')) == 2
+    FileInfo.mime_type(path=paths[0])
+    assert sniffed == paths + [paths[0]]
+
+
+def test_stored_file_takes_the_indexed_mime(upload, sniffed):
+    item = upload('indexed.html', b'<html><body>indexed</body></html>', 'text/html')
+    getattr(FileInfo, '__mime_cache').clear()
+    del sniffed[:]
+    path = StoreLayout.store_path(item['path'])
+    assert FileInfo.mime_type(path=path) == item['mime']
+    assert sniffed == []
+    assert MetaIndex.get(item['path'], path)['extension'] == '.html'
+
+
+@pytest.mark.parametrize('filename, mime, expected', [
+    ('photo.JPG', 'image/jpeg', '.jpg'),
+    ('photo.jpeg', 'image/jpeg', '.jpeg'),
+    ('noext', 'image/png', '.png'),
+    ('wrong.txt', 'image/png', '.png'),
+    ('song.mp3', 'audio/mpeg', '.mp3'),
+])
+def test_extension(filename, mime, expected):
+    assert FileInfo.extension(filename=filename, mime=mime, mime_guess=None) == expected
+
+
+def test_extension_table_is_filled_once_per_mime(monkeypatch):
+    getattr(FileInfo, '__extension_table').pop('image/gif', None)
+    calls = []
+    close_matches = difflib.get_close_matches
+    monkeypatch.setattr(difflib, 'get_close_matches', lambda *args, **kwargs: calls.append(args) or close_matches(
+        *args, **kwargs))
+    for filename in ('a.gif', 'b.bin', 'c'):
+        assert FileInfo.extension(filename=filename, mime='image/gif', mime_guess=None) == '.gif'
+    assert len(calls) == 1
+
+
+def test_unknown_mime_keeps_the_filename_extension():
+    ext = FileInfo.extension(filename='data.custom', mime='application/x-rg-unknown', mime_guess=None)
+    assert ext == '.custom'
+    assert 'application/x-rg-unknown' not in getattr(FileInfo, '__extension_table')
@@ -0,0 +1,45 @@
+# encoding: utf-8
+import io
+import os
+
+import pytest
+from PIL import Image
+
+import GlobalConfigContext
+from Service import CacheManager, Derivative, StoreLayout, TransformExecutor
+
+
+def test_original_that_fits_is_served_without_a_transform(client, upload, jpeg, monkeypatch):
+    data = jpeg(40, 40)
+    name = upload('fits.jpg', data, 'image/jpeg')['path']
+
+    def refuse(*args, **kwargs):
+        raise AssertionError('the pool was asked for an original that fits')
+    monkeypatch.setattr(TransformExecutor, 'run', refuse)
+    response = client.get('/file/download/%s?size=%d' % (name, len(data) // 1024 + 1))
+    assert response.status_code == 200
+    assert response.data == data
+
+
+@pytest.mark.parametrize('max_size', [20, 60])
+def test_output_fits_the_budget_at_the_quality_found(client, upload, jpeg, max_size):
+    name = upload('budget.jpg', jpeg(600, 400), 'image/jpeg')['path']
+    response = client.get('/file/download/%s?size=%d' % (name, max_size))
+    assert response.status_code == 200
+    assert len(response.data) <= max_size * 1024
+    assert Image.open(io.BytesIO(response.data)).size == (600, 400)
+    cache_path = Derivative.fit_size(StoreLayout.store_path(name), max_size=max_size, side=None,
+                                     name=StoreLayout.store_path(name))
+    assert CacheManager.quality_hint(cache_path) is not None
+
+
+def test_quality_hint_goes_with_its_evicted_entry(upload, jpeg, tmp_path, monkeypatch):
+    monkeypatch.setattr(GlobalConfigContext, 'FileCache_Directory', str(tmp_path / 'cache'))
+    monkeypatch.setattr(GlobalConfigContext, 'FileCache_Database', str(tmp_path / 'cache.sqlite3'))
+    name = upload('hinted.jpg', jpeg(300, 200), 'image/jpeg')['path']
+    path = StoreLayout.store_path(name)
+    cache_path = Derivative.fit_size(path, max_size=10, side=None, name=path)
+    assert CacheManager.quality_hint(cache_path) is not None
+    CacheManager.evict(target=0)
+    assert not os.path.exists(cache_path)
+    assert CacheManager.quality_hint(cache_path) is None
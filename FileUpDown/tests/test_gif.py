@@ -0,0 +1,63 @@
+# encoding: utf-8
+import io
+
+import pytest
+from PIL import Image, ImageSequence
+
+from Service import Transform
+
+
+def __gif(frames=6, size=(200, 150), **save):
+    images = [Image.new('RGB', size, (40 * i, 255 - 40 * i, 128)) for i in range(frames)]
+    buf = io.BytesIO()
+    durations = [50 + 10 * i for i in range(frames)]
+    images[0].save(buf, format='GIF', save_all=True, append_images=images[1:], duration=durations, **save)
+    return buf.getvalue()
+
+
+def __resize(tmp_path, data, format='GIF', mode='balanced'):
+    source = tmp_path / 'source.gif'
+    source.write_bytes(data)
+    destination = str(tmp_path / ('resized.' + format.lower()))
+    assert Transform.gif_resize(str(source), destination, 100, 64, mode, format=format)
+    return Image.open(destination)
+
+
+@pytest.mark.parametrize('mode', ['fast', 'balanced', 'small'])
+def test_frames_and_durations_are_kept(tmp_path, mode):
+    im = __resize(tmp_path, __gif(loop=0), mode=mode)
+    assert im.size == (100, 75)
+    assert im.n_frames == 6
+    assert [frame.info['duration'] for frame in ImageSequence.Iterator(im)] == [50 + 10 * i for i in range(6)]
+
+
+def test_play_once_gif_stays_play_once(tmp_path):
+    assert 'loop' not in Image.open(io.BytesIO(__gif())).info
+    assert 'loop' not in __resize(tmp_path, __gif()).info
+    if 'WEBP' in Transform.save_formats():
+        assert __resize(tmp_path, __gif(), format='WEBP').info['loop'] == 1
+
+
+@pytest.mark.parametrize('loop', [0, 3])
+def test_loop_count_is_kept(tmp_path, loop):
+    assert __resize(tmp_path, __gif(loop=loop)).info['loop'] == loop
+    if 'WEBP' in Transform.save_formats():
+        assert __resize(tmp_path, __gif(loop=loop), format='WEBP').info['loop'] == loop
+
+
+def test_gif_thumbnail_endpoint(client, upload):
+    name = upload('anim.gif', __gif(loop=0), 'image/gif')['path']
+    response = client.get('/file/download/' + name, query_string={'side': 100})
+    assert response.status_code == 200
+    im = Image.open(io.BytesIO(response.data))
+    assert im.format == 'GIF'
+    assert im.n_frames == 6
+    assert max(im.size) == 100
+
+
+def test_too_many_frames_serve_a_still(client, upload, monkeypatch):
+    monkeypatch.setattr('GlobalConfigContext.Image_Max_Frames', 3)
+    name = upload('long.gif', __gif(loop=0), 'image/gif')['path']
+    response = client.get('/file/download/' + name, query_string={'side': 100})
+    assert response.status_code == 200
+    assert getattr(Image.open(io.BytesIO(response.data)), 'n_frames', 1) == 1
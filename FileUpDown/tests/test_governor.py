@@ -0,0 +1,45 @@
+# encoding: utf-8
+import subprocess
+
+import pytest
+
+from Service import Governor
+
+
+def __limits(monkeypatch, memory, cpu):
+    monkeypatch.setattr('GlobalConfigContext.Subprocess_Memory_Limit', memory)
+    monkeypatch.setattr('GlobalConfigContext.Subprocess_CPU_Limit', cpu)
+    status, stderr = Governor.run(['sh', '-c', 'ulimit -v >&2; ulimit -t >&2'])
+    assert status == 0
+    return stderr.decode().split()
+
+
+def test_subprocess_runs_under_the_limits(monkeypatch):
+    assert __limits(monkeypatch, 512 * 1024 * 1024, 7) == [str(512 * 1024), '7']
+
+
+def test_no_limit_keeps_the_limits_of_the_server(monkeypatch):
+    inherited = subprocess.run(['sh', '-c', 'ulimit -v; ulimit -t'], stdout=subprocess.PIPE, check=True).stdout
+    assert __limits(monkeypatch, None, None) == inherited.decode().split()
+
+
+def test_status_stderr_and_peak():
+    Governor.begin()
+    assert Governor.run(['sh', '-c', 'echo oops >&2; exit 3']) == (3, b'oops\n')
+    assert Governor.end() > 0
+    assert Governor.run(['sh', '-c', 'kill -9 $$'])[0] == -9
+
+
+def test_missing_program():
+    with pytest.raises(FileNotFoundError):
+        Governor.run(['rg-no-such-program', '--version'])
+
+
+def test_image_limits():
+    Governor.check_image(100, 100, frames=10)
+    with pytest.raises(Governor.TooLarge) as info:
+        Governor.check_image(100 * 1000, 100 * 1000)
+    assert info.value.reason == 'pixels'
+    with pytest.raises(Governor.TooLarge) as info:
+        Governor.check_animation(2000, 2000, 900, 2000)
+    assert info.value.reason == 'frames'
@@ -0,0 +1,65 @@
+# encoding: utf-8
+import os
+import sqlite3
+
+from Service import Database, MetaIndex, StoreLayout
+
+
+def test_put_get_and_stale_rows(tmp_path):
+    path = tmp_path / 'a.txt'
+    path.write_bytes(b'hello')
+    MetaIndex.put('meta-a.txt', str(path), mime='text/plain', exif={'k': [1, 2]}, hash='meta-a', hash_type='md5')
+    info = MetaIndex.get('meta-a.txt', str(path))
+    assert info['mime'] == 'text/plain'
+    assert info['exif'] == {'k': [1, 2]}
+    assert info['size'] == 5
+    # a changed file no longer trusts its row
+    path.write_bytes(b'hello again')
+    assert MetaIndex.get('meta-a.txt', str(path)) is None
+    assert MetaIndex.find_by_hash('meta-a', 'md5')['name'] == 'meta-a.txt'
+    MetaIndex.delete('meta-a.txt')
+    assert MetaIndex.find_by_hash('meta-a', 'md5') is None
+
+
+def test_get_many_leaves_out_missing_names(tmp_path):
+    paths = []
+    for i in range(3):
+        path = tmp_path / ('%d.txt' % i)
+        path.write_bytes(b'x' * i)
+        paths.append(str(path))
+    MetaIndex.put('many-0', paths[0], mime='text/plain')
+    MetaIndex.put('many-2', paths[2], mime='text/plain')
+    found = MetaIndex.get_many(['many-0', 'many-1', 'many-2'], paths)
+    assert sorted(found) == ['many-0', 'many-2']
+    assert found['many-2']['size'] == 2
+
+
+def test_info_answers_from_the_index_without_reading_the_file(client, upload, monkeypatch):
+    item = upload('indexed.txt', b'indexed content', 'text/plain')
+    read = []
+    monkeypatch.setattr('Service.Digest.file_digest', lambda *args, **kwargs: read.append(args) or 'x')
+    response = client.get('/file/info', json={'names': [item['path']]})
+    assert response.json[0]['hash'] == item['hash']
+    assert response.json[0]['mime'] == 'text/plain'
+    assert read == []
+
+
+def test_info_falls_back_to_the_file_and_indexes_it(client, upload):
+    item = upload('unindexed.txt', b'some text', 'text/plain')
+    MetaIndex.delete(item['path'])
+    response = client.get('/file/info', json={'names': [item['path'], 'missing.txt']})
+    assert response.json[0]['hash'] == item['hash']
+    assert response.json[1]['flag'] is False
+    assert MetaIndex.get(item['path'], StoreLayout.store_path(item['path'])) is not None
+
+
+def test_older_database_gets_the_new_columns(tmp_path):
+    path = str(tmp_path / 'old.sqlite3')
+    conn = sqlite3.connect(path)
+    conn.execute('CREATE TABLE file_meta (name TEXT PRIMARY KEY, mime TEXT)')
+    conn.commit()
+    conn.close()
+    conn = Database.connection(path)
+    Database.add_columns(conn, 'file_meta', [('name', 'TEXT PRIMARY KEY'), ('mime', 'TEXT'), ('crc32', 'INTEGER')])
+    assert 'crc32' in {row['name'] for row in conn.execute('PRAGMA table_info(file_meta)')}
+    assert os.path.exists(path)
@@ -0,0 +1,125 @@
+# encoding: utf-8
+import io
+import os
+
+import pytest
+
+from Gateway import MetricsGateway
+from Service import Metrics
+
+DOWNLOAD = '/file/download/<path:filename>'
+
+
+def __value(name, **labels):
+    prefix = name + getattr(Metrics, '__labels')(tuple(sorted(labels.items()))) + ' '
+    for line in Metrics.render().splitlines():
+        if line.startswith(prefix):
+            return float(line[len(prefix):])
+    return 0
+
+
+@pytest.fixture(scope='module')
+def data():
+    return os.urandom(600 * 1024)
+
+
+@pytest.fixture
+def stored(upload, data):
+    return upload('metrics.bin', data)['path']
+
+
+def test_sent_bytes_are_the_bytes_sent(client, stored, data):
+    before = __value('rg_http_sent_bytes_total', route=DOWNLOAD)
+    with client.get('/file/download/' + stored) as response:
+        assert response.data == data
+    with client.get('/file/download/' + stored, headers={'Range': 'bytes=0-99'}) as response:
+        assert response.status_code == 206
+    with client.head('/file/download/' + stored) as response:
+        assert int(response.headers['Content-Length']) == len(data)
+    assert __value('rg_http_sent_bytes_total', route=DOWNLOAD) - before == len(data) + 100
+
+
+def test_abandoned_download_counts_what_was_sent(client, stored, data):
+    before = __value('rg_http_sent_bytes_total', route=DOWNLOAD)
+    in_flight = __value('rg_http_requests_in_flight')
+    response = client.get('/file/download/' + stored, buffered=False)
+    assert __value('rg_http_requests_in_flight') == in_flight + 1
+    first = next(iter(response.response))
+    response.close()
+    assert 0 < len(first) < len(data)
+    assert __value('rg_http_sent_bytes_total', route=DOWNLOAD) - before == len(first)
+    assert __value('rg_http_requests_in_flight') == in_flight
+
+
+def test_received_bytes_are_the_bytes_read(client):
+    route = '/file/upload/chunked/<upload_id>/<int:part>'
+    body = os.urandom(1000)
+    upload_id = client.post('/file/upload/chunked/', json={'filename': 'm.bin', 'size': len(body)}).json['upload_id']
+    before = __value('rg_http_received_bytes_total', route=route)
+    with client.put('/file/upload/chunked/%s/0' % upload_id, data=body) as response:
+        assert response.status_code == 200
+    assert __value('rg_http_received_bytes_total', route=route) - before == len(body)
+    client.delete('/file/upload/chunked/' + upload_id)
+
+
+def __environ(**extra):
+    environ = {'REQUEST_METHOD': 'GET', 'wsgi.input': io.BytesIO()}
+    environ.update(extra)
+    return environ
+
+
+def test_in_flight_is_released_when_the_application_raises():
+    def failing(environ, start_response):
+        raise RuntimeError('boom')
+
+    in_flight = __value('rg_http_requests_in_flight')
+    with pytest.raises(RuntimeError):
+        MetricsGateway.middleware(failing)(__environ(), None)
+    assert __value('rg_http_requests_in_flight') == in_flight
+    assert __value('rg_http_requests_total', route='unmatched', method='GET', status=500) >= 1
+
+
+def test_in_flight_is_released_when_the_body_raises():
+    closed = []
+
+    def body():
+        try:
+            yield b'abc'
+            raise OSError('disk gone')
+        finally:
+            closed.append(True)
+
+    in_flight = __value('rg_http_requests_in_flight')
+    iterable = MetricsGateway.middleware(lambda environ, start_response: body())(__environ(), None)
+    chunks = iter(iterable)
+    assert next(chunks) == b'abc'
+    assert __value('rg_http_requests_in_flight') == in_flight + 1
+    with pytest.raises(OSError):
+        next(chunks)
+    iterable.close()
+    assert closed
+    assert __value('rg_http_requests_in_flight') == in_flight
+
+
+class __Wrapper:
+
+    def __init__(self, filelike, block_size=8192):
+        self.filelike = filelike
+
+    def close(self):
+        self.filelike.close()
+
+
+def test_file_wrapper_counts_how_far_the_file_moved():
+    wrapper = __Wrapper
+    fd = io.BytesIO(b'x' * 1000)
+    fd.seek(100)
+    before = __value('rg_http_sent_bytes_total', route='unmatched')
+    body = MetricsGateway.middleware(lambda environ, start_response: wrapper(fd))(
+        __environ(**{'wsgi.file_wrapper': wrapper}), None)
+    # the server keeps its own wrapper type, e.g. to send it with socket.sendfile
+    assert isinstance(body, wrapper)
+    fd.seek(600)
+    body.close()
+    assert fd.closed
+    assert __value('rg_http_sent_bytes_total', route='unmatched') - before == 500
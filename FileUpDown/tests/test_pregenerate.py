@@ -0,0 +1,53 @@
+# encoding: utf-8
+import glob
+import os
+import time
+
+import pytest
+
+import GlobalConfigContext
+from Service import FileService, Pregenerate
+
+
+def __wait_done(name, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        progress = Pregenerate.progress(name)
+        if progress is not None and progress['state'] in ('done', 'failed'):
+            return progress
+        time.sleep(0.05)
+    raise AssertionError('pregeneration of %s did not finish' % name)
+
+
+def test_off_by_default(upload):
+    assert GlobalConfigContext.Pregenerate_Enabled is False
+    name = upload('not-pregenerated.bin', b'data')['path']
+    assert Pregenerate.progress(name) is None
+
+
+@pytest.fixture
+def enabled(monkeypatch):
+    monkeypatch.setattr(GlobalConfigContext, 'Pregenerate_Enabled', True)
+    monkeypatch.setattr(GlobalConfigContext, 'Pregenerate_Sides', [60, 30])
+    monkeypatch.setattr(GlobalConfigContext, 'Pregenerate_Negotiated', False)
+    Pregenerate.start()
+
+
+def test_upload_builds_the_standard_thumbnails(enabled, upload, jpeg, client):
+    name = upload('pregenerated.jpg', jpeg(200, 100), 'image/jpeg')['path']
+    progress = __wait_done(name)
+    assert progress['state'] == 'done'
+    assert progress['total'] == progress['finished'] == 2
+    cache_dir = FileService.get_file_cache_base_dir(name)
+    names = sorted(os.path.basename(p) for p in glob.glob(os.path.join(cache_dir, '@*')))
+    assert names == ['@30x30@quality_85_compressCacheThumbnail', '@60x60@quality_85_compressCacheThumbnail']
+    assert client.get('/file/derivatives/' + name).json['state'] == 'done'
+
+
+def test_requeue_through_the_gateway(enabled, client, upload):
+    name = upload('requeued.txt', b'no derivatives', 'text/plain')['path']
+    __wait_done(name)
+    response = client.post('/file/derivatives/' + name)
+    assert response.status_code == 200
+    assert __wait_done(name)['total'] == 0
+    assert client.get('/file/derivatives/missing.txt').status_code == 404
@@ -0,0 +1,61 @@
+# encoding: utf-8
+import os
+import threading
+import time
+
+import pytest
+
+import GlobalConfigContext
+from Service import CacheManager
+
+
+def test_concurrent_callers_build_once(cache):
+    cache_path = str(cache / '@cover')
+    builds = []
+    served = []
+
+    def request():
+        with CacheManager.produce(cache_path) as temp_path:
+            if temp_path is not None:
+                builds.append(temp_path)
+                time.sleep(0.05)
+                with open(temp_path, 'wb') as f:
+                    f.write(b'derived')
+        with open(cache_path, 'rb') as f:
+            served.append(f.read())
+
+    threads = [threading.Thread(target=request) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(builds) == 1
+    assert served == [b'derived'] * 8
+    assert CacheManager.stats()['entries'] == 1
+
+
+def test_no_lock_or_temp_file_is_left(cache):
+    for i in range(3):
+        with CacheManager.produce(str(cache / ('@%d' % i))) as temp_path:
+            with open(temp_path, 'wb') as f:
+                f.write(b'x')
+    # a failed build leaves nothing either
+    with pytest.raises(RuntimeError):
+        with CacheManager.produce(str(cache / '@failed')) as temp_path:
+            with open(temp_path, 'wb') as f:
+                f.write(b'partial')
+            raise RuntimeError('transform failed')
+    assert sorted(os.listdir(str(cache))) == ['@0', '@1', '@2']
+
+
+def test_rebuild_removes_leftovers_of_killed_processes(cache):
+    old = cache / '.@old.lock'
+    old.write_bytes(b'')
+    past = time.time() - GlobalConfigContext.Transform_Timeout - 1
+    os.utime(str(old), (past, past))
+    recent = cache / '.@recent.lock'
+    recent.write_bytes(b'')
+    CacheManager.rebuild()
+    assert not old.exists()
+    assert recent.exists()
+
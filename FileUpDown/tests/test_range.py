@@ -0,0 +1,96 @@
+# encoding: utf-8
+import email
+import io
+import os
+import zipfile
+
+import pytest
+from werkzeug.wsgi import FileWrapper
+
+
+@pytest.fixture(scope='module')
+def data():
+    return os.urandom(100 * 1024)
+
+
+@pytest.fixture
+def stored(upload, data):
+    return upload('range.bin', data)['path']
+
+
+@pytest.mark.parametrize('header, start, end', [
+    ('bytes=0-99', 0, 99),
+    ('bytes=1000-', 1000, 100 * 1024 - 1),
+    ('bytes=-500', 100 * 1024 - 500, 100 * 1024 - 1),
+    ('bytes=5000-999999999', 5000, 100 * 1024 - 1),
+])
+def test_single_range(client, stored, data, header, start, end):
+    response = client.get('/file/download/' + stored, headers={'Range': header})
+    assert response.status_code == 206
+    assert response.headers['Content-Range'] == 'bytes %d-%d/%d' % (start, end, len(data))
+    assert int(response.headers['Content-Length']) == end - start + 1
+    assert response.data == data[start:end + 1]
+
+
+def test_every_range_is_served_as_multipart(client, stored, data):
+    response = client.get('/file/download/' + stored, headers={'Range': 'bytes=0-9, 50000-50009, -10'})
+    assert response.status_code == 206
+    assert int(response.headers['Content-Length']) == len(response.data)
+    message = email.message_from_bytes(b'Content-Type: ' + response.headers['Content-Type'].encode() + b'\r\n\r\n'
+                                       + response.data)
+    parts = message.get_payload()
+    assert [part['Content-Range'] for part in parts] == [
+        'bytes 0-9/102400', 'bytes 50000-50009/102400', 'bytes 102390-102399/102400']
+    assert [part.get_payload(decode=True) for part in parts] == [data[0:10], data[50000:50010], data[-10:]]
+
+
+def test_unsatisfiable_range_is_416(client, stored, data):
+    response = client.get('/file/download/' + stored, headers={'Range': 'bytes=200000-'})
+    assert response.status_code == 416
+    assert response.headers['Content-Range'] == 'bytes */%d' % len(data)
+
+
+@pytest.mark.parametrize('header', ['bytes=abc', 'items=0-1', 'bytes=9-1'])
+def test_malformed_range_is_ignored(client, stored, data, header):
+    response = client.get('/file/download/' + stored, headers={'Range': header})
+    assert response.status_code == 200
+    assert response.data == data
+
+
+def test_range_of_an_archive_member(client, upload, data):
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, 'w') as z:
+        z.writestr('stored.bin', data, compress_type=zipfile.ZIP_STORED)
+        z.writestr('deflated.bin', data, compress_type=zipfile.ZIP_DEFLATED)
+    name = upload('members.zip', buf.getvalue(), 'application/zip')['path']
+    for member in ('stored.bin', 'deflated.bin'):
+        response = client.get('/file/download/%s/%s' % (name, member), headers={'Range': 'bytes=10-19'})
+        assert response.status_code == 206
+        assert response.data == data[10:20]
+
+
+class __Wrapper(FileWrapper):
+    """
+    A server file wrapper sending up to the end of the file, as werkzeug's does.
+    """
+    used = []
+
+    def __init__(self, filelike, buffer_size=8192):
+        super().__init__(filelike, buffer_size)
+        self.used.append(self)
+
+
+@pytest.mark.parametrize('header, start, end, wrapped', [
+    ('bytes=0-99', 0, 99, False),
+    ('bytes=5000-5999', 5000, 5999, False),
+    ('bytes=1000-', 1000, 100 * 1024 - 1, True),
+    ('bytes=-500', 100 * 1024 - 500, 100 * 1024 - 1, True),
+])
+def test_file_wrapper_only_for_ranges_to_the_end(client, stored, data, header, start, end, wrapped):
+    wrapper = __Wrapper
+    wrapper.used.clear()
+    response = client.get('/file/download/' + stored, headers={'Range': header},
+                          environ_base={'wsgi.file_wrapper': wrapper})
+    assert response.status_code == 206
+    assert response.data == data[start:end + 1]
+    assert bool(wrapper.used) == wrapped
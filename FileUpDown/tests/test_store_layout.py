@@ -0,0 +1,101 @@
+# encoding: utf-8
+import os
+
+import pytest
+
+import GlobalConfigContext
+from Service import CacheManager, StoreLayout
+
+
+@pytest.fixture
+def layout(tmp_path, monkeypatch):
+    """
+    An empty store and cache of their own, <store dir, cache dir>.
+    """
+    store, cache = tmp_path / 'stores', tmp_path / 'cache'
+    store.mkdir()
+    cache.mkdir()
+    monkeypatch.setattr(GlobalConfigContext, 'FileStore_Directory', str(store))
+    monkeypatch.setattr(GlobalConfigContext, 'FileCache_Directory', str(cache))
+    monkeypatch.setattr(GlobalConfigContext, 'FileCache_Database', str(tmp_path / 'cache.sqlite3'))
+    return store, cache
+
+
+def test_new_names_go_to_their_shard(layout):
+    store, cache = layout
+    path = StoreLayout.store_path('new.jpg')
+    assert os.path.dirname(os.path.dirname(os.path.dirname(path))) == str(store / '.s')
+    assert path == StoreLayout.shard_path(str(store), 'new.jpg')
+    assert StoreLayout.cache_dir('new') == StoreLayout.shard_path(str(cache), 'new')
+
+
+def test_flat_names_keep_resolving(layout, monkeypatch):
+    store, _ = layout
+    (store / 'old.jpg').write_bytes(b'old')
+    assert StoreLayout.store_path('old.jpg') == str(store / 'old.jpg')
+    monkeypatch.setattr(GlobalConfigContext, 'Store_Sharded', False)
+    assert StoreLayout.store_path('other.jpg') == str(store / 'other.jpg')
+
+
+def test_migrate_moves_files_and_cache_directories(layout):
+    store, cache = layout
+    (store / 'old.jpg').write_bytes(b'old')
+    inode = os.stat(str(store / 'old.jpg')).st_ino
+    (cache / 'old').mkdir()
+    thumbnail = cache / 'old' / '@150x150@quality_85_compressCacheThumbnail'
+    thumbnail.write_bytes(b'thumb')
+    CacheManager.commit(str(thumbnail))
+    shared = cache / '.shared' / 'md5' / 'abc'
+    shared.mkdir(parents=True)
+    os.symlink(str(shared), str(cache / 'linked'))
+
+    assert StoreLayout.migrate(pause=0) == {'files': 1, 'cache_dirs': 2, 'conflicts': 0}
+    assert not (store / 'old.jpg').exists()
+    path = StoreLayout.store_path('old.jpg')
+    assert path == StoreLayout.shard_path(str(store), 'old.jpg')
+    assert os.stat(path).st_ino == inode
+    moved = os.path.join(StoreLayout.cache_dir('old'), thumbnail.name)
+    assert open(moved, 'rb').read() == b'thumb'
+    assert os.readlink(StoreLayout.cache_dir('linked')) == str(shared)
+    # the cache rows follow their directory
+    CacheManager.evict(target=0)
+    assert not os.path.exists(moved)
+    assert CacheManager.stats()['bytes'] == 0
+    # a second pass has nothing left to move
+    assert StoreLayout.migrate(pause=0) == {'files': 0, 'cache_dirs': 0, 'conflicts': 0}
+
+
+def test_two_hex_digit_names_are_not_shards(layout):
+    store, cache = layout
+    path = StoreLayout.store_path('new.jpg')
+    os.makedirs(os.path.dirname(path))
+    shard = os.path.relpath(path, str(store / '.s')).split(os.sep)[0]
+    # a name equal to the first level shard of another does not resolve to that directory
+    assert StoreLayout.store_path(shard) == StoreLayout.shard_path(str(store), shard)
+    for name in ('ab', '3f'):
+        path = StoreLayout.store_path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(name.encode())
+        os.makedirs(StoreLayout.cache_dir(name))
+    # and one stored flat before
+    (store / 'cd').write_bytes(b'cd')
+    (cache / 'cd').mkdir()
+    assert StoreLayout.migrate(pause=0) == {'files': 1, 'cache_dirs': 1, 'conflicts': 0}
+    for name in ('ab', '3f', 'cd'):
+        assert StoreLayout.store_path(name) == StoreLayout.shard_path(str(store), name)
+        assert open(StoreLayout.store_path(name), 'rb').read() == name.encode()
+        assert os.path.isdir(StoreLayout.cache_dir(name))
+    assert sorted(os.listdir(str(store))) == ['.s']
+
+
+def test_names_are_single_entries(layout, tmp_path):
+    store, _ = layout
+    for name in ('', '.', '..', '.chunked', '../x', 'a/b', 'a\\b', '/etc/passwd', 'a..b', 'a\0b'):
+        with pytest.raises(StoreLayout.InvalidName):
+            StoreLayout.store_path(name)
+        assert not StoreLayout.is_store_path(name, os.path.join(str(store), name))
+    # a store entry linked out of the store does not resolve either
+    (store / 'linked.txt').symlink_to(tmp_path / 'elsewhere.txt')
+    with pytest.raises(StoreLayout.InvalidName):
+        StoreLayout.store_path('linked.txt')
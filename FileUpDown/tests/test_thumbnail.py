@@ -0,0 +1,55 @@
+# encoding: utf-8
+import io
+
+import pytest
+from PIL import Image
+
+from Service import Transform
+
+
+@pytest.fixture
+def sources(monkeypatch):
+    """
+    :return: list of the sources Transform.image_side built thumbnails from
+    """
+    built = []
+    image_side = Transform.image_side
+
+    def recorded(source, *args, **kwargs):
+        built.append(source)
+        return image_side(source, *args, **kwargs)
+
+    monkeypatch.setattr(Transform, 'image_side', recorded)
+    return built
+
+
+def __side(client, name, side):
+    response = client.get('/file/download/' + name, query_string={'side': side, 'quality': 80})
+    assert response.status_code == 200
+    return Image.open(io.BytesIO(response.data)).size
+
+
+def test_small_thumbnail_comes_from_a_larger_cached_one(client, upload, jpeg, sources):
+    name = upload('derive.jpg', jpeg(1600, 1200), 'image/jpeg')['path']
+    assert __side(client, name, 1080) == (1080, 810)
+    assert __side(client, name, 150)[0] == 150
+    # 1080 is not twice 600: that one comes from the original again
+    assert __side(client, name, 600) == (600, 450)
+    original = sources[0]
+    assert sources[1] != original and '@1080x1080@quality_80' in sources[1]
+    assert sources[2] == original
+
+
+def test_derivation_can_be_turned_off(client, upload, jpeg, sources, monkeypatch):
+    monkeypatch.setattr('GlobalConfigContext.Image_Derive_Min_Ratio', 0)
+    name = upload('no-derive.jpg', jpeg(1600, 1200), 'image/jpeg')['path']
+    __side(client, name, 1080)
+    __side(client, name, 150)
+    assert sources[0] == sources[1]
+
+
+def test_a_lower_quality_thumbnail_is_not_derived_from(client, upload, jpeg, sources):
+    name = upload('quality.jpg', jpeg(1600, 1200), 'image/jpeg')['path']
+    client.get('/file/download/' + name, query_string={'side': 1080, 'quality': 50})
+    __side(client, name, 150)
+    assert sources[0] == sources[1]
@@ -0,0 +1,58 @@
+# encoding: utf-8
+import os
+import threading
+import time
+
+import pytest
+
+import GlobalConfigContext
+from Service import TransformExecutor
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    """
+    One worker and no queue, for the duration of a test.
+    """
+    monkeypatch.setattr(GlobalConfigContext, 'Transform_Workers', 1)
+    monkeypatch.setattr(GlobalConfigContext, 'Transform_Queue_Depth', 0)
+    TransformExecutor.shutdown()
+    yield
+    TransformExecutor.shutdown()
+
+
+def test_inline_without_workers():
+    assert GlobalConfigContext.Transform_Workers == 0
+    assert TransformExecutor.run(os.getpid) == os.getpid()
+
+
+def test_runs_in_a_worker_process(pool):
+    assert TransformExecutor.run(os.getpid) != os.getpid()
+    with pytest.raises(ZeroDivisionError):
+        TransformExecutor.run(divmod, 1, 0)
+
+
+def test_busy_when_every_slot_is_taken(pool):
+    TransformExecutor.run(os.getpid)
+    slow = threading.Thread(target=TransformExecutor.run, args=(time.sleep, 0.5))
+    slow.start()
+    time.sleep(0.1)
+    try:
+        with pytest.raises(TransformExecutor.Busy) as ex:
+            TransformExecutor.run(os.getpid)
+        assert ex.value.retry_after == GlobalConfigContext.Transform_Retry_After
+    finally:
+        slow.join()
+    # the slot is back once the job ended
+    assert TransformExecutor.run(os.getpid) != os.getpid()
+
+
+def test_busy_is_answered_with_503(client, upload, jpeg, monkeypatch):
+    name = upload('busy.jpg', jpeg(300, 200), 'image/jpeg')['path']
+
+    def busy(*args, **kwargs):
+        raise TransformExecutor.Busy(7)
+    monkeypatch.setattr(TransformExecutor, 'run', busy)
+    response = client.get('/file/download/%s?side=100' % name)
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '7'
@@ -0,0 +1,55 @@
+# encoding: utf-8
+import hashlib
+import os
+
+from PIL import Image
+
+import GlobalConfigContext
+from Service import Digest, StoreLayout
+
+
+def test_upload_hashes_sizes_and_sniffs_in_one_pass(upload, jpeg):
+    exif = Image.Exif()
+    exif[0x0112] = 6
+    exif[0x010f] = 'Camera'
+    data = jpeg(64, 48, exif=exif)
+    # the client MIME is only a guess, the bytes decide
+    item = upload('photo.jpg', data, 'application/octet-stream')
+    assert item['hash'] == hashlib.md5(data).hexdigest()
+    assert item['size'] == len(data)
+    assert item['mime'] == 'image/jpeg'
+    assert item['exif']['orientation'] == 6
+    assert item['path'].startswith('photo_') and item['path'].endswith('.jpg')
+    with open(StoreLayout.store_path(item['path']), 'rb') as f:
+        assert f.read() == data
+
+
+def test_upload_keeps_only_the_last_component_of_the_name(upload):
+    for filename, prefix in (('../../up.txt', 'up_'), ('.hidden.txt', 'hidden_'), ('a..b.txt', 'a.b_')):
+        item = upload(filename, b'name', 'text/plain')
+        assert item['path'].startswith(prefix), item['path']
+        with open(StoreLayout.store_path(item['path']), 'rb') as f:
+            assert f.read() == b'name'
+
+
+def test_upload_larger_than_the_header(upload, monkeypatch):
+    monkeypatch.setattr(GlobalConfigContext, 'Upload_Header_Size', 1024)
+    data = os.urandom(300 * 1024)
+    item = upload('blob.bin', data)
+    assert item['size'] == len(data)
+    assert item['hash'] == hashlib.md5(data).hexdigest()
+
+
+def test_upload_hash_algorithm(upload, monkeypatch):
+    monkeypatch.setattr(GlobalConfigContext, 'Upload_Hash_Algorithm', 'blake2b')
+    data = b'same bytes, another digest'
+    assert upload('note.txt', data, 'text/plain')['hash'] == hashlib.blake2b(data, digest_size=32).hexdigest()
+
+
+def test_stream_digest_keeps_the_header_only():
+    digest = Digest.StreamDigest(None, algorithm='sha256', header_size=4)
+    digest.write(b'ab')
+    digest.write(b'cdef')
+    assert digest.header == b'abcd'
+    assert digest.size == 6
+    assert digest.hexdigest() == hashlib.sha256(b'abcdef').hexdigest()
@@ -0,0 +1,98 @@
+# encoding: utf-8
+import io
+import os
+import tempfile
+
+import pytest
+from PIL import Image
+
+from Service import Transform
+
+
+@pytest.fixture(scope='module')
+def video():
+    """
+    :return: bytes of a 3 s, 10 fps MP4 whose frame i is a flat gray of level 8 * i
+    """
+    cv2 = pytest.importorskip('cv2')
+    import numpy
+    fd, path = tempfile.mkstemp(suffix='.mp4')
+    os.close(fd)
+    try:
+        writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'mp4v'), 10, (160, 120))
+        for i in range(30):
+            writer.write(numpy.full((120, 160, 3), i * 8, numpy.uint8))
+        writer.release()
+        with open(path, 'rb') as f:
+            return f.read()
+    finally:
+        os.remove(path)
+
+
+@pytest.fixture
+def png():
+    im = Image.frombytes('RGB', (400, 300), os.urandom(400 * 300 * 3))
+    buf = io.BytesIO()
+    im.save(buf, 'PNG')
+    return buf.getvalue()
+
+
+# covers are asked with the MIME the client knows, as the apps do
+COVER = {'cover': 1, 'mime': 'video/mp4'}
+
+
+def __image(response):
+    assert response.status_code == 200, response.status_code
+    return Image.open(io.BytesIO(response.data))
+
+
+def test_video_poster(client, upload, video):
+    name = upload('clip.mp4', video, 'video/mp4')['path']
+    im = __image(client.get('/file/download/' + name, query_string=COVER))
+    assert im.size == (160, 120)
+
+
+def test_video_frame_strip(client, upload, video):
+    name = upload('strip.mp4', video, 'video/mp4')['path']
+    response = client.get('/file/download/' + name, query_string=dict(COVER, frames=4, side=80))
+    strip = __image(response)
+    assert response.headers['X-Frame-Count'] == '4'
+    assert (int(response.headers['X-Frame-Width']), int(response.headers['X-Frame-Height'])) == (80, 60)
+    assert strip.size == (320, 60)
+    # evenly spaced frames: each tile is brighter than the one before
+    levels = [strip.convert('L').getpixel((80 * i + 40, 30)) for i in range(4)]
+    assert levels == sorted(levels) and levels[0] < levels[-1]
+
+    one = __image(client.get('/file/download/' + name, query_string=dict(COVER, frames=4, side=80, frame=2)))
+    assert one.size == (80, 60)
+    assert abs(one.convert('L').getpixel((40, 30)) - levels[2]) <= 8
+    assert client.get('/file/download/' + name, query_string=dict(COVER, frames=4, frame=4)).status_code == 404
+
+
+def test_thumbnail_format_from_accept(client, upload, png):
+    if 'WEBP' not in Transform.save_formats():
+        pytest.skip('this Pillow does not write WebP')
+    name = upload('shot.png', png, 'image/png')['path']
+    response = client.get('/file/download/' + name, query_string={'side': 100},
+                          headers={'Accept': 'image/webp,image/*,*/*;q=0.8'})
+    assert __image(response).format == 'WEBP'
+    assert response.mimetype == 'image/webp'
+    assert 'Accept' in response.vary
+    etag = response.headers['ETag']
+
+    response = client.get('/file/download/' + name, query_string={'side': 100}, headers={'Accept': 'image/*,*/*'})
+    assert __image(response).format == 'PNG'
+    assert 'Accept' in response.vary
+    assert response.headers['ETag'] != etag
+
+
+def test_explicit_format_does_not_vary(client, upload, png):
+    name = upload('explicit.png', png, 'image/png')['path']
+    response = client.get('/file/download/' + name, query_string={'side': 100, 'format': 'jpg'},
+                          headers={'Accept': 'image/webp'})
+    assert __image(response).format == 'JPEG'
+    assert 'Accept' not in response.vary
+    # a plain download is the stored file whatever the client accepts
+    response = client.get('/file/download/' + name, headers={'Accept': 'image/webp'})
+    assert response.data == png
+    assert 'Accept' not in response.vary